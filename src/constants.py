@@ -39,6 +39,18 @@ GEDI_PATH = DATA_PATH / "GEDI"
 GEDI_INTERMEDIATE_PATH = DATA_PATH / "gedi_intermediate"
 INTERMEDIATE_RESULTS = DATA_PATH / "intermediate"
 
+# GEDI shots extracted for the regions of interest, see extract_gedi_data.
+SIERRAS_GEDI_ALL_COLUMNS = f"{GEDI_INTERMEDIATE_PATH}/sierras_gedi_shots.parquet"  # noqa: E501
+SEKI_GEDI_ALL_COLUMNS = f"{GEDI_INTERMEDIATE_PATH}/seki_gedi_shots.parquet"
+
+SIERRAS_GEDI_ID_COLUMNS = f"{GEDI_INTERMEDIATE_PATH}/gedi_info_columns.parquet"
+SEKI_GEDI_ID_COLUMNS = f"{GEDI_INTERMEDIATE_PATH}/seki_gedi_info_columns.parquet"  # noqa: E501
+
+# Archives of all GEDI columns, partitioned by tile and month, see
+# gedi_archive.
+SIERRAS_GEDI_ARCHIVE = f"{GEDI_INTERMEDIATE_PATH}/sierras_gedi_archive"
+SEKI_GEDI_ARCHIVE = f"{GEDI_INTERMEDIATE_PATH}/seki_gedi_archive"
+
 
 def gedi_product_path(product):
     return GEDI_PATH / product.value
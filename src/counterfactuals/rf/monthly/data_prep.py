@@ -7,6 +7,8 @@ from fastai.tabular.all import load_pickle, save_pickle
 from src.constants import DATA_PATH, INTERMEDIATE_RESULTS
 from src.data.adapters import mtbs
 from src.data.processing import overlay
+from src.data.processing.feature_store import FeatureStore
+from src.data.utils import storage
 from src.placebo import placebo
 from src.utils.logging_util import get_logger
 
@@ -25,11 +27,15 @@ def add_landsat_monthly(
     year: int
 ):
     result = df.copy()
-    monthly_overlays = list(
-        Path(f"{overlay.MONTHLY_LANDSAT_FOLDER(year)}").iterdir())
+    # Overlays that weren't migrated from pickles yet are loaded through
+    # their Parquet path as well.
+    monthly_overlays = sorted({
+        path.with_suffix(".parquet") for path in
+        Path(f"{overlay.MONTHLY_LANDSAT_FOLDER(year)}").iterdir()
+        if path.suffix in [".parquet", ".pkl"]})
 
     for filename in monthly_overlays:
-        monthly_df = load_pickle(filename)
+        monthly_df = storage.load_frame(str(filename))
         cols = [col for col in monthly_df if (
             col.startswith("SR_") or col.startswith("NDVI"))]
         result = result.join(monthly_df[cols], how="left")
@@ -40,15 +46,15 @@ def add_landsat_monthly(
 def add_tree_canopy_cover(
     df: pd.DataFrame
 ):
-    tcc = load_pickle(overlay.TCC)
-    return df.join(tcc[TTC_COLUMNS], how="left")
+    return FeatureStore().add_features(df.copy(), TTC_COLUMNS)
 
 
 def add_recent_ndvi(
     df: pd.DataFrame
 ):
-    ndvi = load_pickle(overlay.NDVI_RECENT)
-    return df.join(ndvi, how="left")
+    store = FeatureStore()
+    return store.add_features(
+        df.copy(), store.get_source_columns(overlay.NDVI_RECENT))
 
 
 def create_monthly_landsat_inference_data_sets(
@@ -88,7 +94,7 @@ if __name__ == '__main__':
     k_fold = "set_5"
 
     # Match burned.
-    burned = load_pickle(f"{INPUT_PATH}/burned.pkl")
+    burned = storage.load_frame(f"{INPUT_PATH}/burned.parquet")
     burned = add_tree_canopy_cover(burned)
     burned = add_recent_ndvi(burned)
     create_monthly_landsat_inference_data_sets(
@@ -99,7 +105,8 @@ if __name__ == '__main__':
     # Match unburned.
     for year in MONTHLY_LANDSAT_YEARS:
         logger.info(f"Matching unburned for year {year}.")
-        unburned = load_pickle(f"{INPUT_PATH}/unburned_lc_{year}.pkl")
+        unburned = storage.load_frame(
+            f"{INPUT_PATH}/unburned_lc_{year}.parquet")
         unburned = add_tree_canopy_cover(unburned)
         unburned = add_recent_ndvi(unburned)
         save_pickle(
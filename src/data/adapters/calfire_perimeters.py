@@ -6,7 +6,8 @@ import fiona
 import geopandas as gpd
 import pandas as pd
 from fastai.tabular.all import save_pickle
-from src.constants import DATA_PATH, USER_PATH, SEKI_HULL, SIERRAS_HULL
+from src.constants import DATA_PATH, USER_PATH, SEKI_HULL, SIERRAS_HULL, \
+    SIERRAS_GEDI_ARCHIVE
 
 # Fetch simplified regions of interest.
 SEKI = gpd.read_file(SEKI_HULL)
@@ -100,7 +101,7 @@ class Fire:
         # Create a gdf to store the area around the fire, called fire buffer.
         fire_geometry = self.fire.geometry.iloc[0]
         self.fire_buffer = gpd.GeoSeries([fire_geometry.buffer(
-            1000).symmetric_difference(fire_geometry)])
+            1000).symmetric_difference(fire_geometry)], crs=self.fire.crs)
 
     def get_buffer(self, width: int, exclusion_zone: int = 100):
         # convert to projected CRS to be able to specify distances in meters.
@@ -118,13 +119,23 @@ class Fire:
     def overlay_fire_map(self, gdf: gpd.GeoDataFrame):
         self.fire.overlay(gdf, how="union").plot(cmap='tab20b')
 
-    def load_gedi(self, load_buffer: bool = False):
-        # TODO: remove
-        # self.gedi = gedi_loader.get_gedi_shots(self.fire.geometry)
-        # if load_buffer:
-        #    self.gedi_buffer = gedi_loader.get_gedi_shots(
-        #        self.fire_buffer.geometry)
-        pass
+    def load_gedi(
+            self,
+            load_buffer: bool = False,
+            archive_path: str = SIERRAS_GEDI_ARCHIVE):
+        '''
+        Loads GEDI shots within the fire, and its buffer, reading only the
+        partitions of the GEDI archive around them.
+        '''
+        # Imported here, so that the adapter doesn't need the GEDI loader and
+        # its database stack unless shots are loaded.
+        from src.data.utils import gedi_utils
+
+        self.gedi = gedi_utils.get_gedi_shots(
+            archive_path, "shot_number", geometry=self.fire.geometry)
+        if load_buffer:
+            self.gedi_buffer = gedi_utils.get_gedi_shots(
+                archive_path, "shot_number", geometry=self.fire_buffer)
 
     def get(self):
         return self.fire
@@ -1,7 +1,16 @@
+import os
+import re
+
 import geopandas as gpd
 import pandas as pd
+import rasterio as rio
 from fastai.tabular.all import save_pickle
-from src.constants import DATA_PATH, SIERRAS_HULL, SEKI_HULL
+from src.constants import DATA_PATH, SIERRAS_GEDI_ARCHIVE, SIERRAS_HULL, \
+    SEKI_HULL
+from src.data.utils import raster, storage
+from src.utils.logging_util import get_logger
+
+logger = get_logger(__file__)
 
 # Fetch simplified regions of interest.
 SEKI = gpd.read_file(SEKI_HULL)
@@ -17,6 +26,13 @@ def MTBS_PERIMETERS_TRIMMED(distance):
 
 
 MTBS_INDIVIDUAL_FIRES = f"{DATA_PATH}/mtbs/all_fires/mtbs"
+# dNBR rasters of individual fires, reprojected to WGS84, and their catalog.
+MTBS_DNBR_PATH = f"{DATA_PATH}/mtbs/dnbr_wgs84"
+MTBS_DNBR_CATALOG = f"{MTBS_DNBR_PATH}/catalog.parquet"
+
+
+def MTBS_DNBR(fire_year: int, fire_id: str):
+    return f"{MTBS_DNBR_PATH}/{fire_year}/{fire_id.lower()}_dnbr.tif"
 
 
 class MTBSFirePerimetersDB:
@@ -48,7 +64,7 @@ class MTBSFire:
         # Create a gdf to store the area around the fire, called fire buffer.
         fire_geometry = self.fire.geometry.iloc[0]
         self.fire_buffer = gpd.GeoSeries([fire_geometry.buffer(
-            1000).symmetric_difference(fire_geometry)])
+            1000).symmetric_difference(fire_geometry)], crs=self.fire.crs)
 
     def get_buffer(self, width: int, exclusion_zone: int = 100):
         # convert to projected CRS to be able to specify distances in meters.
@@ -66,14 +82,24 @@ class MTBSFire:
     def overlay_fire_map(self, gdf: gpd.GeoDataFrame):
         self.fire.overlay(gdf, how="union").plot(cmap='tab20b')
 
-    def load_gedi(self, load_buffer: bool = False):
-        # TODO: remove
-        ''' Loads GEDI shots stored for the fire from postgress database. '''
-        # self.gedi = gedi_loader.get_gedi_shots(self.fire.geometry)
-
-        # if load_buffer:
-        #    self.gedi_buffer = gedi_loader.get_gedi_shots(
-        #        self.fire_buffer.geometry)
+    def load_gedi(
+            self,
+            load_buffer: bool = False,
+            archive_path: str = SIERRAS_GEDI_ARCHIVE):
+        '''
+        Loads GEDI shots within the fire, and its buffer, reading only the
+        partitions of the GEDI archive around them.
+        '''
+        # Imported here, so that the adapter doesn't need the GEDI loader and
+        # its database stack unless shots are loaded.
+        from src.data.utils import gedi_utils
+
+        self.gedi = gedi_utils.get_gedi_shots(
+            archive_path, "shot_number", geometry=self.fire.geometry)
+
+        if load_buffer:
+            self.gedi_buffer = gedi_utils.get_gedi_shots(
+                archive_path, "shot_number", geometry=self.fire_buffer)
 
     def get(self):
         return self.fire
@@ -210,3 +236,83 @@ def get_burn_severity(df: pd.DataFrame):
                      'Low_T_adj', 'Mod_T_adj', 'High_T_adj'], inplace=True)
 
     return df
+
+
+def _find_dnbr_file(fire_dir: str, fire_id: str):
+    # MTBS names dNBR rasters {fire_id}_{pre fire date}_{post fire date}_dnbr.
+    r = re.compile(f"^{fire_id.lower()}.*_dnbr\\.tif$")
+    matches = list(filter(r.match, os.listdir(fire_dir)))
+    if len(matches) != 1:
+        logger.warning(f"Found {len(matches)} dnbr files in {fire_dir}.")
+        return None
+    return f"{fire_dir}/{matches[0]}"
+
+
+def build_dnbr_catalog(
+        fires_path: str = MTBS_INDIVIDUAL_FIRES,
+        catalog_path: str = MTBS_DNBR_CATALOG):
+    '''
+    Reprojects dNBR rasters of individual fires in fires_path, stored as
+    {year}/{fire_id}/, to WGS84, and catalogs them by fire_id, with their
+    year and bounds. Rasters that were already reprojected from the same
+    source aren't reprojected again, and an unchanged catalog isn't
+    rewritten, so that it only looks changed to the overlay cache when fires
+    do.
+    '''
+    existing = storage.load_frame(catalog_path) \
+        if storage.frame_exists(catalog_path) else pd.DataFrame()
+
+    rows = []
+    for year in sorted(os.listdir(fires_path)):
+        if not year.isdigit():
+            continue
+        for fire_dir in sorted(os.listdir(f"{fires_path}/{year}")):
+            fire_id = fire_dir.upper()
+            source_path = _find_dnbr_file(
+                f"{fires_path}/{year}/{fire_dir}", fire_id)
+            if source_path is None:
+                continue
+
+            source_mtime_ns = os.stat(source_path).st_mtime_ns
+            dnbr_path = MTBS_DNBR(int(year), fire_id)
+            if fire_id in existing.index and \
+                    existing.loc[fire_id, "source_mtime_ns"] == \
+                    source_mtime_ns and os.path.exists(dnbr_path):
+                rows.append(existing.loc[fire_id].to_dict() |
+                            {"fire_id": fire_id})
+                continue
+
+            logger.info(f"Reprojecting {source_path}.")
+            os.makedirs(os.path.dirname(dnbr_path), exist_ok=True)
+            raster.reproject_raster(source_path, f"{dnbr_path}.tmp")
+            os.replace(f"{dnbr_path}.tmp", dnbr_path)
+            with rio.open(dnbr_path) as src:
+                bounds = src.bounds
+            rows.append({
+                "fire_id": fire_id,
+                "fire_year": int(year),
+                "source_path": source_path,
+                "source_mtime_ns": source_mtime_ns,
+                "dnbr_path": dnbr_path,
+                "minx": bounds.left,
+                "miny": bounds.bottom,
+                "maxx": bounds.right,
+                "maxy": bounds.top,
+            })
+
+    catalog = pd.DataFrame(rows, columns=[
+        "fire_id", "fire_year", "source_path", "source_mtime_ns",
+        "dnbr_path", "minx", "miny", "maxx", "maxy"]).set_index("fire_id")
+    if not catalog.equals(existing):
+        storage.save_frame(catalog_path, catalog)
+    return catalog
+
+
+def get_dnbr_catalog(
+        fires_path: str = MTBS_INDIVIDUAL_FIRES,
+        catalog_path: str = MTBS_DNBR_CATALOG):
+    '''
+    Returns the catalog of reprojected dNBR rasters, up to date with the
+    fires in fires_path. Only new or changed fires are reprojected.
+    '''
+    return build_dnbr_catalog(fires_path, catalog_path)
@@ -0,0 +1,200 @@
+# Local archive of GEDI shots, partitioned by a fixed lat/lon grid of tiles
+# and by the year and month of the shots, as a hive partitioned Parquet
+# dataset:
+#
+#   {archive}/tile_x=-122/tile_y=36/gedi_year=2020/gedi_month=7/*.parquet
+#
+# Reads for a bounding box or geometry, time range and columns only open the
+# partitions that overlap them, and only read the requested columns.
+
+import json
+import math
+import os
+import shutil
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import shapely
+from src.data.gedi import gedi_loader
+from src.data.utils import storage
+from src.utils.logging_util import get_logger
+
+logger = get_logger(__file__)
+
+# Size of the tiles in degrees. The Sierras span around 40 tiles, of up to 60
+# months of GEDI data each.
+ARCHIVE_TILE_SIZE = 1.0
+MAX_PARTITIONS = 100_000
+TILE_COLUMNS = ["tile_x", "tile_y"]
+PARTITIONING = ds.partitioning(
+    pa.schema([
+        ("tile_x", pa.int32()),
+        ("tile_y", pa.int32()),
+        ("gedi_year", pa.int16()),
+        ("gedi_month", pa.int8()),
+    ]),
+    flavor="hive")
+ARCHIVE_METADATA = "_archive.json"
+
+
+def is_archive(path: str):
+    return os.path.isdir(path)
+
+
+def _add_tiles(table: pa.Table, tile_size: float):
+    tile_x = np.floor(table.column("longitude").to_numpy() / tile_size)
+    tile_y = np.floor(table.column("latitude").to_numpy() / tile_size)
+    return table.append_column("tile_x", pa.array(tile_x.astype(np.int32))) \
+        .append_column("tile_y", pa.array(tile_y.astype(np.int32)))
+
+
+def build_archive(
+        input_path: str,
+        archive_path: str,
+        tile_size: float = ARCHIVE_TILE_SIZE):
+    '''
+    Builds an archive from the shots in input_path, as saved by the GEDI
+    loader, reading them in batches. The archive replaces archive_path once
+    it's complete.
+    '''
+    parquet_file = pq.ParquetFile(storage.stored_path(input_path))
+    # Partition columns get the types of PARTITIONING.
+    partition_fields = {field.name: field for field in PARTITIONING.schema}
+    batch_schema = pa.schema([
+        partition_fields.get(field.name, field)
+        for field in parquet_file.schema_arrow])
+    schema = batch_schema.append(partition_fields["tile_x"]) \
+        .append(partition_fields["tile_y"])
+
+    def batches():
+        for batch in parquet_file.iter_batches(
+                batch_size=storage.ROW_GROUP_SIZE):
+            table = pa.Table.from_batches([batch]).cast(batch_schema)
+            yield from _add_tiles(table, tile_size).to_batches()
+
+    tmp_path = f"{archive_path}.tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    logger.info(f"Building GEDI archive {archive_path} from {input_path}.")
+    ds.write_dataset(
+        batches(), tmp_path, schema=schema, format="parquet",
+        partitioning=PARTITIONING,
+        max_partitions=MAX_PARTITIONS,
+        max_rows_per_group=storage.ROW_GROUP_SIZE,
+        existing_data_behavior="error")
+    with open(f"{tmp_path}/{ARCHIVE_METADATA}", "w") as f:
+        json.dump({"tile_size": tile_size}, f)
+
+    if os.path.exists(archive_path):
+        shutil.rmtree(archive_path)
+    os.replace(tmp_path, archive_path)
+
+
+def _get_tile_size(archive_path: str):
+    with open(f"{archive_path}/{ARCHIVE_METADATA}") as f:
+        return json.load(f)["tile_size"]
+
+
+def _get_dataset(archive_path: str):
+    # Files starting with "_", like ARCHIVE_METADATA, are ignored.
+    return ds.dataset(
+        archive_path, format="parquet", partitioning=PARTITIONING)
+
+
+def _get_month_filter(start_time: pd.Timestamp, end_time: pd.Timestamp):
+    # Conditions on the partition columns, so that partitions outside of the
+    # time range are skipped.
+    year, month = ds.field("gedi_year"), ds.field("gedi_month")
+    condition = None
+    if start_time is not None:
+        condition = (year > start_time.year) | \
+            ((year == start_time.year) & (month >= start_time.month))
+    if end_time is not None:
+        before_end = (year < end_time.year) | \
+            ((year == end_time.year) & (month <= end_time.month))
+        condition = before_end if condition is None \
+            else condition & before_end
+    return condition
+
+
+def load_shots(
+        archive_path: str,
+        columns: list[str] = None,
+        geometry: gpd.GeoSeries = None,
+        bbox: tuple = None,
+        start_time: str = None,
+        end_time: str = None) -> pd.DataFrame:
+    '''
+    Loads shots from the archive, within geometry or bbox (minx, miny, maxx,
+    maxy), both in WGS84, and with start_time <= absolute_time < end_time.
+    Only partitions that overlap them are read, and only the columns
+    requested.
+    '''
+    dataset = _get_dataset(archive_path)
+    if columns is None:
+        columns = [name for name in dataset.schema.names
+                   if name not in TILE_COLUMNS]
+
+    if geometry is not None:
+        bbox = geometry.total_bounds
+    start_time = None if start_time is None else \
+        pd.Timestamp(start_time, tz="UTC")
+    end_time = None if end_time is None else \
+        pd.Timestamp(end_time, tz="UTC")
+
+    conditions = []
+    if bbox is not None:
+        tile_size = _get_tile_size(archive_path)
+        minx, miny, maxx, maxy = bbox
+        conditions += [
+            (ds.field("tile_x") >= math.floor(minx / tile_size))
+            & (ds.field("tile_x") <= math.floor(maxx / tile_size))
+            & (ds.field("tile_y") >= math.floor(miny / tile_size))
+            & (ds.field("tile_y") <= math.floor(maxy / tile_size)),
+            (ds.field("longitude") >= minx) & (ds.field("longitude") <= maxx)
+            & (ds.field("latitude") >= miny) & (ds.field("latitude") <= maxy)
+        ]
+    if start_time is not None or end_time is not None:
+        conditions += [_get_month_filter(start_time, end_time)]
+    if start_time is not None:
+        conditions += [ds.field("absolute_time") >= pa.scalar(
+            start_time, type=dataset.schema.field("absolute_time").type)]
+    if end_time is not None:
+        conditions += [ds.field("absolute_time") < pa.scalar(
+            end_time, type=dataset.schema.field("absolute_time").type)]
+
+    condition = None
+    for c in conditions:
+        condition = c if condition is None else condition & c
+
+    read_columns = list(columns)
+    if geometry is not None:
+        read_columns += [column for column in ["longitude", "latitude"]
+                         if column not in columns]
+    table = dataset.to_table(columns=read_columns, filter=condition)
+
+    if geometry is not None:
+        shape = shapely.union_all(geometry.values)
+        inside = shapely.intersects_xy(
+            shape,
+            table.column("longitude").to_numpy(),
+            table.column("latitude").to_numpy())
+        table = table.filter(pa.array(inside)).select(columns)
+
+    logger.debug(f"Loaded {table.num_rows} shots from {archive_path}.")
+    # Categoricals of other types than strings are read as their values.
+    return gedi_loader.apply_gedi_schema(table.to_pandas())
+
+
+def get_columns(archive_path: str):
+    dataset = _get_dataset(archive_path)
+    return [name for name in dataset.schema.names if name not in TILE_COLUMNS]
+
+
+def get_mtime_ns(archive_path: str):
+    ''' Time the archive was built, which changes with every rebuild. '''
+    return os.stat(f"{archive_path}/{ARCHIVE_METADATA}").st_mtime_ns
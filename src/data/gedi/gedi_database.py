@@ -1,14 +1,83 @@
+import datetime
+import decimal
+import io
+import json
+import os
+import threading
+import time
 import warnings
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
 import pyproj
-from sqlalchemy import create_engine, inspect
-from src.constants import DB_CONFIG, WGS84
+from sqlalchemy import ARRAY, bindparam, create_engine, inspect, text
+from sqlalchemy.dialects import postgresql
+from src.constants import DB_CONFIG, GEDI_INTERMEDIATE_PATH, WGS84
 from src.utils.logging_util import get_logger
 
 logger = get_logger(__file__)
 
+# Engines are shared by all GediDatabase instances in a process, and keep a
+# pool of up to POOL_SIZE connections.
+POOL_SIZE = 5
+
+# Column names and types of the database tables are cached on disk, and
+# inspected again once they are older than SCHEMA_CACHE_TTL seconds.
+SCHEMA_CACHE = f"{GEDI_INTERMEDIATE_PATH}/gedi_schema_cache.json"
+SCHEMA_CACHE_TTL = 24 * 60 * 60
+
+_engines = {}
+_schemas = {}
+_lock = threading.Lock()
+
+
+# SQL operators of query filters.
+SQL_OPERATORS = {
+    "=": "=",
+    "==": "=",
+    "!=": "!=",
+    "<": "<",
+    "<=": "<=",
+    ">": ">",
+    ">=": ">=",
+    "in": "IN",
+    "not in": "NOT IN",
+    "between": "BETWEEN",
+}
+
+
+def compile_filters(filters: list):
+    '''
+    Compiles filters, a list of (column, op, value) conditions that are
+    combined with AND, e.g. [("l4_quality_flag", "=", 1),
+    ("beam_type", "in", ["full"]), ("sensitivity_a0", "between", (0.9, 1))],
+    to SQL conditions and their bound parameters. Values are never
+    interpolated into the query.
+    '''
+    conditions = []
+    params = []
+    for i, (column, op, value) in enumerate(filters or []):
+        if op not in SQL_OPERATORS:
+            raise ValueError(f"Unsupported filter operator {op}.")
+        name = f"filter_{i}"
+        if op == "between":
+            low, high = value
+            conditions += [
+                f"{column} BETWEEN :{name}_low AND :{name}_high"]
+            params += [bindparam(f"{name}_low", low),
+                       bindparam(f"{name}_high", high)]
+        elif op in ["in", "not in"]:
+            conditions += [f"{column} {SQL_OPERATORS[op]} :{name}"]
+            params += [bindparam(name, list(value), expanding=True)]
+        else:
+            conditions += [f"{column} {SQL_OPERATORS[op]} :{name}"]
+            params += [bindparam(name, value)]
+    return conditions, params
+
 
 def gedi_sql_query(
     table_name: str,
@@ -19,13 +88,18 @@ def gedi_sql_query(
     end_time: str = None,
     limit: int = None,
     force: bool = False,
+    filters: list = None,
 ):
-
-    conditions = []
+    '''
+    Returns the query as an SQL text clause with bound parameters. See
+    compile_filters for the format of filters.
+    '''
+    conditions, params = compile_filters(filters)
     # Temporal conditions
     if start_time is not None and end_time is not None:
-        conditions += [
-            f"absolute_time between '{start_time}' and '{end_time}'"]
+        conditions += ["absolute_time between :start_time and :end_time"]
+        params += [bindparam("start_time", start_time),
+                   bindparam("end_time", end_time)]
     # Spatial conditions
     if geometry is not None:
         crs = pyproj.CRS.from_user_input(crs)
@@ -37,17 +111,17 @@ def gedi_sql_query(
                     and will be removed in Shapely 2.0",
             )
             conditions += [
-                "ST_Intersects(geometry, "
-                f"ST_GeomFromText(\
-                    '{geometry.to_wkt().values[0]}', {crs.to_epsg()}))"
+                "ST_Intersects(geometry, ST_GeomFromText(:geometry, :srid))"
             ]
+            params += [bindparam("geometry", geometry.to_wkt().values[0]),
+                       bindparam("srid", crs.to_epsg())]
 
     # Combining conditions
     condition = (
         f" WHERE {' and '.join(conditions)}" if len(conditions) > 0 else ""
     )
     # Setting limits
-    limits = f" LIMIT {limit}" if limit is not None else ""
+    limits = f" LIMIT {int(limit)}" if limit is not None else ""
 
     if not force and condition == "" and limit is None:
         raise UserWarning(
@@ -58,27 +132,166 @@ def gedi_sql_query(
     sql_query = (
         f"SELECT {', '.join(columns)} FROM {table_name}" + condition + limits
     )
-    return sql_query
+    return text(sql_query).bindparams(*params)
+
+
+# Types of postgres columns, as stored in the schema cache, by their python
+# type. Columns of other types, e.g. geometry, are read as strings.
+COLUMN_TYPES = {
+    int: "int64",
+    float: "float64",
+    decimal.Decimal: "float64",
+    bool: "bool",
+    str: "string",
+    datetime.datetime: "timestamp",
+    datetime.date: "date",
+}
+ARRAY_TYPE = "array"
+
+ARROW_TYPES = {
+    "int64": pa.int64(),
+    "float64": pa.float64(),
+    "bool": pa.bool_(),
+    "string": pa.string(),
+    "timestamp": pa.timestamp("us", tz="UTC"),
+    "date": pa.date32(),
+    # Arrays are read as strings, and parsed by _parse_arrays.
+    ARRAY_TYPE: pa.string(),
+}
+
+
+def _get_column_type(column_type):
+    if isinstance(column_type, ARRAY):
+        return ARRAY_TYPE
+    try:
+        return COLUMN_TYPES.get(column_type.python_type, "string")
+    except NotImplementedError:
+        return "string"
+
+
+def get_engine(db_config: str = DB_CONFIG, pool_size: int = POOL_SIZE):
+    '''
+    Returns the engine of db_config, shared by the whole process. Engines are
+    thread safe, and hand out connections from their pool.
+    '''
+    with _lock:
+        if (db_config, pool_size) not in _engines:
+            _engines[(db_config, pool_size)] = create_engine(
+                db_config, echo=False, pool_size=pool_size, max_overflow=0,
+                pool_pre_ping=True)
+        return _engines[(db_config, pool_size)]
+
+
+def _inspect_schema(engine):
+    with warnings.catch_warnings():
+        warnings.filterwarnings(
+            "ignore", "Did not recognize type 'geometry' of column"
+        )
+        inspector = inspect(engine)
+        return {
+            table_name: {
+                col["name"]: _get_column_type(col["type"])
+                for col in inspector.get_columns(table_name)
+            }
+            for table_name in inspector.get_table_names()
+        }
+
+
+def _load_schema_cache(cache_path: str):
+    if not os.path.exists(cache_path):
+        return {}
+    with open(cache_path) as f:
+        return json.load(f)
+
+
+def _save_schema_cache(cache: dict, cache_path: str):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, cache_path)
+
+
+def get_schema(
+        engine,
+        refresh: bool = False,
+        cache_path: str = SCHEMA_CACHE,
+        ttl: float = SCHEMA_CACHE_TTL):
+    '''
+    Returns a dict of table name to a dict of its column names and types.
+    The schema is inspected only if refresh is set, or if the cached schema
+    is older than ttl seconds, and is then cached on disk and in memory.
+    '''
+    key = engine.url.render_as_string(hide_password=True)
+    with _lock:
+        entry = _schemas.get(key)
+        if entry is None:
+            entry = _load_schema_cache(cache_path).get(key)
+        if refresh or entry is None or time.time() - entry["created"] > ttl:
+            logger.info(f"Inspecting the schema of {key}.")
+            entry = {"created": time.time(),
+                     "tables": _inspect_schema(engine)}
+            cache = _load_schema_cache(cache_path)
+            cache[key] = entry
+            _save_schema_cache(cache, cache_path)
+        _schemas[key] = entry
+        return entry["tables"]
+
+
+def _parse_arrays(column: pa.ChunkedArray):
+    '''
+    Parses postgres array literals, e.g. "{1.5,NULL,2}", to a list<float64>
+    column, without going through python objects.
+    '''
+    column = column.combine_chunks()
+    trimmed = pc.utf8_trim(column, "{}")
+    elements = pc.split_pattern(trimmed, ",")
+    # Empty arrays are split into a single empty element.
+    empty = pc.fill_null(pc.equal(trimmed, ""), False)
+    lengths = pc.if_else(
+        empty, 0, pc.fill_null(pc.list_value_length(elements), 0))
+    offsets = np.concatenate(
+        [[0], np.cumsum(lengths.to_numpy(zero_copy_only=False))])
+
+    values = pc.list_flatten(elements)
+    values = values.filter(pc.invert(
+        empty.take(pc.list_parent_indices(elements))))
+    values = pc.if_else(pc.equal(values, "NULL"), None, values)
+    return pa.ListArray.from_arrays(
+        pa.array(offsets, type=pa.int32()),
+        values.cast(pa.float64()),
+        mask=pc.is_null(column))
 
 
 class GediDatabase(object):
     """Database connector for the GEDI DB."""
 
-    def __init__(self):
-        self.engine = create_engine(DB_CONFIG, echo=False)
-        with warnings.catch_warnings():
-            warnings.filterwarnings(
-                "ignore", "Did not recognize type 'geometry' of column"
-            )
-            self.inspector = inspect(self.engine)
+    def __init__(
+            self,
+            pool_size: int = POOL_SIZE,
+            db_config: str = DB_CONFIG,
+            refresh_schema: bool = False):
+        """
+        Uses the process-wide engine of db_config, with a pool of up to
+        pool_size connections, which can be shared by threads querying in
+        parallel. The schema is read from the schema cache, unless
+        refresh_schema is set.
+        """
+        self.engine = get_engine(db_config, pool_size)
+        self._set_schema(get_schema(self.engine, refresh=refresh_schema))
+
+    def _set_schema(self, column_types: dict):
+        self.column_types = column_types
+        self.allowed_cols = {
+            table_name: set(columns)
+            for table_name, columns in column_types.items()
+        }
+        self._schema_refreshed = False
 
-            self.allowed_cols = {}
-            for table_name in self.inspector.get_table_names():
-                allowed_cols = {
-                    col["name"]
-                    for col in self.inspector.get_columns(table_name)
-                }
-                self.allowed_cols[table_name] = allowed_cols
+    def refresh_schema(self):
+        """Inspects the database schema again, e.g. after tables changed."""
+        self._set_schema(get_schema(self.engine, refresh=True))
+        self._schema_refreshed = True
 
     def query(
         self,
@@ -91,18 +304,10 @@ class GediDatabase(object):
         limit: int = None,
         use_geopandas: bool = False,
         force: bool = False,
+        filters: list = None,
     ) -> pd.DataFrame:
 
-        if table_name not in self.allowed_cols:
-            raise ValueError("Unsupported table {table_name}.")
-
-        if columns != "*":
-            for column in columns:
-                if column not in self.allowed_cols[table_name]:
-                    raise ValueError(
-                        f"`{column}` not allowed.\
-                            Must be one of {self.allowed_cols[table_name]}"
-                    )
+        self._validate_columns(table_name, columns, filters)
 
         if use_geopandas or geometry is not None:
             if columns != "*" and "geometry" not in columns:
@@ -118,9 +323,11 @@ class GediDatabase(object):
                 start_time=start_time,
                 end_time=end_time,
                 force=force,
+                filters=filters,
             )
 
-            logger.debug("SQL Query: %s", sql_query)
+            logger.debug("SQL Query: %s, parameters: %s", sql_query,
+                         sql_query.compile().params)
             return gpd.read_postgis(
                 sql_query, con=self.engine, geom_col="geometry"
             )
@@ -136,7 +343,161 @@ class GediDatabase(object):
                 start_time=start_time,
                 end_time=end_time,
                 force=force,
+                filters=filters,
             )
 
-            logger.debug("SQL Query: %s", sql_query)
+            logger.debug("SQL Query: %s, parameters: %s", sql_query,
+                         sql_query.compile().params)
             return pd.read_sql(sql_query, con=self.engine)
+
+    def query_chunks(
+        self,
+        table_name: str,
+        columns: str = "*",
+        geometry: gpd.GeoDataFrame = None,
+        crs: str = WGS84,
+        start_time: str = None,
+        end_time: str = None,
+        limit: int = None,
+        force: bool = False,
+        filters: list = None,
+        chunksize: int = 100_000,
+        dtypes: dict = None,
+    ):
+        """
+        Streams the result of a query in frames of up to chunksize rows,
+        through a server-side cursor, so the whole result is never in memory.
+        Every chunk is cast to dtypes, so that chunks have the same types even
+        if a column is all null in some of them. The geometry is only used to
+        filter rows, and isn't returned.
+        """
+        self._validate_columns(table_name, columns, filters)
+
+        sql_query = gedi_sql_query(
+            table_name,
+            columns=columns,
+            geometry=geometry,
+            crs=crs,
+            limit=limit,
+            start_time=start_time,
+            end_time=end_time,
+            force=force,
+            filters=filters,
+        )
+
+        logger.debug("SQL Query: %s, parameters: %s", sql_query,
+                     sql_query.compile().params)
+        with self.engine.connect().execution_options(
+                stream_results=True, max_row_buffer=chunksize) as connection:
+            for chunk in pd.read_sql(
+                    sql_query, con=connection, chunksize=chunksize):
+                yield chunk if dtypes is None else chunk.astype(dtypes)
+
+    def query_arrow(
+        self,
+        table_name: str,
+        columns: str = "*",
+        geometry: gpd.GeoDataFrame = None,
+        crs: str = WGS84,
+        start_time: str = None,
+        end_time: str = None,
+        limit: int = None,
+        force: bool = False,
+        filters: list = None,
+    ) -> pa.Table:
+        """
+        Fast path for large reads, returning an Arrow table. The query result
+        is copied out of postgres with COPY, and parsed into Arrow columns by
+        the multithreaded Arrow CSV reader, instead of converting every row to
+        python objects. Use table.to_pandas() for a data frame.
+
+        Like query_chunks, the geometry is only used to filter rows. Geometry
+        columns aren't decoded, use lon_lowestmode and lat_lowestmode instead.
+        """
+        self._validate_columns(table_name, columns, filters)
+        if columns == "*":
+            columns = list(self.column_types[table_name])
+
+        sql_query = gedi_sql_query(
+            table_name,
+            columns=columns,
+            geometry=geometry,
+            crs=crs,
+            limit=limit,
+            start_time=start_time,
+            end_time=end_time,
+            force=force,
+            filters=filters,
+        )
+
+        # COPY doesn't take bound parameters, so they are rendered into the
+        # query by the driver, which escapes them.
+        compiled = sql_query.compile(
+            dialect=postgresql.dialect(),
+            compile_kwargs={"render_postcompile": True})
+        connection = self.engine.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                select = cursor.mogrify(
+                    str(compiled), compiled.params).decode()
+                logger.debug("SQL Query: %s", select)
+                cursor.execute("SET TIME ZONE 'UTC'")
+                buffer = io.BytesIO()
+                cursor.copy_expert(
+                    f"COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER)",
+                    buffer)
+            connection.commit()
+        finally:
+            connection.close()
+
+        column_types = {
+            column: ARROW_TYPES[self.column_types[table_name][column]]
+            for column in columns}
+        buffer.seek(0)
+        table = pa_csv.read_csv(
+            buffer,
+            convert_options=pa_csv.ConvertOptions(
+                column_types=column_types,
+                # Nulls are empty, and empty strings are quoted.
+                null_values=[""],
+                quoted_strings_can_be_null=False,
+                true_values=["t"],
+                false_values=["f"],
+                timestamp_parsers=[pa_csv.ISO8601]))
+
+        for i, column in enumerate(columns):
+            if self.column_types[table_name][column] == ARRAY_TYPE:
+                table = table.set_column(
+                    i, column, _parse_arrays(table.column(column)))
+        return table
+
+    def _validate_columns(
+            self, table_name: str, columns: str, filters: list = None):
+        # Tables and columns missing from a cached schema may have been
+        # added since it was cached.
+        requested = [] if columns == "*" else list(columns)
+        requested += [column for column, _, _ in filters or []]
+        if not self._schema_refreshed and (
+                table_name not in self.allowed_cols or not set(requested)
+                <= self.allowed_cols[table_name]):
+            self.refresh_schema()
+
+        if table_name not in self.allowed_cols:
+            raise ValueError(f"Unsupported table {table_name}.")
+
+        if columns != "*":
+            for column in columns:
+                if column not in self.allowed_cols[table_name]:
+                    raise ValueError(
+                        f"`{column}` not allowed.\
+                            Must be one of {self.allowed_cols[table_name]}"
+                    )
+
+        # Columns of filters are interpolated into the query, so they are
+        # validated the same way.
+        for column, _, _ in filters or []:
+            if column not in self.allowed_cols[table_name]:
+                raise ValueError(
+                    f"Filter on `{column}` not allowed.\
+                        Must be one of {self.allowed_cols[table_name]}"
+                )
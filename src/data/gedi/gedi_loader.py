@@ -1,8 +1,14 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
 import geopandas as gpd
+import numpy as np
 import pandas as pd
-from fastai.tabular.all import load_pickle, save_pickle
+import pyarrow as pa
 from src import constants
-from src.data.gedi.gedi_database import GediDatabase
+from src.data.gedi.gedi_database import POOL_SIZE, GediDatabase
+from src.data.utils import shape_processor, storage
 from src.utils.logging_util import get_logger
 
 logger = get_logger(__file__)
@@ -35,10 +41,9 @@ ALL_POSTGRES_COLUMNS = [
     "cover",
     "cover_z",
 
-    # Quality Data
+    # Quality Data, l4_algorithm_run_flag and l4_quality_flag are filtered on
+    # in the query, see QUALITY_FILTERS.
     "sensitivity_a0",
-    "l4_algorithm_run_flag",
-    "l4_quality_flag",
     # "predictor_limit_flag",
     # "response_limit_flag",
     "solar_elevation",
@@ -52,6 +57,95 @@ ALL_POSTGRES_COLUMNS = [
 ]
 
 
+# Columns that are renamed once shots are fetched.
+RENAMED_COLUMNS = {
+    "lon_lowestmode": "longitude",
+    "lat_lowestmode": "latitude",
+}
+
+# Preliminary filtering to reduce computation size, run in the query, see
+# gedi_database.compile_filters. More filters, e.g. on beam_type or
+# sensitivity_a0, can be added by callers.
+QUALITY_FILTERS = [
+    ("l4_quality_flag", "=", 1),
+    ("l4_algorithm_run_flag", "=", 1),
+]
+
+# Types of the numeric columns, so that chunks streamed from postgres have the
+# same types even when a column is all null within a chunk.
+POSTGRES_DTYPES = {
+    "shot_number": "int64",
+    "elevation_difference_tdx": "float64",
+    "agbd": "float64",
+    "agbd_se": "float64",
+    "fhd_normal": "float64",
+    "pai": "float64",
+    "rh_98": "float64",
+    "rh_70": "float64",
+    "rh_50": "float64",
+    "rh_25": "float64",
+    "cover": "float64",
+    "sensitivity_a0": "float64",
+    "solar_elevation": "float64",
+}
+
+# Compact types of processed GEDI shot frames. Measurements are float32,
+# coordinates stay float64, as float32 would move shots by up to a meter.
+BEAM_TYPES = ["coverage", "full"]
+PFT_CLASSES = list(range(12))
+# Fill values of unclassified shots, which become missing values.
+FILL_VALUES = {
+    "gridded_pft_class": [255, -9999],
+}
+GEDI_SCHEMA = {
+    "shot_number": "int64",
+    "beam_type": pd.CategoricalDtype(BEAM_TYPES),
+    "longitude": "float64",
+    "latitude": "float64",
+    "elevation_difference_tdx": "float32",
+    "agbd": "float32",
+    "agbd_se": "float32",
+    "fhd_normal": "float32",
+    "pai": "float32",
+    "rh_98": "float32",
+    "rh_70": "float32",
+    "rh_50": "float32",
+    "rh_25": "float32",
+    "cover": "float32",
+    "sensitivity_a0": "float32",
+    "solar_elevation": "float32",
+    "gridded_pft_class": pd.CategoricalDtype(PFT_CLASSES),
+    "gedi_year": "int16",
+    "gedi_month": "int8",
+}
+
+# Arrow types of the shot files written by stream_combined_l2ab_l4a_shots,
+# for the columns that aren't in GEDI_SCHEMA.
+ARROW_TYPES = {
+    "absolute_time": pa.timestamp("ns", tz="UTC"),
+    "pai_z": pa.list_(pa.float64()),
+    "pavd_z": pa.list_(pa.float64()),
+    "cover_z": pa.list_(pa.float64()),
+}
+
+# Maximum absolute error of the compact types, in the units of the column.
+PRECISION_TOLERANCES = {
+    "agbd": 0.01,
+    "agbd_se": 0.01,
+    "rh_98": 0.01,
+    "rh_70": 0.01,
+    "rh_50": 0.01,
+    "rh_25": 0.01,
+}
+
+# Number of shots streamed from postgres at a time.
+CHUNK_SIZE = 500_000
+
+# Regions are extracted in tiles of TILE_SIZE degrees, TILE_WORKERS at a time.
+TILE_SIZE = 0.5
+TILE_WORKERS = 4
+
+
 # Minimal columns necessary for intersecting GEDI data with other raster-based
 # datasets.
 ID_COLUMNS = [
@@ -67,7 +161,8 @@ def get_combined_l2ab_l4a_shots(
     start_year: int = 2019,
     end_year: int = 2024,
     crs: str = constants.WGS84,
-    save_file_path: str = None
+    save_file_path: str = None,
+    filters: list = QUALITY_FILTERS
 ):
     database = GediDatabase()
 
@@ -81,57 +176,251 @@ def get_combined_l2ab_l4a_shots(
         crs=crs,
         start_time=f"{start_year}-01-01",
         end_time=f"{end_year}-01-01",
+        filters=filters,
     )
     logger.debug(f'Found {len(gedi_shots)} shots in \
         {start_year}-{end_year} in the specified geometry')
 
-    # Preliminary filtering to reduce computation size
-    gedi_shots = gedi_shots[
-        (gedi_shots.l4_quality_flag == 1)
-        & (gedi_shots.l4_algorithm_run_flag == 1)
-    ]
-    # Drop the columns we filtered on already.
-    gedi_shots = gedi_shots.drop(
-        columns=['l4_algorithm_run_flag', 'l4_quality_flag'])
-
     gedi_shots = initial_shot_processing(gedi_shots)
 
     logger.info(f'Number of GEDI shots found: {gedi_shots.shape[0]}')
 
     logger.info(save_file_path)
     if save_file_path is not None:
-        logger.info(f"Saving data into a pickle file: {save_file_path}")
-        save_pickle(save_file_path, gedi_shots)
+        logger.info(f"Saving data into a Parquet file: {save_file_path}")
+        storage.save_frame(save_file_path, gedi_shots)
         logger.info("Data successfully saved.")
 
     return gedi_shots
 
 
+def _get_arrow_type(column: str):
+    if column in ARROW_TYPES:
+        return ARROW_TYPES[column]
+    dtype = GEDI_SCHEMA[column]
+    if isinstance(dtype, pd.CategoricalDtype):
+        # Pandas stores codes of less than 128 categories as int8.
+        return pa.dictionary(pa.int8(), pa.array(dtype.categories).type)
+    return pa.from_numpy_dtype(np.dtype(dtype))
+
+
+def get_shots_schema():
+    '''
+    Arrow schema of the shots written by stream_combined_l2ab_l4a_shots, so
+    that every chunk is written with the same types, even if a column is all
+    null in the first one.
+    '''
+    columns = [RENAMED_COLUMNS.get(column, column)
+               for column in ALL_POSTGRES_COLUMNS]
+    return pa.schema([(column, _get_arrow_type(column))
+                      for column in columns + ["gedi_year", "gedi_month"]])
+
+
+def stream_combined_l2ab_l4a_shots(
+    geometry: gpd.GeoDataFrame,
+    save_file_path: str,
+    start_year: int = 2019,
+    end_year: int = 2024,
+    crs: str = constants.WGS84,
+    chunksize: int = CHUNK_SIZE,
+    filters: list = QUALITY_FILTERS,
+    database: GediDatabase = None
+):
+    '''
+    Same as get_combined_l2ab_l4a_shots, but streams shots from postgres in
+    chunks, processes each chunk and appends it to save_file_path, so that
+    memory is bounded by the chunk size rather than the size of the region.
+    The geometry column isn't saved, as shots have longitude and latitude.
+    '''
+    if database is None:
+        database = GediDatabase()
+
+    logger.info(f'Streaming combined GEDI shots for period \
+        {start_year}-{end_year} in this geometry')
+    chunks = database.query_chunks(
+        table_name="filtered_l2ab_l4a_shots",
+        columns=ALL_POSTGRES_COLUMNS,
+        geometry=geometry,
+        crs=crs,
+        start_time=f"{start_year}-01-01",
+        end_time=f"{end_year}-01-01",
+        filters=filters,
+        chunksize=chunksize,
+        dtypes=POSTGRES_DTYPES,
+    )
+
+    with storage.FrameWriter(save_file_path, get_shots_schema()) as writer:
+        for chunk in chunks:
+            writer.write(initial_shot_processing(chunk))
+            logger.debug(f'Saved {writer.num_rows} shots so far.')
+
+    logger.info(f'Number of GEDI shots found: {writer.num_rows}')
+    if writer.num_rows == 0:
+        logger.warning(f'No shots found, {save_file_path} was not written.')
+    return writer.num_rows
+
+
+def TILES_PATH(output_path: str):
+    return f"{os.path.splitext(output_path)[0]}_tiles"
+
+
+def _is_tile_done(done_path: str, tile_wkt: str):
+    if not os.path.exists(done_path):
+        return False
+    with open(done_path) as f:
+        return f.read() == tile_wkt
+
+
+def stream_tiled_l2ab_l4a_shots(
+    geometry: gpd.GeoDataFrame,
+    save_file_path: str,
+    tile_size: float = TILE_SIZE,
+    workers: int = TILE_WORKERS,
+    keep_tiles: bool = False,
+    crs: str = constants.WGS84,
+    **kwargs
+):
+    '''
+    Splits geometry into a grid of tiles of tile_size, in units of crs, and
+    streams the shots of each tile into its own file, up to `workers` tiles
+    at a time over a shared connection pool. Shots on the edges of tiles are
+    deduplicated by shot number when tiles are merged into save_file_path.
+
+    Finished tiles are marked as done, so a run that fails on some tiles can
+    be rerun to only fetch the remaining ones. Tiles are removed once they are
+    merged, unless keep_tiles is set. kwargs are passed to
+    stream_combined_l2ab_l4a_shots.
+    '''
+    tiles_path = TILES_PATH(save_file_path)
+    os.makedirs(tiles_path, exist_ok=True)
+    tiles = shape_processor.get_grid(geometry, tile_size, crs)
+    # Tiles share the process-wide engine, if its pool is large enough.
+    database = GediDatabase(pool_size=max(workers, POOL_SIZE))
+
+    def fetch_tile(tile):
+        tile_path = f"{tiles_path}/{tile.tile}.parquet"
+        done_path = f"{tiles_path}/{tile.tile}.done"
+        # Tiles are only done if they were fetched for the same geometry.
+        if _is_tile_done(done_path, tile.geometry.wkt):
+            logger.debug(f'Tile {tile.tile} is already fetched.')
+            return
+        if os.path.exists(tile_path):
+            os.remove(tile_path)
+
+        stream_combined_l2ab_l4a_shots(
+            gpd.GeoSeries([tile.geometry], crs=crs), tile_path, crs=crs,
+            database=database, **kwargs)
+        with open(done_path, "w") as f:
+            f.write(tile.geometry.wkt)
+
+    logger.info(f'Fetching GEDI shots in {len(tiles)} tiles.')
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch_tile, tile): tile.tile
+                   for tile in tiles.itertuples()}
+        for future, name in futures.items():
+            try:
+                future.result()
+            except Exception:
+                logger.exception(f'Fetching tile {name} failed.')
+                failed.append(name)
+
+    if failed:
+        raise Exception(f'Fetching tiles {failed} failed, run again to retry \
+            only the failed tiles.')
+
+    num_rows = merge_tiles(tiles_path, tiles.tile, save_file_path)
+    if not keep_tiles:
+        shutil.rmtree(tiles_path)
+    return num_rows
+
+
+def merge_tiles(tiles_path: str, tile_names: list[str], save_file_path: str):
+    '''
+    Merges tile files into save_file_path, keeping only the first occurrence
+    of every shot number.
+    '''
+    seen = np.array([], dtype=np.int64)
+    with storage.FrameWriter(save_file_path, get_shots_schema()) as writer:
+        for name in tile_names:
+            tile_path = f"{tiles_path}/{name}.parquet"
+            if not os.path.exists(tile_path):
+                continue
+            # Parquet doesn't keep categories of integers, e.g. of
+            # gridded_pft_class, so tiles are cast back to GEDI_SCHEMA.
+            shots = apply_gedi_schema(storage.load_frame(tile_path))
+            shots = shots[~np.isin(shots.shot_number.values, seen)]
+            shots = shots.drop_duplicates(subset="shot_number")
+            if len(shots) == 0:
+                continue
+            writer.write(shots)
+            seen = np.union1d(seen, shots.shot_number.values)
+
+    logger.info(f'Merged {writer.num_rows} GEDI shots from tiles.')
+    return writer.num_rows
+
+
 def initial_shot_processing(gedi_gdf: pd.DataFrame):
+    # Postgres timestamps are ISO 8601, with or without fractional seconds.
     gedi_gdf.absolute_time = pd.to_datetime(
-        gedi_gdf.absolute_time, utc=True, format='mixed')
+        gedi_gdf.absolute_time, utc=True, format='ISO8601')
 
     # Extract month and year of when GEDI shot was taken.
     gedi_gdf['gedi_year'] = gedi_gdf.absolute_time.dt.year
     gedi_gdf['gedi_month'] = gedi_gdf.absolute_time.dt.month
 
-    gedi_gdf.rename(columns={"lon_lowestmode": "longitude",
-                             "lat_lowestmode": "latitude"}, inplace=True)
+    gedi_gdf.rename(columns=RENAMED_COLUMNS, inplace=True)
+    return apply_gedi_schema(gedi_gdf)
+
+
+def apply_gedi_schema(gedi_gdf: pd.DataFrame):
+    '''
+    Casts the columns of a GEDI frame to GEDI_SCHEMA, with FILL_VALUES as
+    missing values. Raises a ValueError if a column loses more precision than
+    PRECISION_TOLERANCES allows, or has other values outside of its
+    categories.
+    '''
+    for column, dtype in GEDI_SCHEMA.items():
+        if column not in gedi_gdf.columns or gedi_gdf[column].dtype == dtype:
+            continue
+        values = gedi_gdf[column]
+        if column in FILL_VALUES:
+            values = values.mask(values.isin(FILL_VALUES[column]))
+        compact = values.astype(dtype)
+
+        if isinstance(dtype, pd.CategoricalDtype):
+            if (compact.isna() & values.notna()).any():
+                raise ValueError(
+                    f"{column} has values outside of {list(dtype.categories)}")
+        elif column in PRECISION_TOLERANCES:
+            error = np.nanmax(np.abs(
+                compact.to_numpy(np.float64) - values.to_numpy(np.float64)),
+                initial=0)
+            if error > PRECISION_TOLERANCES[column]:
+                raise ValueError(
+                    f"{column} loses {error} of precision as {dtype}.")
+        gedi_gdf[column] = compact
     return gedi_gdf
 
 
 def fetch_gedi_from_postgres(
         geometry: gpd.GeoDataFrame,
-        output_path: str):
+        output_path: str,
+        tile_size: float = TILE_SIZE,
+        workers: int = TILE_WORKERS,
+        chunksize: int = CHUNK_SIZE):
 
-    return get_combined_l2ab_l4a_shots(
+    return stream_tiled_l2ab_l4a_shots(
         geometry=geometry,
-        save_file_path=output_path
+        save_file_path=output_path,
+        tile_size=tile_size,
+        workers=workers,
+        chunksize=chunksize
     )
 
 
 # Load a dataframe with all GEDI columns, and extract only the ID and
 # geolocation columns, to minimize processing time for further processing.
 def extract_and_save_id_columns(input_path: str, output_path: str):
-    gedi_shots = load_pickle(input_path)
-    save_pickle(output_path, gedi_shots[ID_COLUMNS])
+    gedi_shots = storage.load_frame(input_path, columns=ID_COLUMNS)
+    storage.save_frame(output_path, gedi_shots)
@@ -1,9 +1,8 @@
 import pandas as pd
-from fastai.tabular.all import load_pickle, save_pickle
 from src.constants import INTERMEDIATE_RESULTS
-from src.data.pipelines.extract_gedi_data import SIERRAS_GEDI_ALL_COLUMNS
-from src.data.utils import gedi_utils
+from src.data.utils import gedi_utils, storage
 from src.data.processing import overlay, filter
+from src.data.processing.feature_store import FeatureStore
 
 PIPELINES_PATH = f"{INTERMEDIATE_RESULTS}/pipelines"
 
@@ -43,11 +42,12 @@ Steps:
 
 def run(severity_analysis):
     if severity_analysis:
-        burned = load_pickle(get_pipelines_path(
-            "severity_burned_once_lc.pkl"))
+        burned = storage.load_frame(get_pipelines_path(
+            "severity_burned_once_lc.parquet"))
     else:
-        burned = load_pickle(get_pipelines_path("burned_once_lc.pkl"))
-    unburned = load_pickle(get_pipelines_path("unburned_lc.pkl"))
+        burned = storage.load_frame(
+            get_pipelines_path("burned_once_lc.parquet"))
+    unburned = storage.load_frame(get_pipelines_path("unburned_lc.parquet"))
 
     # Add years since fire
     burned["YSF"] = burned.absolute_time.dt.year - burned.fire_ig_date.dt.year
@@ -59,25 +59,21 @@ def run(severity_analysis):
     df = gedi_utils.add_YSF_categories(df, 5)
 
     # Step 4.
-    # - load all of GEDI data.
-    gedi = gedi_utils.get_gedi_shots(SIERRAS_GEDI_ALL_COLUMNS, overlay.INDEX)
+    # - add GEDI columns, and terrain.
+    store = FeatureStore()
     GEDI_COLUMNS = ["agbd", "cover", "fhd_normal", "pai", "pai_z", "rh_25",
                     "rh_50", "rh_70", "rh_98", "elevation_difference_tdx"]
-    # cols_to_use = gedi.columns.difference(df.columns)
-    df = df.join(gedi[GEDI_COLUMNS], how="left")
-
-    # Finally, join with terrain.
-    terrain = load_pickle(overlay.TERRAIN)
-    cols_to_use = terrain.columns.difference(df.columns)
-    df = df.join(terrain[cols_to_use], how="left")
+    terrain_columns = [column for column in overlay.TERRAIN_COLUMNS
+                       if column not in df.columns]
+    df = store.add_features(df, GEDI_COLUMNS + terrain_columns)
 
     # Filter on terrain.
     df = filter.exclude_steep_slopes(df).drop(
         columns=["elevation_difference_tdx"])
 
     # And NDVI.
-    ndvi = load_pickle(overlay.NDVI_RECENT)
-    df = df.join(ndvi, how="left")
+    df = store.add_features(
+        df, store.get_source_columns(overlay.NDVI_RECENT))
 
     # Get rid of points over 35 years as we only have a few of those, and
     # points where YSF = 0, since it's unclear whether GEDI shot was taken
@@ -91,21 +87,22 @@ def run(severity_analysis):
     df_da = pd.concat([burned_da, unburned_da])
 
     if severity_analysis:
-        save_pickle(get_pipelines_path(
-            "severity_aggregated_info.pkl"), df)
-        save_pickle(get_pipelines_path(
-            "severity_aggregated_info_da.pkl"), df_da)
+        storage.save_frame(get_pipelines_path(
+            "severity_aggregated_info.parquet"), df)
+        storage.save_frame(get_pipelines_path(
+            "severity_aggregated_info_da.parquet"), df_da)
         '''
         TODO: decide whether to keep these - but leftover hold in case we want
         to deal with all unburned data, and not the land-cover filtered ones.
-        save_pickle(get_pipelines_path(
-            "severity_aggregated_info_no_lc_for_unburned.pkl"), df)
-        save_pickle(get_pipelines_path(
-            "severity_aggregated_info_da_no_lc_for_unburned.pkl"), df_da)
+        storage.save_frame(get_pipelines_path(
+            "severity_aggregated_info_no_lc_for_unburned.parquet"), df)
+        storage.save_frame(get_pipelines_path(
+            "severity_aggregated_info_da_no_lc_for_unburned.parquet"), df_da)
         '''
     else:
-        save_pickle(get_pipelines_path("aggregated_info.pkl"), df)
-        save_pickle(get_pipelines_path("aggregated_info_da.pkl"), df_da)
+        storage.save_frame(get_pipelines_path("aggregated_info.parquet"), df)
+        storage.save_frame(
+            get_pipelines_path("aggregated_info_da.parquet"), df_da)
 
     return df
 
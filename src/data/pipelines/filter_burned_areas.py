@@ -1,7 +1,7 @@
 from src.constants import INTERMEDIATE_RESULTS
 from src.utils.logging_util import get_logger
-from fastai.tabular.all import load_pickle, save_pickle
 from src.data.processing import overlay, filter
+from src.data.utils import storage
 import pandas as pd
 
 pd.options.mode.chained_assignment = None
@@ -11,7 +11,7 @@ PIPELINES_PATH = f"{INTERMEDIATE_RESULTS}/pipelines"
 
 
 def get_overlay(file_name: str):
-    return load_pickle(f"{overlay.OVERLAYS_PATH}/{file_name}")
+    return storage.load_frame(f"{overlay.OVERLAYS_PATH}/{file_name}")
 
 
 def get_output_path(file_name: str):
@@ -30,13 +30,14 @@ def save_burned_output(df: pd.DataFrame, file_name: str, prefix: str = ""):
                                       'dnbr_max', 'Low_T_adj', 'Mod_T_adj',
                                       'High_T_adj'])
 
-    save_pickle(f"{PIPELINES_PATH}/{prefix}{file_name}", df_no_severity)
+    storage.save_frame(f"{PIPELINES_PATH}/{prefix}{file_name}", df_no_severity)
 
     logger.info(f"Number of GEDI shots before severity filtering: {len(df)}")
     df_severity = filter.filter_burn_severity(df)
     logger.info(f"Number of GEDI shots afer severity filtering: \
                 {len(df_severity)}")
-    save_pickle(f"{PIPELINES_PATH}/{prefix}severity_{file_name}", df_severity)
+    storage.save_frame(f"{PIPELINES_PATH}/{prefix}severity_{file_name}",
+                       df_severity)
 
 
 def save_unburned_output(df: pd.DataFrame, file_name: str, prefix: str = ""):
@@ -52,7 +53,7 @@ def save_unburned_output(df: pd.DataFrame, file_name: str, prefix: str = ""):
                           "days_since_fire", "pre_fire_ndvi", 'dnbr_max',
                           'dnbr_min'])
 
-    save_pickle(f"{PIPELINES_PATH}/{prefix}{file_name}", df)
+    storage.save_frame(f"{PIPELINES_PATH}/{prefix}{file_name}", df)
 
 
 def run(gedi_path: str, prefix: str):
@@ -75,24 +76,24 @@ def run(gedi_path: str, prefix: str):
     logger.info(
         f"Number of GEDI shots that didn't burn: {len(unburned)}")
 
-    save_burned_output(burned_once, "burned_once.pkl", prefix)
-    save_burned_output(burned_multiple, "burned_multiple.pkl", prefix)
-    save_unburned_output(unburned, "unburned.pkl", prefix)
+    save_burned_output(burned_once, "burned_once.parquet", prefix)
+    save_burned_output(burned_multiple, "burned_multiple.parquet", prefix)
+    save_unburned_output(unburned, "unburned.parquet", prefix)
 
     burned_once_lc = filter.filter_burned_based_on_land_cover(burned_once)
     logger.info(
         f"Number of burned shots after filtering for land cover: \
             {len(burned_once_lc)}")
-    save_burned_output(burned_once_lc, "burned_once_lc.pkl", prefix)
+    save_burned_output(burned_once_lc, "burned_once_lc.parquet", prefix)
 
     unburned_lc = filter.filter_unburned_based_on_land_cover(unburned)
     logger.info(
         f"Number of unburned shots after filtering for land cover: \
             {len(unburned_lc)}")
-    save_unburned_output(unburned_lc, "unburned_lc.pkl", prefix)
+    save_unburned_output(unburned_lc, "unburned_lc.parquet", prefix)
 
 
 if __name__ == '__main__':
-    # gedi_path = "seki_mtbs_severity_overlay.pkl"
+    # gedi_path = "seki_mtbs_severity_overlay.parquet"
     gedi_path = overlay.MTBS_SEVERITY_WITH_PREFIRE_NDVI
     run(gedi_path, prefix="")
@@ -1,10 +1,9 @@
 import pandas as pd
-from fastai.tabular.all import load_pickle, save_pickle
 from src.constants import INTERMEDIATE_RESULTS
 from src.data.adapters import mtbs
-from src.data.pipelines.extract_gedi_data import SIERRAS_GEDI_ALL_COLUMNS
 from src.data.processing import filter, overlay
-from src.data.utils import gedi_utils
+from src.data.processing.feature_store import FeatureStore
+from src.data.utils import gedi_utils, storage
 from src.utils.logging_util import get_logger
 
 pd.options.mode.chained_assignment = None
@@ -21,17 +20,18 @@ COLUMNS = ['longitude', 'latitude', 'absolute_time', 'fire_size_acres',
 
 
 def filter_unburned_based_on_pre_fire_landcover():
-    unburned = load_pickle(f"{OUTPUT_PATH}/unburned.pkl")
+    unburned = storage.load_frame(f"{OUTPUT_PATH}/unburned.parquet")
 
     for year in range(1985, 2022):
         logger.info(f"Filter land cover for year: {year}.")
         unburned_lc = filter.filter_for_land_cover_in_year(year, unburned)
         logger.info(f"Number of shots remaining: {len(unburned_lc)}.")
-        save_pickle(f"{OUTPUT_PATH}/unburned_lc_{year}.pkl", unburned_lc)
+        storage.save_frame(f"{OUTPUT_PATH}/unburned_lc_{year}.parquet",
+                           unburned_lc)
 
 
 def run():
-    shots = load_pickle(overlay.MTBS_SEVERITY_WITH_PREFIRE_NDVI)
+    shots = storage.load_frame(overlay.MTBS_SEVERITY_WITH_PREFIRE_NDVI)
     logger.info(f"Number of input shots: {len(shots)}.")
 
     # Include only shots that fall within Sierra Conservancy
@@ -77,17 +77,12 @@ def run():
     logger.info(f"Total number of shots after joining: {len(df)}")
     df = gedi_utils.add_YSF_categories(df, 5)
 
-    # Join with GEDI columns.
-    gedi = gedi_utils.get_gedi_shots(SIERRAS_GEDI_ALL_COLUMNS, overlay.INDEX)
+    # Add GEDI and terrain columns.
     GEDI_COLUMNS = ["agbd", "cover", "fhd_normal", "pai", "pai_z", "rh_25",
                     "rh_50", "rh_70", "rh_98", "elevation_difference_tdx"]
-    # cols_to_use = gedi.columns.difference(df.columns)
-    df = df.join(gedi[GEDI_COLUMNS], how="left")
-
-    # Join with terrain.
-    terrain = load_pickle(overlay.TERRAIN)
-    cols_to_use = terrain.columns.difference(df.columns)
-    df = df.join(terrain[cols_to_use], how="left")
+    terrain_columns = [column for column in overlay.TERRAIN_COLUMNS
+                       if column not in df.columns]
+    df = FeatureStore().add_features(df, GEDI_COLUMNS + terrain_columns)
 
     # Filter on terrain.
     df = filter.exclude_steep_slopes(df).drop(
@@ -98,8 +93,8 @@ def run():
     burned = df[df.YSF > 0]
     unburned = df[df.YSF < 0]
 
-    save_pickle(f"{OUTPUT_PATH}/burned.pkl", burned)
-    save_pickle(f"{OUTPUT_PATH}/unburned.pkl", unburned)
+    storage.save_frame(f"{OUTPUT_PATH}/burned.parquet", burned)
+    storage.save_frame(f"{OUTPUT_PATH}/unburned.parquet", unburned)
 
     return burned, unburned
 
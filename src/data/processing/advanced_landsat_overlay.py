@@ -59,7 +59,8 @@ def overlay_advanced_landsat(
             raster.RasterSampler(file_name, bands),
             gedi_within,
             # Raster resolution is 30m, so use 2x2 matching with GEDI.
-            kernel=2
+            kernel=2,
+            stats=["mean"]
         )
 
         for column in bands:
@@ -103,7 +104,8 @@ def overlay_monthly_landsat(
             raster.RasterSampler(file_name, bands),
             gedi_within,
             # Raster resolution is 30m, so use 2x2 matching with GEDI.
-            kernel=2
+            kernel=2,
+            stats=["mean"]
         )
 
         for column in bands:
@@ -4,10 +4,10 @@
 # We exclude a 10m buffer around the fire perimeter, to decrease the impact of
 # GEDI's geolocation uncertainty.
 
+import numpy as np
 import pandas as pd
-from fastai.tabular.all import load_pickle
 from src.data.adapters import calfire_perimeters as cp
-from src.data.processing import overlay
+from src.data.processing import fire_history, overlay, perimeter_index
 from src.data.utils import gedi_utils
 from src.utils.logging_util import get_logger
 
@@ -18,39 +18,40 @@ def overlay_with_all_fires(
         df: pd.DataFrame,
         distance: int = 30):
     df = overlay.validate_input(df)
-    gdf = gedi_utils.convert_to_geo_df(df)
 
-    burn_areas = load_pickle(cp.CALFIRE_BURN_AREA_AUGMENTED(distance))
+    burn_areas = fire_history.get_fire_history(
+        cp.CALFIRE_BURN_AREA_AUGMENTED(distance))
 
-    intersection = gdf.sjoin(burn_areas,
-                             how="left",
-                             predicate="within")
-
-    burned_shots = intersection[intersection.index_right.notna()].astype({
-        'YEAR_': 'int64'})
+    point_idx, fire_idx = burn_areas.points_within(
+        df.longitude.to_numpy(), df.latitude.to_numpy())
+    fire_years = burn_areas.attributes.YEAR_.astype(
+        'int64').to_numpy()[fire_idx]
 
     # Look only at gedi shots post fire, not pre fire (relevant for the
     # most recent fires 2019-2022 that overlap with the dates GEDI was
     # sampled at).
-    delta_time = burned_shots.absolute_time.dt.year - burned_shots.YEAR_
-    burned_shots["years_since_fire"] = delta_time
-    burned_shots = burned_shots[burned_shots.years_since_fire >= 0]
-
-    recent_burned_shots = burned_shots[burned_shots.YEAR_ > 1984]
-
-    # Assign total number of all fires for each GEDI shot.
-    fire_count_col = "fire_count"
-    burned_shots[fire_count_col] = burned_shots.groupby(
-        overlay.INDEX).index_right.count()
-
-    recent_fire_count_col = "recent_fire_count"
-    burned_shots[recent_fire_count_col] = 0
-    recent_fire_count = recent_burned_shots.groupby(
-        overlay.INDEX).YEAR_.count()
-    burned_shots.loc[recent_burned_shots.index,
-                     recent_fire_count_col] = recent_fire_count
-
-    burned_shots.drop(columns=["index_right"], inplace=True)
+    years_since_fire = \
+        df.absolute_time.dt.year.to_numpy()[point_idx] - fire_years
+    post_fire = years_since_fire >= 0
+    point_idx, fire_idx = point_idx[post_fire], fire_idx[post_fire]
+    fire_years = fire_years[post_fire]
+
+    # Assign total number of all fires, and of fires after 1984, for each
+    # GEDI shot.
+    shots, fire_counts, recent_fire_counts, _ = \
+        perimeter_index.summarize_fires(
+            point_idx, fire_years, recent=fire_years > 1984)
+    shot_fires = np.searchsorted(shots, point_idx)
+
+    # Only shots within perimeters are kept, so only they get geometries.
+    burned_shots = perimeter_index.join_pairs(
+        df, burn_areas.attributes, point_idx, fire_idx, how="inner").astype({
+            'YEAR_': 'int64'})
+    burned_shots["years_since_fire"] = years_since_fire[post_fire]
+    burned_shots["fire_count"] = fire_counts[shot_fires]
+    burned_shots["recent_fire_count"] = recent_fire_counts[shot_fires]
+
+    burned_shots.drop(columns=[perimeter_index.INDEX_RIGHT], inplace=True)
 
     # Save.
-    return burned_shots
+    return gedi_utils.convert_to_geo_df(burned_shots)
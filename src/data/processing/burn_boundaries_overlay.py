@@ -7,10 +7,10 @@
 # We use CalFire perimeters that include small fires, with large historic
 # record.
 
+import numpy as np
 import pandas as pd
-from fastai.tabular.all import load_pickle
 from src.data.adapters import mtbs
-from src.data.processing import overlay
+from src.data.processing import fire_history, overlay, perimeter_index
 from src.data.utils import gedi_utils
 from src.utils.logging_util import get_logger
 
@@ -22,19 +22,24 @@ def overlay_with_boundary_buffers(
         df: pd.DataFrame,
         distance: int = 30):
     df = overlay.validate_input(df)
-    gdf = gedi_utils.convert_to_geo_df(df)
 
-    buffers = load_pickle(mtbs.MTBS_BOUNDARY_BUFFER(distance))
+    buffers = fire_history.get_fire_history(
+        mtbs.MTBS_BOUNDARY_BUFFER(distance))
 
-    intersection = gdf.sjoin(buffers,
-                             how="left",
-                             predicate="within")
+    point_idx, buffer_idx = buffers.points_within(
+        df.longitude.to_numpy(), df.latitude.to_numpy())
+    buffer_years = buffers.attributes.Ig_Year.to_numpy()[buffer_idx]
+    shots, _, _, most_recent_years = perimeter_index.summarize_fires(
+        point_idx, buffer_years)
 
-    shots_around_boundaries = intersection[intersection.index_right.notna()]
+    # Only shots within buffers are kept, so only they get geometries.
+    shots_around_boundaries = perimeter_index.join_pairs(
+        df, buffers.attributes, point_idx, buffer_idx, how="inner")
     shots_around_boundaries["most_recent_boundary"] = \
-        shots_around_boundaries.groupby(overlay.INDEX).Ig_Year.max()
+        most_recent_years[np.searchsorted(shots, point_idx)]
 
-    shots_around_boundaries.drop(columns=["index_right"], inplace=True)
+    shots_around_boundaries.drop(
+        columns=[perimeter_index.INDEX_RIGHT], inplace=True)
 
     # Save.
-    return shots_around_boundaries
+    return gedi_utils.convert_to_geo_df(shots_around_boundaries)
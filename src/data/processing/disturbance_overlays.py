@@ -16,6 +16,9 @@ importlib.reload(raster)
 logger = get_logger(__file__)
 
 RASTER_BANDS = [f"year_{year}" for year in range(1985, 2022)]
+# Fill value for pixels without disturbance information.
+FILL_VALUE = 65533
+DA_STATS = ["mean", "std", "median", "min", "max"]
 
 
 def overlay_with_disturbances(df: pd.DataFrame):
@@ -40,12 +43,15 @@ def overlay_with_disturbances(df: pd.DataFrame):
         logger.info(f"Matching {len(gedi_within)} gedi shots.")
         gdf.drop(gedi_within.index, inplace=True)
 
+        # Fill values are excluded from the stats, and shots without any
+        # disturbance information are dropped while sampling.
         matched = gedi_raster_matching.sample_raster(
-            raster.RasterSampler(file_name, RASTER_BANDS),
+            raster.RasterSampler(file_name, RASTER_BANDS,
+                                 nodata=FILL_VALUE),
             gedi_within,
             # Raster resolution is 30m, so use 2x2 matching with GEDI.
             kernel=2,
-            expanded=True
+            stats=DA_STATS
         )
         filtered = filter_disturbances(matched)
         gedi_matched.append(filtered)
@@ -56,47 +62,12 @@ def overlay_with_disturbances(df: pd.DataFrame):
 def filter_disturbances(df: pd.DataFrame):
     filtered_disturbances = []
     for year in range(1985, 2022):
-        col_mean = pd.melt(
-            df,
-            value_vars=[f'year_{year}_mean'],
-            value_name="da_mean",
-            ignore_index=False
-        ).drop(columns=['variable'])
-
-        col_std = pd.melt(
-            df,
-            value_vars=[f'year_{year}_std'],
-            value_name="da_std",
-            ignore_index=False
-        ).drop(columns=['variable'])
-
-        col_median = pd.melt(
-            df,
-            value_vars=[f'year_{year}_median'],
-            value_name="da_median",
-            ignore_index=False
-        ).drop(columns=['variable'])
-
-        col_min = pd.melt(
-            df,
-            value_vars=[f'year_{year}_min'],
-            value_name="da_min",
-            ignore_index=False
-        ).drop(columns=['variable'])
-
-        col_max = pd.melt(
-            df,
-            value_vars=[f'year_{year}_max'],
-            value_name="da_max",
-            ignore_index=False
-        ).drop(columns=['variable'])
-
-        per_year = pd.concat([col_mean, col_std, col_median,
-                              col_min, col_max], axis=1)
-
-        # Get rid of the ones with std == 0 and median == fill value
-        filtered = per_year[
-            ~((per_year.da_std == 0) & (per_year.da_median == 65533.0))]
+        per_year = df[[f'year_{year}_{stat}' for stat in DA_STATS]]
+        per_year.columns = [f'da_{stat}' for stat in DA_STATS]
+
+        # Get rid of the ones where all the pixels had the fill value. These
+        # have NaN stats, since fill values are masked while sampling.
+        filtered = per_year.dropna(subset=['da_median'])
 
         # Add column for the year.
         filtered['da_year'] = year
@@ -0,0 +1,248 @@
+# Feature store for overlay and GEDI columns. Every feature is stored as a
+# dense array aligned to one canonical sorted array of shot numbers, so that
+# gathering features for a set of shots is a single searchsorted, instead of
+# a chain of joins on the shot_number index.
+#
+# Features are named after the column they come from, e.g. "agbd" or
+# "elevation", and columns of overlays computed per year are suffixed with
+# the year, e.g. "land_cover_median@1999". Features are built from their
+# source on first use, and rebuilt when the source or the shots change. GEDI
+# features are read from the GEDI archive, see gedi_archive, or from the flat
+# file of GEDI shots if the archive isn't built.
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from src.constants import INTERMEDIATE_RESULTS, SIERRAS_GEDI_ALL_COLUMNS, \
+    SIERRAS_GEDI_ARCHIVE, SIERRAS_GEDI_ID_COLUMNS
+from src.data.gedi import gedi_archive
+from src.data.processing import overlay
+from src.data.utils import storage
+from src.utils.logging_util import get_logger
+
+logger = get_logger(__file__)
+
+FEATURE_STORE_PATH = f"{INTERMEDIATE_RESULTS}/feature_store"
+YEAR_SEPARATOR = "@"
+
+# Sources of features, in the order in which they are looked up.
+FEATURE_SOURCES = [
+    overlay.TERRAIN,
+    overlay.TCC,
+    overlay.NDVI_RECENT,
+    overlay.NDVI_TIMESERIES,
+    overlay.DISTURBANCE_AGENTS,
+    overlay.RECENT_LANDSAT,
+    overlay.DYNAMIC_WORLD,
+    SIERRAS_GEDI_ARCHIVE,
+    SIERRAS_GEDI_ALL_COLUMNS,
+]
+YEARLY_FEATURE_SOURCES = [overlay.LANDCOVER, overlay.LANDSAT]
+
+
+def _get_mtime_ns(path: str):
+    if gedi_archive.is_archive(path):
+        return gedi_archive.get_mtime_ns(path)
+    return os.stat(storage.stored_path(path)).st_mtime_ns
+
+
+def _source_exists(path: str):
+    return gedi_archive.is_archive(path) or storage.frame_exists(path)
+
+
+class FeatureStore:
+    def __init__(
+            self,
+            store_path: str = FEATURE_STORE_PATH,
+            shots_path: str = SIERRAS_GEDI_ID_COLUMNS,
+            sources: list[str] = FEATURE_SOURCES,
+            yearly_sources: list = YEARLY_FEATURE_SOURCES):
+        self.store_path = store_path
+        self.shots_path = shots_path
+        self.sources = sources
+        self.yearly_sources = yearly_sources
+        self._shot_numbers = None
+        self._source_columns = {}
+        os.makedirs(store_path, exist_ok=True)
+
+    @property
+    def shot_numbers(self):
+        ''' The canonical sorted shot numbers that features are aligned to. '''
+        if self._shot_numbers is None:
+            path = f"{self.store_path}/{overlay.INDEX}.npy"
+            metadata = self._load_metadata(overlay.INDEX)
+            if metadata.get("source_mtime_ns") != \
+                    _get_mtime_ns(self.shots_path):
+                logger.info(f"Building shot numbers from {self.shots_path}.")
+                shots = storage.load_frame(self.shots_path)
+                shot_numbers = shots.index.values \
+                    if shots.index.name == overlay.INDEX \
+                    else shots[overlay.INDEX].values
+                np.save(path, np.unique(shot_numbers.astype(np.int64)))
+                self._save_metadata(overlay.INDEX, {
+                    "source": self.shots_path,
+                    "source_mtime_ns": _get_mtime_ns(self.shots_path)})
+            self._shot_numbers = np.load(path, mmap_mode="r")
+        return self._shot_numbers
+
+    def _metadata_path(self, feature: str):
+        return f"{self.store_path}/{feature}.json"
+
+    def _load_metadata(self, feature: str):
+        path = self._metadata_path(feature)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def _save_metadata(self, feature: str, metadata: dict):
+        with open(self._metadata_path(feature), "w") as f:
+            json.dump(metadata, f, indent=2)
+
+    def get_source_columns(self, source: str):
+        if source not in self._source_columns:
+            self._source_columns[source] = \
+                gedi_archive.get_columns(source) \
+                if gedi_archive.is_archive(source) \
+                else storage.get_columns(source)
+        return self._source_columns[source]
+
+    def resolve(self, feature: str):
+        '''
+        Returns the source file and the column of a feature.
+        '''
+        if YEAR_SEPARATOR in feature:
+            column, year = feature.split(YEAR_SEPARATOR)
+            sources = [source(int(year)) for source in self.yearly_sources]
+        else:
+            column = feature
+            sources = self.sources
+
+        for source in sources:
+            if _source_exists(source) and \
+                    column in self.get_source_columns(source):
+                return source, column
+        raise ValueError(f"Feature {feature} not found in {sources}.")
+
+    def build_feature(self, feature: str):
+        source, column = self.resolve(feature)
+        logger.info(f"Building feature {feature} from {source}.")
+        # Sources are either indexed by shot number, or have it as a column.
+        if gedi_archive.is_archive(source):
+            df = gedi_archive.load_shots(
+                source, columns=[overlay.INDEX, column])
+            df = df.set_index(overlay.INDEX)
+        elif overlay.INDEX in self.get_source_columns(source):
+            df = storage.load_frame(source, columns=[overlay.INDEX, column])
+            df = df.set_index(overlay.INDEX)
+        else:
+            df = storage.load_frame(source, columns=[column])
+        if not df.index.is_unique:
+            raise ValueError(
+                f"Feature {feature} has more than one value per shot.")
+
+        values = df[column]
+        tz = None
+        categories = None
+        if isinstance(values.dtype, pd.DatetimeTZDtype):
+            tz = str(values.dt.tz)
+            values = values.dt.tz_convert("UTC").dt.tz_localize(None)
+        elif isinstance(values.dtype, pd.CategoricalDtype):
+            # Categoricals are stored as codes, -1 for missing values.
+            categories = values.cat.categories.tolist()
+            values = values.cat.codes
+        values = values.to_numpy()
+
+        positions, found = self.get_positions(df.index.values)
+        dense = np.zeros(len(self.shot_numbers), dtype=values.dtype)
+        if values.dtype == object:
+            dense[:] = None
+        elif categories is not None:
+            dense[:] = -1
+        present = np.zeros(len(self.shot_numbers), dtype=bool)
+        dense[positions[found]] = values[found]
+        present[positions[found]] = True
+
+        np.save(f"{self.store_path}/{feature}.npy", dense,
+                allow_pickle=values.dtype == object)
+        np.save(f"{self.store_path}/{feature}.present.npy", present)
+        self._save_metadata(feature, {
+            "source": source,
+            "column": column,
+            "source_mtime_ns": _get_mtime_ns(source),
+            "shots_mtime_ns": _get_mtime_ns(self.shots_path),
+            "tz": tz,
+            "categories": categories})
+
+    def load_feature(self, feature: str):
+        '''
+        Returns the dense values of a feature, a mask of the shots that have
+        a value, and the feature metadata. Stale features are rebuilt.
+        '''
+        metadata = self._load_metadata(feature)
+        shots_mtime_ns = _get_mtime_ns(self.shots_path)
+        if not metadata or metadata["shots_mtime_ns"] != shots_mtime_ns or \
+                not _source_exists(metadata["source"]) or \
+                metadata["source_mtime_ns"] != \
+                _get_mtime_ns(metadata["source"]):
+            self.build_feature(feature)
+            metadata = self._load_metadata(feature)
+
+        path = f"{self.store_path}/{feature}.npy"
+        try:
+            values = np.load(path, mmap_mode="r")
+        except ValueError:
+            # Object arrays can't be memory mapped.
+            values = np.load(path, allow_pickle=True)
+        present = np.load(f"{self.store_path}/{feature}.present.npy",
+                          mmap_mode="r")
+        return values, present, metadata
+
+    def get_positions(self, shot_numbers: np.ndarray):
+        '''
+        Returns positions of shot_numbers in the canonical shot numbers, and
+        a mask of the shots that were found.
+        '''
+        shot_numbers = np.asarray(shot_numbers, dtype=np.int64)
+        canonical = self.shot_numbers
+        positions = np.searchsorted(canonical, shot_numbers)
+        positions[positions == len(canonical)] = 0
+        found = canonical[positions] == shot_numbers
+        return positions, found
+
+    def get_features(self, shot_numbers: np.ndarray, features: list[str]):
+        '''
+        Returns a frame with the features of shot_numbers, indexed by them.
+        Shots without a value get NaN, as they would in a left join.
+        '''
+        index = pd.Index(shot_numbers, name=overlay.INDEX)
+        positions, found = self.get_positions(shot_numbers)
+        result = {}
+        for feature in features:
+            values, present, metadata = self.load_feature(feature)
+            mask = found & present[positions]
+            if metadata.get("categories") is not None:
+                codes = np.where(mask, values[positions], -1)
+                result[feature] = pd.Series(pd.Categorical.from_codes(
+                    codes, metadata["categories"]), index=index)
+                continue
+
+            column = pd.Series(values[positions], index=index)
+            if metadata["tz"] is not None:
+                column = column.dt.tz_localize("UTC").dt.tz_convert(
+                    metadata["tz"])
+            result[feature] = column if mask.all() else column.where(mask)
+
+        return pd.DataFrame(result, index=index)
+
+    def add_features(self, df: pd.DataFrame, features: list[str]):
+        '''
+        Adds features to df, which is indexed by shot number, in place of
+        df.join(feature_frame, how="left").
+        '''
+        gathered = self.get_features(df.index.values, features)
+        for feature in features:
+            df[feature] = gathered[feature].array
+        return df
@@ -1,20 +1,28 @@
+import os
+
 import geopandas as gpd
+import numpy as np
 import pandas as pd
-from fastai.tabular.all import load_pickle
-from src.constants import SIERRAS
+import shapely
+from src.constants import SIERRAS, WGS84
 from src.data.processing import overlay
+from src.data.utils import parallel, storage
 from src.utils.logging_util import get_logger
 
 logger = get_logger(__file__)
 
+LAND_COVER_COLUMNS = ["land_cover_std", "land_cover_median"]
+
 
 def exclude_shots_outside_sierra_conservancy(
     df: pd.DataFrame
 ):
-    SIERRAS_ROI = gpd.read_file(SIERRAS)[["geometry"]]
-    # Keep only shots that fall within the Sierra conservancy teritory.
-    return df.sjoin(SIERRAS_ROI, how="inner", predicate="within").drop(
-        columns="index_right")
+    SIERRAS_ROI = gpd.read_file(SIERRAS).to_crs(WGS84).unary_union
+    shapely.prepare(SIERRAS_ROI)
+    # Keep only shots that fall within the Sierra conservancy teritory,
+    # testing their coordinates against the prepared shape.
+    return df[shapely.contains_xy(
+        SIERRAS_ROI, df.longitude.to_numpy(), df.latitude.to_numpy())]
 
 
 def exclude_steep_slopes(
@@ -37,7 +45,8 @@ def filter_other_disturbances(
     DA_CLASSES = [2, 3, 5]
 
     # Join with disturbances.
-    da = load_pickle(overlay.DISTURBANCE_AGENTS)
+    da = storage.load_frame(overlay.DISTURBANCE_AGENTS,
+                            columns=["da_year", "da_min"])
     unburned_da = unburned.join(da, how="left")
     burned_da = burned.join(da, how="left")
 
@@ -58,25 +67,53 @@ def filter_other_disturbances(
     return burned_filtered, unburned_filtered
 
 
-def filter_burned_based_on_land_cover(df: pd.DataFrame):
+def _land_cover_year_for_fire(year: int):
+    return max(1985, year - 1)
+
+
+def _filter_land_cover_for_fire_year(shots: dict, year: int):
+    # Returns positions of the shots that burned in the year, and were
+    # forest in the year before the fire.
+    in_year = shots["year"] == year
+    fire_year_df = pd.DataFrame(
+        {"position": shots["position"][in_year]},
+        index=pd.Index(shots["shot_number"][in_year], name=overlay.INDEX))
+    lc_df = storage.load_frame(
+        overlay.LANDCOVER(_land_cover_year_for_fire(year)),
+        columns=LAND_COVER_COLUMNS)
+
+    return filter_for_land_cover(fire_year_df, lc_df).position.values
+
+
+def filter_burned_based_on_land_cover(
+        df: pd.DataFrame,
+        workers: int = 1,
+        memory_budget: int = None):
     start = 1985
     end = 2022
 
-    all_years = []
-    for year in range(start, end):
-        lc_year = max(1985, year - 1)
-        fire_year_df = df[df.fire_ig_date.dt.year == year]
-        lc_df = load_pickle(overlay.LANDCOVER(lc_year))
-
-        all_years.append(filter_for_land_cover(fire_year_df, lc_df))
+    # Each year loads its own land cover overlay, so years are filtered in
+    # parallel by up to `workers` processes, within memory_budget bytes.
+    positions = parallel.run_parallel(
+        _filter_land_cover_for_fire_year,
+        {
+            "shot_number": df.index.values,
+            "year": df.fire_ig_date.dt.year.values,
+            "position": np.arange(len(df)),
+        },
+        list(range(start, end)),
+        workers=workers,
+        memory_budget=memory_budget,
+        task_memory=lambda year: os.path.getsize(storage.stored_path(
+            overlay.LANDCOVER(_land_cover_year_for_fire(year)))))
 
-    return pd.concat(all_years)
+    return df.iloc[np.concatenate(positions)]
 
 
 def filter_based_on_recent_land_cover(
         df: pd.DataFrame):
-    recent_lc = load_pickle(overlay.RECENT_LAND_COVER).drop(
-        columns=["absolute_time"])
+    recent_lc = storage.load_frame(overlay.RECENT_LAND_COVER,
+                                   columns=LAND_COVER_COLUMNS)
     return filter_for_land_cover(df, recent_lc)
 
 
@@ -84,7 +121,7 @@ def filter_for_land_cover(
         df_input: pd.DataFrame,
         land_cover_df: pd.DataFrame):
     filtered = df_input.join(
-        land_cover_df[["land_cover_std", "land_cover_median"]], how="left")
+        land_cover_df[LAND_COVER_COLUMNS], how="left")
     # Filter for all pixels being "trees"
     filtered = filtered[(filtered.land_cover_std == 0)
                         & (filtered.land_cover_median == 1)]
@@ -95,7 +132,8 @@ def filter_for_land_cover(
 def filter_for_land_cover_in_year(
         year: int,
         df_input: pd.DataFrame):
-    lc_df = load_pickle(overlay.LANDCOVER(year))
+    lc_df = storage.load_frame(overlay.LANDCOVER(year),
+                               columns=LAND_COVER_COLUMNS)
     return filter_for_land_cover(df_input, lc_df)
 
 
@@ -109,7 +147,8 @@ def filter_burn_severity(df: pd.DataFrame):
 
 def exclude_fire_boundaries(df: pd.DataFrame):
     # Get rid of all the shots that fell around the boundary of any fire.
-    boundary_shots = load_pickle(overlay.MTBS_BURN_BOUNDARIES)
+    boundary_shots = storage.load_frame(overlay.MTBS_BURN_BOUNDARIES,
+                                        columns=[])
     return df[~df.index.isin(boundary_shots.index)]
 
 
@@ -117,7 +156,8 @@ def filter_burn_areas(df: pd.DataFrame):
     logger.info("Number of rows before filtering.")
 
     # Get fires from call fires.
-    all_fires = load_pickle(overlay.ALL_CALFIRE_FIRES)
+    all_fires = storage.load_frame(overlay.ALL_CALFIRE_FIRES,
+                                   columns=["Shape_Area_Acres", "YEAR_"])
 
     # Eliminate all shots that fall within small and recent fires.
     small_recent = all_fires[(all_fires.Shape_Area_Acres < 1000)
@@ -0,0 +1,296 @@
+# Rasterized fire history of a fire perimeter product, e.g.
+# MTBS_PERIMETERS_TRIMMED, MTBS_BOUNDARY_BUFFER or CALFIRE_BURN_AREA_AUGMENTED,
+# so that the burn history of a shot is a pixel lookup, instead of a spatial
+# join with the perimeters.
+#
+# Every pixel of a WGS84 grid of 1 arc-second, around 30m, holds the id of
+# the set of perimeters that cover its center. Sets are stored once, as
+# positions of their perimeters in the product, in increasing order:
+#
+#   fires[offsets[set_id]:offsets[set_id + 1]]
+#
+# so the fire count of a pixel, its most recent fire, or whether it's around
+# a fire boundary, are all read from its set. Set 0 is the empty set.
+#
+# Sets are those of pixel centers, which is only right for shots in pixels
+# that no perimeter boundary crosses. Such edge pixels hold -(set_id + 1)
+# instead, and their shots are matched with the perimeters themselves,
+# through perimeter_index, so the history matches exactly the same perimeters
+# as the vector index. Boundary buffers are only a couple of pixels wide, so
+# most of their shots are in edge pixels.
+
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import rasterio as rio
+import shapely
+from affine import Affine
+from fastai.tabular.all import load_pickle, save_pickle
+from rasterio import features
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from src import constants
+from src.data.processing import perimeter_index
+from src.data.utils import storage
+from src.data.utils.raster import RasterSampler
+from src.utils.logging_util import get_logger
+
+logger = get_logger(__file__)
+
+# 1 arc-second, around 30m.
+FIRE_HISTORY_RESOLUTION = 1 / 3600
+# Pixels rasterized at a time.
+TILE_SIZE = 2048
+BLOCK_SIZE = 512
+EMPTY_SET = 0
+# Version of the raster and sets format, histories of older versions are
+# rebuilt.
+FIRE_HISTORY_VERSION = 2
+
+_histories = {}
+_lock = threading.Lock()
+
+
+def FIRE_HISTORY_RASTER(perimeters_path: str):
+    return f"{os.path.splitext(perimeters_path)[0]}_history.tif"
+
+
+def FIRE_HISTORY_SETS(perimeters_path: str):
+    return f"{os.path.splitext(perimeters_path)[0]}_history.pkl"
+
+
+class FireSets:
+    '''
+    Sets of perimeters that cover pixels. A perimeter is added to the sets of
+    pixels it covers, in the order of perimeters, so the same set always has
+    the same id.
+    '''
+
+    def __init__(self):
+        self.sets = [()]
+        self.transitions = {}
+
+    def add(self, set_ids: np.ndarray, fire: int):
+        # Returns ids of the sets with the fire added.
+        unique_ids, inverse = np.unique(set_ids, return_inverse=True)
+        new_ids = np.empty(len(unique_ids), dtype=np.int32)
+        for i, set_id in enumerate(unique_ids):
+            key = (set_id, fire)
+            if key not in self.transitions:
+                self.transitions[key] = len(self.sets)
+                self.sets.append(self.sets[set_id] + (fire,))
+            new_ids[i] = self.transitions[key]
+        return new_ids[inverse]
+
+    def to_arrays(self):
+        lengths = np.array([len(s) for s in self.sets], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        fires = np.fromiter(
+            (fire for s in self.sets for fire in s), dtype=np.int64,
+            count=offsets[-1])
+        return offsets, fires
+
+
+def _get_grid(bounds, resolution: float):
+    minx, miny, maxx, maxy = bounds
+    minx = np.floor(minx / resolution) * resolution
+    maxy = np.ceil(maxy / resolution) * resolution
+    width = int(np.ceil((maxx - minx) / resolution))
+    height = int(np.ceil((maxy - miny) / resolution))
+    return from_origin(minx, maxy, resolution, resolution), width, height
+
+
+def _rasterize_tile(geometries, tree, transform, window, fire_sets):
+    tile_transform = rio.windows.transform(window, transform)
+    tile = np.zeros((window.height, window.width), dtype=np.int32)
+    tile_box = shapely.box(*rio.windows.bounds(window, transform))
+    candidates = np.sort(tree.query(tile_box))
+    for fire in candidates:
+        # Only rasterize the pixels of the tile within the fire bounds.
+        minx, miny, maxx, maxy = geometries[fire].bounds
+        col_start, row_start = ~tile_transform * (minx, maxy)
+        col_stop, row_stop = ~tile_transform * (maxx, miny)
+        col_start, row_start = max(int(np.floor(col_start)), 0), \
+            max(int(np.floor(row_start)), 0)
+        col_stop, row_stop = min(int(np.ceil(col_stop)), window.width), \
+            min(int(np.ceil(row_stop)), window.height)
+        if col_start >= col_stop or row_start >= row_stop:
+            continue
+
+        mask = features.geometry_mask(
+            [geometries[fire]],
+            out_shape=(row_stop - row_start, col_stop - col_start),
+            transform=tile_transform * Affine.translation(
+                col_start, row_start),
+            invert=True)
+        if not mask.any():
+            continue
+        sets = tile[row_start:row_stop, col_start:col_stop]
+        sets[mask] = fire_sets.add(sets[mask], fire)
+
+    # Pixels touched by any perimeter boundary are marked as edge pixels.
+    if len(candidates):
+        edges = features.rasterize(
+            shapely.boundary(geometries[candidates]),
+            out_shape=(window.height, window.width),
+            transform=tile_transform,
+            all_touched=True,
+            dtype=np.uint8).astype(bool)
+        tile[edges] = -tile[edges] - 1
+    return tile
+
+
+def build_fire_history(
+        perimeters_path: str,
+        resolution: float = FIRE_HISTORY_RESOLUTION):
+    '''
+    Rasterizes perimeters saved in perimeters_path, in tiles of TILE_SIZE
+    pixels, into FIRE_HISTORY_RASTER, marking edge pixels, and saves their
+    sets of fires, along with perimeter attributes, in FIRE_HISTORY_SETS.
+    '''
+    logger.info(f"Building fire history for {perimeters_path}.")
+    mtime_ns = os.stat(perimeters_path).st_mtime_ns
+    perimeters = load_pickle(perimeters_path)
+    if perimeters.crs is not None:
+        perimeters = perimeters.to_crs(constants.WGS84)
+    geometries = np.asarray(perimeters.geometry.values)
+    tree = shapely.STRtree(geometries)
+    transform, width, height = _get_grid(perimeters.total_bounds, resolution)
+
+    fire_sets = FireSets()
+    raster_path = FIRE_HISTORY_RASTER(perimeters_path)
+    profile = {
+        "driver": "GTiff",
+        "width": width,
+        "height": height,
+        "count": 1,
+        "dtype": "int32",
+        "crs": constants.WGS84,
+        "transform": transform,
+        "tiled": True,
+        "blockxsize": BLOCK_SIZE,
+        "blockysize": BLOCK_SIZE,
+        "compress": "deflate",
+        "BIGTIFF": "IF_SAFER",
+    }
+    with storage.atomic_path(raster_path) as tmp_path, \
+            rio.open(tmp_path, "w", **profile) as dst:
+        for row_off in range(0, height, TILE_SIZE):
+            for col_off in range(0, width, TILE_SIZE):
+                window = Window(col_off, row_off,
+                                min(TILE_SIZE, width - col_off),
+                                min(TILE_SIZE, height - row_off))
+                tile = _rasterize_tile(
+                    geometries, tree, transform, window, fire_sets)
+                dst.write(tile, 1, window=window)
+
+    offsets, fires = fire_sets.to_arrays()
+    logger.info(f"Fire history of {perimeters_path} has "
+                f"{len(offsets) - 1} sets of fires.")
+    with storage.atomic_path(FIRE_HISTORY_SETS(perimeters_path)) as tmp_path:
+        save_pickle(tmp_path, {
+            "version": FIRE_HISTORY_VERSION,
+            "mtime_ns": mtime_ns,
+            "offsets": offsets,
+            "fires": fires,
+            "attributes": pd.DataFrame(
+                perimeters.drop(columns=perimeters.geometry.name)),
+        })
+
+
+class FireHistory:
+    def __init__(self, perimeters_path: str):
+        sets = load_pickle(FIRE_HISTORY_SETS(perimeters_path))
+        self.perimeters_path = perimeters_path
+        self.version = sets.get("version")
+        self.mtime_ns = sets["mtime_ns"]
+        self.offsets = sets["offsets"]
+        self.fires = sets["fires"]
+        self.attributes = sets["attributes"]
+        # Only the raster blocks with shots are read.
+        self.sampler = RasterSampler(
+            FIRE_HISTORY_RASTER(perimeters_path), ["fire_set"], lazy=True)
+        with rio.open(FIRE_HISTORY_RASTER(perimeters_path)) as src:
+            self.bounds = src.bounds
+
+    def get_fire_sets(self, lon: np.ndarray, lat: np.ndarray):
+        '''
+        Returns ids of the sets of fires of the pixels at the given
+        coordinates, and whether those are edge pixels.
+        '''
+        lon, lat = np.asarray(lon), np.asarray(lat)
+        inside = (lon >= self.bounds.left) & (lon < self.bounds.right) & \
+            (lat > self.bounds.bottom) & (lat <= self.bounds.top)
+        set_ids = np.full(len(lon), EMPTY_SET, dtype=np.int64)
+        if inside.any():
+            set_ids[inside] = self.sampler.sample_values(
+                lon[inside], lat[inside])[0]
+        edges = set_ids < 0
+        set_ids[edges] = -set_ids[edges] - 1
+        return set_ids, edges
+
+    def points_within(self, lon: np.ndarray, lat: np.ndarray):
+        '''
+        Same as PerimeterIndex.points_within. Shots in edge pixels are
+        matched with the perimeters, the rest with the sets of their pixels.
+        '''
+        lon, lat = np.asarray(lon), np.asarray(lat)
+        set_ids, edges = self.get_fire_sets(lon, lat)
+        set_ids[edges] = EMPTY_SET
+        starts = self.offsets[set_ids]
+        counts = self.offsets[set_ids + 1] - starts
+        point_idx = np.repeat(np.arange(len(set_ids)), counts)
+        offsets = np.arange(len(point_idx)) - np.repeat(
+            np.cumsum(counts) - counts, counts)
+        polygon_idx = self.fires[starts[point_idx] + offsets]
+        if not edges.any():
+            return point_idx, polygon_idx
+
+        edge_points = np.flatnonzero(edges)
+        edge_idx, edge_polygons = perimeter_index.get_perimeter_index(
+            self.perimeters_path).points_within(
+                lon[edge_points], lat[edge_points])
+        point_idx = np.concatenate([point_idx, edge_points[edge_idx]])
+        polygon_idx = np.concatenate([polygon_idx, edge_polygons])
+        order = np.lexsort((polygon_idx, point_idx))
+        return point_idx[order], polygon_idx[order]
+
+    def join_within(self, df: pd.DataFrame, how: str = "left"):
+        '''
+        Same as PerimeterIndex.join_within, see points_within.
+        '''
+        point_idx, polygon_idx = self.points_within(
+            df.longitude.to_numpy(), df.latitude.to_numpy())
+        return perimeter_index.join_pairs(
+            df, self.attributes, point_idx, polygon_idx, how)
+
+
+def get_fire_history(perimeters_path: str):
+    '''
+    Returns the fire history of the perimeters saved in perimeters_path,
+    building it if it doesn't exist, can't be read, or if perimeters_path
+    changed since.
+    '''
+    perimeters_path = str(perimeters_path)
+    mtime_ns = os.stat(perimeters_path).st_mtime_ns
+    with _lock:
+        history = _histories.get(perimeters_path)
+        if history is not None and history.mtime_ns == mtime_ns:
+            return history
+
+        history = None
+        if os.path.exists(FIRE_HISTORY_SETS(perimeters_path)):
+            try:
+                history = FireHistory(perimeters_path)
+            except Exception as e:
+                logger.warning("Can't read fire history of "
+                               f"{perimeters_path}, rebuilding: {e}")
+        if history is None or history.mtime_ns != mtime_ns or \
+                history.version != FIRE_HISTORY_VERSION:
+            build_fire_history(perimeters_path)
+            history = FireHistory(perimeters_path)
+
+        _histories[perimeters_path] = history
+        return history
@@ -63,6 +63,35 @@ def get_gfcc_raster_sampler(year):
     return raster.RasterSampler(raster_path, GFCC_BANDS)
 
 
+def get_landsat_stacked_raster_sampler(years: list[int]):
+    # Band names are suffixed with the year, to keep them unique in the stack.
+    return raster.StackedRasterSampler([
+        raster.RasterSampler(
+            LANDSAT_RASTER(year),
+            [f"{band}_{year}" for band in get_landsat_bands(year)],
+            lazy=True)
+        for year in years])
+
+
+def get_ndvi_stacked_raster_sampler(years: list[int]):
+    return raster.StackedRasterSampler([
+        raster.RasterSampler(
+            LANDSAT_RASTER(year),
+            bands_map={band_idx: f"{band}_{year}"
+                       for band_idx, band in get_ndvi_band(year).items()},
+            lazy=True)
+        for year in years])
+
+
+def get_landcover_stacked_raster_sampler(years: list[int]):
+    return raster.StackedRasterSampler([
+        raster.RasterSampler(
+            LCSM_RASTER(year),
+            [f"{band}_{year}" for band in LAND_COVER_BANDS],
+            lazy=True)
+        for year in years])
+
+
 def which_landsat(year):
     if year < 1999:
         return 5
@@ -137,27 +166,41 @@ def match_landcover_for_year(
 
 def match_terrain(
     df: gpd.GeoDataFrame,
-    kernel: int
+    kernel: int,
+    stats: list[str] = None
 ) -> gpd.GeoDataFrame:
     terrain_raster = raster.RasterSampler(TERRAIN_RASTER, TERRAIN_BANDS)
 
-    return sample_raster(terrain_raster, df, kernel)
+    return sample_raster(terrain_raster, df, kernel, stats=stats)
 
 
 def sample_raster(
     raster_sampler: raster.RasterSampler,
     df: gpd.GeoDataFrame,
     kernel: int,
-    expanded: bool = False
+    expanded: bool = False,
+    stats: list[str] = None
 ):
     LAT = 'latitude'
     LON = 'longitude'
     if kernel == 1:
         return raster_sampler.sample(df, LON, LAT)
     elif kernel == 2:
-        return raster_sampler.sample_2x2(df, LON, LAT, expanded=expanded)
+        return raster_sampler.sample_2x2(df, LON, LAT, expanded=expanded,
+                                         stats=stats)
     elif kernel == 3:
-        return raster_sampler.sample_3x3(df, LON, LAT)
+        return raster_sampler.sample_3x3(df, LON, LAT, stats=stats)
+
+
+def sample_stacked_raster(
+    raster_sampler: raster.StackedRasterSampler,
+    df: gpd.GeoDataFrame,
+    kernel: int,
+    stats: list[str] = None
+):
+    LAT = 'latitude'
+    LON = 'longitude'
+    return raster_sampler.sample(df, LON, LAT, kernel, stats)
 
 
 def merge_landsat_tiles_for_year(year):
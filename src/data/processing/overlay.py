@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 from src.constants import INTERMEDIATE_RESULTS
 from src.data.gedi import gedi_loader
@@ -5,44 +6,45 @@ from src.data.gedi import gedi_loader
 INDEX = 'shot_number'
 OVERLAYS_PATH = f"{INTERMEDIATE_RESULTS}/overlays"
 
-DYNAMIC_WORLD = f"{OVERLAYS_PATH}/dynamic_world_overlay.pkl"
-RECENT_LAND_COVER = f"{OVERLAYS_PATH}/recent_land_cover.pkl"
-RECENT_LANDSAT = f"{OVERLAYS_PATH}/landsat_overlay.pkl"
-DISTURBANCE_AGENTS = f"{OVERLAYS_PATH}/disturbances_overlay.pkl"
-TCC = f"{OVERLAYS_PATH}/tree_canopy_cover_overlay.pkl"
+DYNAMIC_WORLD = f"{OVERLAYS_PATH}/dynamic_world_overlay.parquet"
+RECENT_LAND_COVER = f"{OVERLAYS_PATH}/recent_land_cover.parquet"
+RECENT_LANDSAT = f"{OVERLAYS_PATH}/landsat_overlay.parquet"
+DISTURBANCE_AGENTS = f"{OVERLAYS_PATH}/disturbances_overlay.parquet"
+TCC = f"{OVERLAYS_PATH}/tree_canopy_cover_overlay.parquet"
 
 # Overlays with fire datasets.
-MTBS_BURN_BOUNDARIES = f"{OVERLAYS_PATH}/burn_boundary_overlay.pkl"
-ALL_CALFIRE_FIRES = f"{OVERLAYS_PATH}/all_fires_overlay.pkl"
-ALL_MTBS_FIRES = f"{OVERLAYS_PATH}/mtbs_fires_overlay_all.pkl"
+MTBS_BURN_BOUNDARIES = f"{OVERLAYS_PATH}/burn_boundary_overlay.parquet"
+ALL_CALFIRE_FIRES = f"{OVERLAYS_PATH}/all_fires_overlay.parquet"
+ALL_MTBS_FIRES = f"{OVERLAYS_PATH}/mtbs_fires_overlay_all.parquet"
 # Includes only fires that occurred before GEDI shot was sampled, not after.
-MTBS_FIRES = f"{OVERLAYS_PATH}/mtbs_fires_overlay.pkl"
+MTBS_FIRES = f"{OVERLAYS_PATH}/mtbs_fires_overlay.parquet"
 
-ALL_MTBS_FIRES_SEVERITY = f"{OVERLAYS_PATH}/mtbs_severity_overlay_all.pkl"
-MTBS_FIRES_SEVERITY = f"{OVERLAYS_PATH}/mtbs_severity_overlay.pkl"
-MTBS_SEVERITY_CATEGORIES = f"{OVERLAYS_PATH}/mtbs_severity_categories_overlay.pkl"  # noqa: E501
-MTBS_SEVERITY_WITH_PREFIRE_NDVI = f"{OVERLAYS_PATH}/mtbs_severity_overlay_with_ndvi.pkl"  # noqa: E501
+ALL_MTBS_FIRES_SEVERITY = f"{OVERLAYS_PATH}/mtbs_severity_overlay_all.parquet"
+MTBS_FIRES_SEVERITY = f"{OVERLAYS_PATH}/mtbs_severity_overlay.parquet"
+MTBS_SEVERITY_CATEGORIES = f"{OVERLAYS_PATH}/mtbs_severity_categories_overlay.parquet"  # noqa: E501
+MTBS_SEVERITY_WITH_PREFIRE_NDVI = f"{OVERLAYS_PATH}/mtbs_severity_overlay_with_ndvi.parquet"  # noqa: E501
 
-TERRAIN = f"{OVERLAYS_PATH}/terrain_overlay.pkl"
+TERRAIN = f"{OVERLAYS_PATH}/terrain_overlay.parquet"
+TERRAIN_COLUMNS = ["aspect", "elevation", "slope", "soil"]
 
-NDVI_TIMESERIES = f"{OVERLAYS_PATH}/ndvi_timeseries_overlay.pkl"
-NDVI_RECENT = f"{OVERLAYS_PATH}/ndvi_overlay.pkl"
+NDVI_TIMESERIES = f"{OVERLAYS_PATH}/ndvi_timeseries_overlay.parquet"
+NDVI_RECENT = f"{OVERLAYS_PATH}/ndvi_overlay.parquet"
 
 
 def LANDCOVER(year):
-    return f"{OVERLAYS_PATH}/land_cover_overlay_{year}.pkl"
+    return f"{OVERLAYS_PATH}/land_cover_overlay_{year}.parquet"
 
 
 def LANDSAT(year):
-    return f"{OVERLAYS_PATH}/landsat_overlay_{year}.pkl"
+    return f"{OVERLAYS_PATH}/landsat_overlay_{year}.parquet"
 
 
 def ADVANCED_LANDSAT(kind):
-    return f"{OVERLAYS_PATH}/advanced_landsat_overlay_{kind}.pkl"
+    return f"{OVERLAYS_PATH}/advanced_landsat_overlay_{kind}.parquet"
 
 
 def MONTHLY_LANDSAT(year, month):
-    return f"{OVERLAYS_PATH}/LANDSAT_{year}/monthly_landsat_overlay_{month}.pkl"  # noqa: E501
+    return f"{OVERLAYS_PATH}/LANDSAT_{year}/monthly_landsat_overlay_{month}.parquet"  # noqa: E501
 
 
 def MONTHLY_LANDSAT_FOLDER(year):
@@ -67,3 +69,54 @@ def validate_input(df: pd.DataFrame):
             missing from the dataframe {df.columns}")
 
     return df
+
+
+def get_shot_arrays(df: pd.DataFrame, years: pd.Series):
+    '''
+    Returns shot coordinates and years as plain numpy arrays, to be shared
+    with per-year overlay workers. Shots are identified by their position in
+    df, rather than their shot number.
+    '''
+    return {
+        "longitude": df.longitude.values,
+        "latitude": df.latitude.values,
+        "year": years.values.astype(np.int16),
+        "position": np.arange(len(df)),
+    }
+
+
+def get_shots_frame(shots: dict, mask: np.ndarray | slice = None):
+    '''
+    Creates a frame of shot coordinates, indexed by shot position. mask is a
+    boolean mask or a slice of the shots.
+    '''
+    if mask is None:
+        mask = np.ones(shots["position"].shape, dtype=bool)
+    return pd.DataFrame({
+        "longitude": shots["longitude"][mask],
+        "latitude": shots["latitude"][mask],
+    }, index=shots["position"][mask])
+
+
+def attach_to_shots(df: pd.DataFrame, matched: list[pd.DataFrame]):
+    '''
+    Combines per-year results, indexed by shot position, with the original
+    shots. Rows are kept in the order of results, and the order of df within
+    each result.
+    '''
+    matched = pd.concat(matched).drop(columns=["longitude", "latitude"])
+    shots = df.iloc[matched.index.values]
+    matched.index = shots.index
+    return pd.concat([shots, matched], axis=1)
+
+
+def assign_by_position(df: pd.DataFrame, matched: pd.DataFrame):
+    '''
+    Assigns result columns, indexed by shot position, to df. Shots without
+    a result get NaN.
+    '''
+    for column in matched.columns:
+        values = np.full(len(df), np.nan)
+        values[matched.index.values] = matched[column].values
+        df[column] = values
+    return df
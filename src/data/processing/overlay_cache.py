@@ -0,0 +1,275 @@
+# Fingerprints of overlay outputs. Every output is recorded in a manifest with
+# a fingerprint of everything it was computed from: the input shots, the
+# datasets the overlay reads, the overlay parameters and the overlay code.
+# An output is only reused if its recorded fingerprint matches the current
+# one. Outputs whose base fingerprint, which excludes the shots, still matches
+# can be extended incrementally with new shots.
+
+import functools
+import hashlib
+import inspect
+import json
+import os
+import sys
+import threading
+
+import numpy as np
+import pandas as pd
+from src.data.processing import overlay
+from src.data.utils import storage
+from src.utils.logging_util import get_logger
+
+logger = get_logger(__file__)
+
+MANIFEST = f"{overlay.OVERLAYS_PATH}/overlay_manifest.json"
+
+# Shots and intermediate overlays are hashed in full. Other inputs, like
+# rasters, are too large for that, and are identified by their size,
+# modification time and a checksum of their first HEADER_BYTES, which hold
+# the file headers.
+CONTENT_HASHED_SUFFIXES = (".pkl", ".parquet", ".csv")
+HEADER_BYTES = 64 * 1024
+HASH_CHUNK_BYTES = 16 * 1024 * 1024
+
+# Package whose modules are hashed in code fingerprints.
+SOURCE_PACKAGE = "src"
+
+# Overlay parameters that change how an overlay is computed, but not its
+# result.
+EXECUTION_PARAMS = {"workers", "memory_budget"}
+
+_manifest_lock = threading.Lock()
+
+
+def load_manifest(manifest_path: str = MANIFEST):
+    if not os.path.exists(manifest_path):
+        return {"outputs": {}, "content_hashes": {}}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def _save_manifest(manifest: dict, manifest_path: str):
+    # Write to a temporary file first, so that an interrupted run doesn't
+    # leave a corrupt manifest behind.
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def _hash_file_content(path: str):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _hash_file_header(path: str):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read(HEADER_BYTES)).hexdigest()
+
+
+def get_file_fingerprint(path: str, manifest_path: str = MANIFEST):
+    '''
+    Returns a fingerprint of a file. Full content hashes are cached in the
+    manifest by size and modification time, so unchanged files aren't
+    re-hashed.
+    '''
+    path = storage.stored_path(str(path))
+    if not os.path.exists(path):
+        return "missing"
+
+    stat = os.stat(path)
+    if not path.endswith(CONTENT_HASHED_SUFFIXES):
+        return f"{stat.st_size}:{stat.st_mtime_ns}:{_hash_file_header(path)}"
+
+    with _manifest_lock:
+        cached = load_manifest(manifest_path)["content_hashes"].get(path)
+    if cached is not None and cached["size"] == stat.st_size and \
+            cached["mtime_ns"] == stat.st_mtime_ns:
+        return cached["sha256"]
+
+    logger.debug(f"Hashing {path}.")
+    content_hash = _hash_file_content(path)
+    with _manifest_lock:
+        manifest = load_manifest(manifest_path)
+        manifest["content_hashes"][path] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": content_hash}
+        _save_manifest(manifest, manifest_path)
+    return content_hash
+
+
+def PROCESSED_SHOTS(output_path: str):
+    return f"{os.path.splitext(output_path)[0]}_shots.npy"
+
+
+def get_shot_numbers(df: pd.DataFrame):
+    shot_numbers = df.index.values if df.index.name == overlay.INDEX \
+        else df[overlay.INDEX].values
+    return shot_numbers.astype(np.int64)
+
+
+def get_shots_fingerprint(df: pd.DataFrame):
+    '''
+    Returns a fingerprint of the shot set of df, independent of row order.
+    '''
+    return hashlib.sha256(
+        np.sort(get_shot_numbers(df)).tobytes()).hexdigest()
+
+
+def _unwrap_overlay_fn(overlay_fn):
+    args, kwargs = (), {}
+    while isinstance(overlay_fn, functools.partial):
+        args = overlay_fn.args + args
+        kwargs = {**overlay_fn.keywords, **kwargs}
+        overlay_fn = overlay_fn.func
+    return overlay_fn, args, kwargs
+
+
+def get_overlay_name(overlay_fn):
+    return _unwrap_overlay_fn(overlay_fn)[0].__name__
+
+
+def _get_source_modules(module):
+    # Modules of the package that module uses, directly or through other
+    # modules, including itself. Modules are found among the globals of
+    # module, either imported themselves, or as the module of an imported
+    # function or class.
+    modules = {}
+    pending = [module]
+    while pending:
+        module = pending.pop()
+        if module.__name__ in modules:
+            continue
+        modules[module.__name__] = module
+        for value in vars(module).values():
+            if not inspect.ismodule(value):
+                name = getattr(value, "__module__", None)
+                value = sys.modules.get(name) if isinstance(name, str) \
+                    else None
+            if value is not None and \
+                    value.__name__.split(".")[0] == SOURCE_PACKAGE:
+                pending.append(value)
+    return modules
+
+
+def get_code_fingerprint(overlay_fn):
+    '''
+    Hashes the source of the module that defines the overlay function, and of
+    all the modules of the package it uses, so that changes to the overlay or
+    its helpers, e.g. in raster or gedi_raster_matching, invalidate its
+    outputs.
+    '''
+    fn, _, _ = _unwrap_overlay_fn(overlay_fn)
+    modules = _get_source_modules(inspect.getmodule(fn))
+    sha = hashlib.sha256()
+    for name in sorted(modules):
+        try:
+            source = inspect.getsource(modules[name])
+        except (OSError, TypeError):
+            # Empty packages have no source.
+            source = ""
+        sha.update(name.encode())
+        sha.update(source.encode())
+    return sha.hexdigest()
+
+
+def get_params_fingerprint(overlay_fn, **params):
+    '''
+    Overlay parameters are the arguments bound to overlay_fn, if it's a
+    functools.partial, and any additional params, e.g. the keys of the outputs
+    of a multi overlay.
+    '''
+    fn, args, kwargs = _unwrap_overlay_fn(overlay_fn)
+    kwargs = {key: value for key, value in {**kwargs, **params}.items()
+              if key not in EXECUTION_PARAMS}
+    return json.dumps({"fn": f"{fn.__module__}.{fn.__qualname__}",
+                       "args": [repr(arg) for arg in args],
+                       "kwargs": {key: repr(value)
+                                  for key, value in sorted(kwargs.items())}})
+
+
+def get_fingerprint(
+        overlay_fn,
+        inputs: list[str],
+        df: pd.DataFrame = None,
+        manifest_path: str = MANIFEST,
+        **params):
+    '''
+    Returns the fingerprint of running overlay_fn over the shots in df, or in
+    the first of inputs if df isn't provided, reading the other inputs.
+    '''
+    parts = {
+        "code": get_code_fingerprint(overlay_fn),
+        "params": get_params_fingerprint(overlay_fn, **params),
+        "inputs": {str(path): get_file_fingerprint(path, manifest_path)
+                   for path in inputs},
+    }
+    if df is not None:
+        parts["shots"] = get_shots_fingerprint(df)
+    return hashlib.sha256(
+        json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def is_fresh(
+        output_path: str,
+        fingerprint: str,
+        manifest_path: str = MANIFEST):
+    '''
+    Returns whether output_path exists and was computed with fingerprint.
+    Outputs that are not in the manifest, or that were rewritten since they
+    were recorded, are never fresh.
+    '''
+    stored_path = storage.stored_path(str(output_path))
+    if not os.path.exists(stored_path):
+        return False
+    with _manifest_lock:
+        recorded = load_manifest(manifest_path)["outputs"].get(
+            str(output_path))
+    return recorded is not None and \
+        recorded["fingerprint"] == fingerprint and \
+        recorded["mtime_ns"] == os.stat(stored_path).st_mtime_ns
+
+
+def get_record(output_path: str, manifest_path: str = MANIFEST):
+    with _manifest_lock:
+        return load_manifest(manifest_path)["outputs"].get(str(output_path))
+
+
+def record(
+        output_path: str,
+        fingerprint: str,
+        base_fingerprint: str = None,
+        shot_numbers: np.ndarray = None,
+        manifest_path: str = MANIFEST):
+    '''
+    Records the fingerprint of output_path. base_fingerprint is the
+    fingerprint without the shots, and shot_numbers are all the shots the
+    overlay was run on, including the ones without a result. Both are needed
+    to later extend the output incrementally.
+    '''
+    if shot_numbers is not None:
+        np.save(PROCESSED_SHOTS(output_path), np.sort(shot_numbers))
+
+    with _manifest_lock:
+        manifest = load_manifest(manifest_path)
+        manifest["outputs"][str(output_path)] = {
+            "fingerprint": fingerprint,
+            "base_fingerprint": base_fingerprint,
+            "mtime_ns": os.stat(
+                storage.stored_path(str(output_path))).st_mtime_ns}
+        _save_manifest(manifest, manifest_path)
+
+
+def load_processed_shots(output_path: str):
+    '''
+    Returns the sorted shot numbers that output_path was computed for, or None
+    if they weren't recorded.
+    '''
+    path = PROCESSED_SHOTS(output_path)
+    if not os.path.exists(path):
+        return None
+    return np.load(path)
@@ -0,0 +1,221 @@
+# Runs overlays as a DAG of tasks. Each task declares the files it reads and
+# the files it writes, and the scheduler derives dependencies between tasks
+# from them. Independent tasks run concurrently, and tasks whose outputs are
+# up to date with their inputs are skipped. Tasks with a fingerprint are up to
+# date if the fingerprints recorded in the overlay cache manifest match,
+# otherwise outputs have to be newer than inputs.
+
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable
+
+from src.data.processing import overlay_cache
+from src.data.utils import storage
+from src.utils.logging_util import get_logger
+
+logger = get_logger(__file__)
+
+RUN = "run"
+SKIP = "skip"
+
+
+class OverlayTask:
+    def __init__(
+            self,
+            name: str,
+            run: Callable[[], None],
+            inputs: list[str],
+            outputs: list[str],
+            fingerprint: Callable[[str], str] = None):
+        '''
+        run is called without arguments, and is expected to write all the
+        outputs. inputs are files that the task reads, either produced by
+        other tasks or external datasets. fingerprint(output) returns the
+        current fingerprint of an output, see overlay_cache.get_fingerprint.
+        '''
+        self.name = name
+        self.run = run
+        self.inputs = [str(path) for path in inputs]
+        self.outputs = [str(path) for path in outputs]
+        self.fingerprint = fingerprint
+
+    def __repr__(self):
+        return f"OverlayTask({self.name})"
+
+
+class OverlayScheduler:
+    def __init__(self, tasks: list[OverlayTask]):
+        self.tasks = {}
+        self.producers = {}
+        for task in tasks:
+            if task.name in self.tasks:
+                raise ValueError(f"Duplicate task name {task.name}.")
+            self.tasks[task.name] = task
+            for output in task.outputs:
+                if output in self.producers:
+                    raise ValueError(
+                        f"Output {output} is produced by both "
+                        f"{self.producers[output].name} and {task.name}.")
+                self.producers[output] = task
+
+        self.dependencies = {
+            task.name: {self.producers[path].name for path in task.inputs
+                        if path in self.producers}
+            for task in tasks}
+        self.order = self._topological_order()
+
+    def _topological_order(self):
+        order = []
+        remaining = {name: set(deps)
+                     for name, deps in self.dependencies.items()}
+        while remaining:
+            ready = sorted(name for name, deps in remaining.items()
+                           if not deps)
+            if not ready:
+                raise ValueError(
+                    f"Overlay tasks have a dependency cycle: {remaining}")
+            for name in ready:
+                del remaining[name]
+                order.append(name)
+            for deps in remaining.values():
+                deps.difference_update(ready)
+        return order
+
+    def is_up_to_date(self, task: OverlayTask):
+        '''
+        A task is up to date if all its outputs exist and, for tasks with a
+        fingerprint, were recorded with their current fingerprint. Otherwise,
+        outputs have to be newer than all the inputs.
+        '''
+        outputs = [storage.stored_path(path) for path in task.outputs]
+        if not all(os.path.exists(path) for path in outputs):
+            return False
+
+        if task.fingerprint is not None:
+            return all(overlay_cache.is_fresh(path, task.fingerprint(path))
+                       for path in task.outputs)
+
+        oldest_output = min(os.path.getmtime(path) for path in outputs)
+        for path in map(storage.stored_path, task.inputs):
+            if not os.path.exists(path) or \
+                    os.path.getmtime(path) > oldest_output:
+                return False
+        return True
+
+    def plan(self, override: bool = False):
+        '''
+        Returns a dict of task name to (action, reason), in topological
+        order. A task runs if it's out of date, or if any of its dependencies
+        runs.
+        '''
+        plan = {}
+        for name in self.order:
+            task = self.tasks[name]
+            upstream = [dep for dep in self.dependencies[name]
+                        if plan[dep][0] == RUN]
+            if override:
+                plan[name] = (RUN, "override")
+            elif upstream:
+                plan[name] = (RUN, f"upstream {', '.join(sorted(upstream))}")
+            elif not self.is_up_to_date(task):
+                plan[name] = (RUN, "outputs missing or stale")
+            else:
+                plan[name] = (SKIP, "up to date")
+        return plan
+
+    def log_plan(self, plan: dict):
+        for name, (action, reason) in plan.items():
+            deps = ", ".join(sorted(self.dependencies[name])) or "-"
+            logger.info(f"[{action.upper()}] {name} ({reason}), "
+                        f"depends on: {deps}")
+
+    def run(
+            self,
+            workers: int = 1,
+            dry_run: bool = False,
+            override: bool = False):
+        '''
+        Runs all out of date tasks, up to `workers` at a time, respecting
+        dependencies. With dry_run, only logs and returns the plan.
+
+        Returns the plan, and a dict of task name to run time in seconds.
+        '''
+        plan = self.plan(override)
+        self.log_plan(plan)
+        if dry_run:
+            return plan, {}
+
+        timings = {}
+        failed = set()
+        pending = dict(self.dependencies)
+        running = {}
+
+        def run_task(task):
+            start = time.perf_counter()
+            task.run()
+            # Overlays that record their own fingerprints are left as is.
+            if task.fingerprint is not None:
+                for path in task.outputs:
+                    # Overlays may return without writing an output, which
+                    # then isn't recorded, so that it runs again next time.
+                    if not storage.frame_exists(path):
+                        logger.warning(f"Overlay task {task.name} didn't "
+                                       f"write {path}.")
+                        continue
+                    fingerprint = task.fingerprint(path)
+                    if not overlay_cache.is_fresh(path, fingerprint):
+                        overlay_cache.record(path, fingerprint)
+            return time.perf_counter() - start
+
+        def is_ready(name):
+            return all(dep in timings for dep in pending[name])
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while pending or running:
+                # Skip tasks downstream of failed tasks.
+                for name in [name for name in pending
+                             if pending[name] & failed]:
+                    logger.error(f"Not running {name}, as its dependencies "
+                                 "failed.")
+                    failed.add(name)
+                    del pending[name]
+
+                for name in [name for name in self.order
+                             if name in pending and is_ready(name)]:
+                    if plan[name][0] == SKIP:
+                        timings[name] = 0.0
+                    elif len(running) < workers:
+                        logger.info(f"Starting overlay task {name}.")
+                        future = executor.submit(run_task, self.tasks[name])
+                        running[future] = name
+                    else:
+                        continue
+                    del pending[name]
+
+                if not running:
+                    if pending and not any(is_ready(name)
+                                           for name in pending):
+                        raise Exception(
+                            f"Overlay tasks can't be scheduled: {pending}")
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        timings[name] = future.result()
+                        logger.info(f"Finished overlay task {name} in "
+                                    f"{timings[name]:.1f}s.")
+                    except Exception:
+                        logger.exception(f"Overlay task {name} failed.")
+                        failed.add(name)
+
+        for name, seconds in timings.items():
+            if plan[name][0] == RUN:
+                logger.info(f"{name}: {seconds:.1f}s")
+
+        if failed:
+            raise Exception(f"Overlay tasks failed: {sorted(failed)}")
+
+        return plan, timings
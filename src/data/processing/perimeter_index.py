@@ -0,0 +1,226 @@
+# Spatial index over fire perimeter products, e.g. MTBS_PERIMETERS_TRIMMED
+# or CALFIRE_BURN_AREA_AUGMENTED, that finds the perimeters that GEDI shots
+# fall within. Overlays read fire_history, which matches shots in pixels
+# crossed by a perimeter boundary with this index.
+#
+# Perimeters are indexed with a shapely STRtree over prepared geometries, and
+# queried with plain coordinate arrays, without creating a geometry for each
+# shot. Indexes are kept in memory for the whole process, and persisted
+# next to the perimeters file, in the CRS of the shots. GEOS trees can't be
+# serialized, so the persisted index holds the prepared input of the tree,
+# and the tree itself is rebuilt on load, which takes milliseconds.
+
+import os
+import threading
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from fastai.tabular.all import load_pickle, save_pickle
+from src import constants
+from src.data.utils import storage
+from src.utils.logging_util import get_logger
+
+logger = get_logger(__file__)
+
+INDEX_RIGHT = "index_right"
+# Size of the cells, in degrees, that points are grouped by before they're
+# matched with perimeters. Around 1km, much smaller than most fires.
+CELL_SIZE = 0.01
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def INDEX_PATH(perimeters_path: str):
+    return f"{os.path.splitext(perimeters_path)[0]}_index.pkl"
+
+
+class PerimeterIndex:
+    def __init__(self, perimeters: gpd.GeoDataFrame):
+        '''
+        perimeters are in the CRS of the shots, WGS84. Their attributes are
+        kept to be joined with the shots.
+        '''
+        self.attributes = pd.DataFrame(
+            perimeters.drop(columns=perimeters.geometry.name))
+        self.geometries = np.asarray(perimeters.geometry.values)
+        shapely.prepare(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+
+    def __getstate__(self):
+        return {"attributes": self.attributes, "geometries": self.geometries}
+
+    def __setstate__(self, state):
+        self.attributes = state["attributes"]
+        self.geometries = state["geometries"]
+        shapely.prepare(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+
+    def points_within(self, lon: np.ndarray, lat: np.ndarray):
+        '''
+        Returns positions of the points that fall within a perimeter, and
+        positions of those perimeters, one pair for each point and perimeter
+        it's within, sorted by point. Points are only given as coordinates,
+        and no geometries are created for them.
+        '''
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        if len(lon) == 0:
+            return np.array([], dtype=np.intp), np.array([], dtype=np.intp)
+
+        # Points are grouped by the cells of a grid, and the tree is queried
+        # with the cells that have points.
+        cell_x = np.floor(lon / CELL_SIZE).astype(np.int64)
+        cell_y = np.floor(lat / CELL_SIZE).astype(np.int64)
+        cell_x -= cell_x.min()
+        cell_y -= cell_y.min()
+        cells, point_cell = np.unique(
+            cell_x * (cell_y.max() + 1) + cell_y, return_inverse=True)
+        points_by_cell = np.argsort(point_cell, kind="stable")
+        cell_counts = np.bincount(point_cell, minlength=len(cells))
+        cell_starts = np.cumsum(cell_counts) - cell_counts
+
+        first_points = points_by_cell[cell_starts]
+        min_x = np.floor(lon[first_points] / CELL_SIZE) * CELL_SIZE
+        min_y = np.floor(lat[first_points] / CELL_SIZE) * CELL_SIZE
+        boxes = shapely.box(min_x, min_y, min_x + CELL_SIZE,
+                            min_y + CELL_SIZE)
+        cell_idx, polygon_idx = self.tree.query(boxes)
+        # All points of cells in the interior of a perimeter are within it.
+        covered = shapely.contains_properly(
+            self.geometries[polygon_idx], boxes[cell_idx])
+
+        # One candidate for each point of a cell and perimeter pair.
+        counts = cell_counts[cell_idx]
+        pair = np.repeat(np.arange(len(cell_idx)), counts)
+        offsets = np.arange(len(pair)) - np.repeat(
+            np.cumsum(counts) - counts, counts)
+        point_idx = points_by_cell[cell_starts[cell_idx][pair] + offsets]
+        polygon_idx = polygon_idx[pair]
+
+        inside = covered[pair]
+        tested = ~inside
+        inside[tested] = shapely.contains_xy(
+            self.geometries[polygon_idx[tested]],
+            lon[point_idx[tested]], lat[point_idx[tested]])
+
+        point_idx, polygon_idx = point_idx[inside], polygon_idx[inside]
+        order = np.lexsort((polygon_idx, point_idx))
+        return point_idx[order], polygon_idx[order]
+
+    def join_within(self, df: pd.DataFrame, how: str = "left"):
+        '''
+        Joins shots in df with attributes of the perimeters they fall within,
+        see join_pairs.
+        '''
+        point_idx, polygon_idx = self.points_within(
+            df.longitude.to_numpy(), df.latitude.to_numpy())
+        return join_pairs(df, self.attributes, point_idx, polygon_idx, how)
+
+
+def join_pairs(
+        df: pd.DataFrame,
+        attributes: pd.DataFrame,
+        point_idx: np.ndarray,
+        polygon_idx: np.ndarray,
+        how: str = "left"):
+    '''
+    Joins shots in df with attributes of the perimeters they fall within,
+    given as pairs of positions sorted by shot, the same way as
+    gdf.sjoin(perimeters, how, predicate="within"), with index labels of
+    perimeters in index_right. No perimeter geometry is added.
+    '''
+    left = df.iloc[point_idx]
+    right = attributes.iloc[polygon_idx]
+    overlap = left.columns.intersection(right.columns)
+    left = left.rename(columns={c: f"{c}_left" for c in overlap})
+    right = right.rename(columns={c: f"{c}_right" for c in overlap})
+    right.index = left.index
+    right.insert(0, INDEX_RIGHT, attributes.index[polygon_idx])
+    joined = pd.concat([left, right], axis=1)
+    if how == "left":
+        # Shots outside of all perimeters keep their place, as in sjoin.
+        is_outside = np.ones(len(df), dtype=bool)
+        is_outside[point_idx] = False
+        outside = np.flatnonzero(is_outside)
+        unmatched = df.iloc[outside].rename(
+            columns={c: f"{c}_left" for c in overlap})
+        positions = np.concatenate([point_idx, outside])
+        joined = pd.concat([joined, unmatched])
+        joined = joined.iloc[np.argsort(positions, kind="stable")]
+
+    if isinstance(df, gpd.GeoDataFrame):
+        return gpd.GeoDataFrame(joined, geometry=df.geometry.name, crs=df.crs)
+    return joined
+
+
+def summarize_fires(
+        point_idx: np.ndarray,
+        dates: np.ndarray,
+        recent: np.ndarray = None):
+    '''
+    Summarizes the fires of shots, given as pairs of shot positions and fire
+    dates, e.g. ignition dates or years, in any order. Returns the shots with
+    fires, and for each of them the number of fires, the number of recent
+    fires, i.e. with recent set, and the date of its most recent fire.
+    '''
+    point_idx = np.asarray(point_idx)
+    dates = np.asarray(dates)
+    if recent is None:
+        recent = np.zeros(len(point_idx), dtype=bool)
+    if len(point_idx) == 0:
+        return point_idx, np.array([], dtype=np.int64), \
+            np.array([], dtype=np.int64), dates
+
+    # Fires of each shot are sorted by date, so the last one is the most
+    # recent.
+    order = np.lexsort((dates, point_idx))
+    points = point_idx[order]
+    starts = np.flatnonzero(np.r_[True, points[1:] != points[:-1]])
+    ends = np.r_[starts[1:], len(points)]
+    recent_counts = np.add.reduceat(
+        np.asarray(recent)[order].astype(np.int64), starts)
+    return points[starts], ends - starts, recent_counts, \
+        dates[order][ends - 1]
+
+
+def _build_index(perimeters_path: str):
+    logger.info(f"Building perimeter index for {perimeters_path}.")
+    perimeters = load_pickle(perimeters_path)
+    if perimeters.crs is not None:
+        perimeters = perimeters.to_crs(constants.WGS84)
+    return PerimeterIndex(perimeters)
+
+
+def get_perimeter_index(perimeters_path: str):
+    '''
+    Returns the index of the perimeters saved in perimeters_path, loading it
+    from memory or from its persisted copy, unless perimeters_path changed
+    since, or the persisted copy can't be read, in which case it's rebuilt.
+    '''
+    perimeters_path = str(perimeters_path)
+    mtime_ns = os.stat(perimeters_path).st_mtime_ns
+    with _lock:
+        cached = _indexes.get(perimeters_path)
+        if cached is not None and cached[0] == mtime_ns:
+            return cached[1]
+
+        index_path = INDEX_PATH(perimeters_path)
+        persisted = None
+        if os.path.exists(index_path):
+            try:
+                persisted = load_pickle(index_path)
+            except Exception as e:
+                logger.warning("Can't read perimeter index of "
+                               f"{perimeters_path}, rebuilding: {e}")
+        if persisted is not None and persisted["mtime_ns"] == mtime_ns:
+            index = persisted["index"]
+        else:
+            index = _build_index(perimeters_path)
+            with storage.atomic_path(index_path) as tmp_path:
+                save_pickle(tmp_path, {"mtime_ns": mtime_ns, "index": index})
+
+        _indexes[perimeters_path] = (mtime_ns, index)
+        return index
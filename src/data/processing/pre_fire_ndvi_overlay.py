@@ -20,7 +20,8 @@ def overlay_pre_fire_NDVI(df: pd.DataFrame):
         filtered = df[df.fire_ig_date.dt.year == year]
 
         raster = gedi_raster_matching.get_ndvi_raster_sampler(ndvi_year)
-        matched = gedi_raster_matching.sample_raster(raster, filtered, 2) \
+        matched = gedi_raster_matching.sample_raster(
+            raster, filtered, 2, stats=["median"]) \
             .rename(columns={"ndvi_median": "pre_fire_ndvi"})
 
         df.loc[matched.index, "pre_fire_ndvi"] = matched.pre_fire_ndvi
@@ -1,5 +1,7 @@
+import numpy as np
 import pandas as pd
 from src.data.processing import gedi_raster_matching, overlay
+from src.data.utils import parallel, raster
 from src.utils.logging_util import get_logger
 
 logger = get_logger(__file__)
@@ -7,16 +9,27 @@ logger = get_logger(__file__)
 
 # We will use LCMS dataset, because it's the easiest one to use through EE.
 def overlay_land_cover(df: pd.DataFrame, year: int):
+    return overlay_land_cover_for_years(df, [year])[year]
+
+
+def overlay_land_cover_for_years(df: pd.DataFrame, years: list[int]):
     df = overlay.validate_input(df)
-    logger.info(f"Overlaying land cover for year {year}.")
-    # LCSM is at 30m resolution, so we match raster on a 2x2 kernel.
-    result = gedi_raster_matching.match_landcover(year, df, 2)
-    result["lc_year"] = year
-    result = overlay.drop(columns=["longitude", "latitude",
-                                   "absolute_time", "land_cover_mean"]
-                          ).astype({"land_cover_median": "int"})
+    logger.info(f"Overlaying land cover for years {years}.")
+    # LCSM is at 30m resolution, so we match raster on a 2x2 kernel. All the
+    # years are sampled in a single pass.
+    sampler = gedi_raster_matching.get_landcover_stacked_raster_sampler(years)
+    matched = gedi_raster_matching.sample_stacked_raster(
+        sampler, df, 2, stats=["std", "median"])
 
-    return result
+    results = {}
+    for year in years:
+        result = matched[[f"land_cover_{year}_std",
+                          f"land_cover_{year}_median"]].dropna()
+        result.columns = ["land_cover_std", "land_cover_median"]
+        result["lc_year"] = year
+        results[year] = result.astype({"land_cover_median": "int"})
+
+    return results
 
 
 def overlay_terrain(df: pd.DataFrame):
@@ -25,13 +38,9 @@ def overlay_terrain(df: pd.DataFrame):
     # Terrain dataset is 30m resolution, so we're matching each gedi shot with
     # a 2x2 terrain grid cells around the shot's coordinates.
     logger.info("Starting raster matching.")
-    result = gedi_raster_matching.match_terrain(df, kernel=2)
-
-    # Keep median columns only and rename them.
-    result.drop(columns=["aspect_mean", "aspect_std", "elevation_mean",
-                         "elevation_std", "slope_mean", "slope_std",
-                         "soil_mean", "soil_std"],
-                inplace=True)
+    # Compute median columns only and rename them.
+    result = gedi_raster_matching.match_terrain(df, kernel=2,
+                                                stats=["median"])
 
     result.rename(columns={
         "aspect_median": "aspect",
@@ -43,90 +52,147 @@ def overlay_terrain(df: pd.DataFrame):
     return result
 
 
-def overlay_landsat(df: pd.DataFrame):
-    df = overlay.validate_input(df)
-    gedi_df_combined_years = []
-    for year in range(2019, 2023):
-        if year == 2022:
-            gedi_for_year = df[df.absolute_time.dt.year >= year]
-        else:
-            gedi_for_year = df[df.absolute_time.dt.year == year]
-
-        logger.debug(f'Match Landsat for year {year}')
-        raster = gedi_raster_matching.get_landsat_raster_sampler(year)
-        gedi_for_year = gedi_raster_matching.sample_raster(raster,
-                                                           gedi_for_year,
-                                                           kernel=2)
-
-        gedi_df_combined_years.append(gedi_for_year)
-
-    result = pd.concat(gedi_df_combined_years)
-    return result
+def _match_landsat_for_year(shots: dict, year: int):
+    if year == 2022:
+        in_year = shots["year"] >= year
+    else:
+        in_year = shots["year"] == year
 
+    logger.debug(f'Match Landsat for year {year}')
+    raster_sampler = gedi_raster_matching.get_landsat_raster_sampler(year)
+    return gedi_raster_matching.sample_raster(
+        raster_sampler, overlay.get_shots_frame(shots, in_year), kernel=2)
 
-def overlay_landsat_for_year(df: pd.DataFrame, year: int):
+
+def overlay_landsat(
+        df: pd.DataFrame,
+        workers: int = 1,
+        memory_budget: int = None):
     df = overlay.validate_input(df)
-    LANDSAT_COLUMNS = gedi_raster_matching.get_landsat_bands(year)
+    # Years are matched in parallel by up to `workers` processes, each loading
+    # one Landsat raster, within memory_budget bytes.
+    matched = parallel.run_parallel(
+        _match_landsat_for_year,
+        overlay.get_shot_arrays(df, df.absolute_time.dt.year),
+        list(range(2019, 2023)),
+        workers=workers,
+        memory_budget=memory_budget,
+        task_memory=lambda year: raster.get_raster_memory(
+            gedi_raster_matching.LANDSAT_RASTER(year)))
+
+    return overlay.attach_to_shots(df, matched)
 
-    logger.debug(f'Match Landsat for year {year}')
-    raster = gedi_raster_matching.get_landsat_raster_sampler(year)
-    matched = gedi_raster_matching.sample_raster(raster,
-                                                 df,
-                                                 kernel=2)
-    for column in LANDSAT_COLUMNS:
-        df[f"{column}_{year}"] = matched[f"{column}_mean"]
 
-    return df
+def overlay_landsat_for_year(df: pd.DataFrame, year: int):
+    return overlay_landsat_for_years(df, [year])[year]
 
 
-def overlay_ndvi(df: pd.DataFrame):
+def overlay_landsat_for_years(df: pd.DataFrame, years: list[int]):
     df = overlay.validate_input(df)
-    for year in range(1984, 2023):
-        logger.debug(f'Match NDVI for year {year}')
 
-        COL_NAME = f"ndvi_{year}"
-        raster = gedi_raster_matching.get_ndvi_raster_sampler(year)
-        matched = gedi_raster_matching.sample_raster(raster, df, 2) \
-            .rename(columns={"ndvi_mean": COL_NAME})
+    logger.debug(f'Match Landsat for years {years}')
+    raster_sampler = gedi_raster_matching.get_landsat_stacked_raster_sampler(
+        years)
+    matched = gedi_raster_matching.sample_stacked_raster(raster_sampler,
+                                                         df,
+                                                         kernel=2,
+                                                         stats=["mean"])
+
+    results = {}
+    for year in years:
+        LANDSAT_COLUMNS = gedi_raster_matching.get_landsat_bands(year)
+        result = df.copy()
+        for column in LANDSAT_COLUMNS:
+            result[f"{column}_{year}"] = matched[f"{column}_{year}_mean"]
+        results[year] = result
+
+    return results
+
+
+def _match_ndvi_for_years(shots: dict, years: tuple[int]):
+    logger.debug(f'Match NDVI for years {years}')
+    raster_sampler = gedi_raster_matching.get_ndvi_stacked_raster_sampler(
+        years)
+    matched = gedi_raster_matching.sample_stacked_raster(
+        raster_sampler, overlay.get_shots_frame(shots), 2, stats=["mean"])
+    return matched.rename(columns={f"ndvi_{year}_mean": f"ndvi_{year}"
+                                   for year in years})
+
+
+def overlay_ndvi(
+        df: pd.DataFrame,
+        workers: int = 1,
+        memory_budget: int = None):
+    df = overlay.validate_input(df)
+    years = list(range(1984, 2023))
 
-        df[COL_NAME] = matched[COL_NAME]
+    # Years sampled by one worker are sampled in a single pass, sharing pixel
+    # indices. Rasters are read lazily, so the memory needed per worker is
+    # small.
+    year_groups = [tuple(group.tolist()) for group in
+                   np.array_split(years, min(workers, len(years)))]
+    matched = parallel.run_parallel(
+        _match_ndvi_for_years,
+        overlay.get_shot_arrays(df, df.absolute_time.dt.year),
+        year_groups,
+        workers=workers,
+        memory_budget=memory_budget)
 
-    return df
+    return overlay.assign_by_position(df, pd.concat(matched, axis=1))
 
 
-def overlay_dynamic_world(df: pd.DataFrame):
-    df = overlay.validate_input(df)
+def _match_dynamic_world_for_year(shots: dict, year: int):
+    logger.debug(f'Match with Dynamic World for year {year - 1}')
+    raster_sampler = gedi_raster_matching.get_dw_raster_sampler(year - 1)
 
-    gedi_df_combined_years = []
-    for year in range(2019, 2024):
-        gedi_for_year = df[df.absolute_time.dt.year == year]
+    # We match with a 3x3 kernel because DW resolution is 10m.
+    return gedi_raster_matching.sample_raster(
+        raster_sampler, overlay.get_shots_frame(shots, shots["year"] == year),
+        3)
 
-        logger.debug(f'Match with Dynamic World for year {year - 1}')
-        raster = gedi_raster_matching.get_dw_raster_sampler(year - 1)
 
-        # We match with a 3x3 kernel because DW resolution is 10m.
-        gedi_for_year = gedi_raster_matching.sample_raster(raster,
-                                                           gedi_for_year,
-                                                           3)
+def overlay_dynamic_world(
+        df: pd.DataFrame,
+        workers: int = 1,
+        memory_budget: int = None):
+    df = overlay.validate_input(df)
 
-        gedi_df_combined_years.append(gedi_for_year)
+    matched = parallel.run_parallel(
+        _match_dynamic_world_for_year,
+        overlay.get_shot_arrays(df, df.absolute_time.dt.year),
+        list(range(2019, 2024)),
+        workers=workers,
+        memory_budget=memory_budget,
+        task_memory=lambda year: raster.get_raster_memory(
+            gedi_raster_matching.DYNAMIC_WORLD_RASTER(year - 1)))
 
-    result = pd.concat(gedi_df_combined_years)
-    return result
+    return overlay.attach_to_shots(df, matched)
 
 
-def overlay_tree_cover(df: pd.DataFrame):
-    df = overlay.validate_input(df)
+def _match_tree_cover_for_year(shots: dict, year: int):
+    logger.debug(f'Match with Global Tree Canopy Cover for year {year}')
+    raster_sampler = gedi_raster_matching.get_gfcc_raster_sampler(year)
 
-    for year in [2000, 2005, 2010, 2015]:
-        logger.debug(f'Match with Global Tree Canopy Cover for year {year}')
-        raster = gedi_raster_matching.get_gfcc_raster_sampler(year)
+    # We match with a 2x2 kernel because GFCC resolution is 30m.
+    matched = gedi_raster_matching.sample_raster(
+        raster_sampler, overlay.get_shots_frame(shots), 2, stats=["mean"])
+    return matched[["tree_canopy_cover_mean"]].rename(
+        columns={"tree_canopy_cover_mean": f"tcc_{year}"})
 
-        COL_NAME = f"tcc_{year}"
-        # We match with a 2x2 kernel because GFCC resolution is 30m.
-        matched = gedi_raster_matching.sample_raster(raster, df, 2) \
-            .rename(columns={"tree_canopy_cover_mean": COL_NAME})
 
-        df[COL_NAME] = matched[COL_NAME]
+def overlay_tree_cover(
+        df: pd.DataFrame,
+        workers: int = 1,
+        memory_budget: int = None):
+    df = overlay.validate_input(df)
+
+    matched = parallel.run_parallel(
+        _match_tree_cover_for_year,
+        overlay.get_shot_arrays(df, df.absolute_time.dt.year),
+        [2000, 2005, 2010, 2015],
+        workers=workers,
+        memory_budget=memory_budget,
+        task_memory=lambda year: raster.get_raster_memory(
+            gedi_raster_matching.TREE_COVER_RASTER(year)))
 
-    return df
+    return overlay.assign_by_position(df, pd.concat(matched, axis=1))
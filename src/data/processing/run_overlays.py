@@ -1,58 +1,184 @@
+import argparse
 import os
+from functools import partial
+from pathlib import Path
 
+import numpy as np
 import pandas as pd
-from fastai.tabular.all import load_pickle, save_pickle
-from src.data.pipelines.extract_gedi_data import SIERRAS_GEDI_ID_COLUMNS
+from src.constants import SIERRAS_GEDI_ID_COLUMNS
+from src.data.adapters import calfire_perimeters as cp
+from src.data.adapters import mtbs
 from src.data.processing import all_fires_overlay as fa
 from src.data.processing import burn_boundaries_overlay as bb
 from src.data.processing import disturbance_overlays as da
 from src.data.processing import advanced_landsat_overlay as alo
+from src.data.processing import gedi_raster_matching as grm
 from src.data.processing import overlay
+from src.data.processing import overlay_cache
 from src.data.processing import pre_fire_ndvi_overlay as pfno
 from src.data.processing import raster_overlays
 from src.data.processing import severity_overlay as se
+from src.data.processing.overlay_scheduler import OverlayScheduler, \
+    OverlayTask
+from src.data.utils import storage
 from src.utils.logging_util import get_logger
 
 logger = get_logger(__file__)
 
+LAND_COVER_OUTPUTS = {year: overlay.LANDCOVER(year)
+                      for year in range(1985, 2022)}
+LANDSAT_OUTPUTS = {year: overlay.LANDSAT(year) for year in range(1984, 2023)}
+ADVANCED_LANDSAT_KINDS = ["mean", "min", "max", "stddev", "qt_25", "qt_50",
+                          "qt_75"]
+MONTHLY_LANDSAT_YEAR = 1985
+RECENT_LAND_COVER_INPUTS = [overlay.DYNAMIC_WORLD] + \
+    [overlay.LANDCOVER(year) for year in range(2018, 2022)]
+
 
 def run_overlay(
         overlay_fn,
         output_path,
         df=None,
-        override=False):
-    logger.info(f"Running overlay: {overlay_fn.__name__}")
-    if not override:
-        if os.path.exists(output_path):
-            logger.info(f"Overlay already exists: {output_path} \n")
-            return  # file already exists, and we shouldn't override.
+        override=False,
+        inputs=None,
+        df_path=SIERRAS_GEDI_ID_COLUMNS,
+        incremental=False):
+    '''
+    Runs overlay_fn over the shots in df, or in df_path if df isn't provided,
+    and saves the result in output_path. inputs are the other files that the
+    overlay reads. The overlay is skipped if output_path was computed from the
+    same shots, inputs, parameters and code, see overlay_cache.
+
+    With incremental, if only the shots changed, overlay_fn is run on the new
+    shots only, and the result is appended to the existing output.
+    '''
+    name = overlay_cache.get_overlay_name(overlay_fn)
+    logger.info(f"Running overlay: {name}")
+    inputs = inputs or []
+    if df is None:
+        fingerprint = overlay_cache.get_fingerprint(
+            overlay_fn, [df_path] + inputs)
+    else:
+        fingerprint = overlay_cache.get_fingerprint(overlay_fn, inputs, df)
+
+    if not override and overlay_cache.is_fresh(output_path, fingerprint):
+        logger.info(f"Overlay is up to date: {output_path} \n")
+        return
 
     if df is None:
-        df = load_pickle(SIERRAS_GEDI_ID_COLUMNS)
+        df = storage.load_frame(df_path)
+
+    base_fingerprint = overlay_cache.get_fingerprint(overlay_fn, inputs)
+    shot_numbers = overlay_cache.get_shot_numbers(df)
+    if incremental:
+        result = run_incremental_overlay(
+            overlay_fn, output_path, df, base_fingerprint)
+    else:
+        result = overlay_fn(df)
 
-    result = overlay_fn(df)
     if result is None:
         logger.info("No overlay obtained.")
         return
 
-    save_pickle(output_path, result)
+    storage.save_frame(output_path, result)
+    overlay_cache.record(output_path, fingerprint, base_fingerprint,
+                         shot_numbers)
     logger.info("Done! \n")
     return result
 
 
+def run_incremental_overlay(overlay_fn, output_path, df, base_fingerprint):
+    '''
+    Runs overlay_fn on the shots in df that the existing output wasn't
+    computed for, and appends the result to it. Shots that are no longer in
+    df are dropped. If the overlay inputs, parameters or code changed, or the
+    processed shots weren't recorded, all shots are overlaid again.
+    '''
+    recorded = overlay_cache.get_record(output_path)
+    processed = overlay_cache.load_processed_shots(output_path)
+    if not os.path.exists(storage.stored_path(output_path)) or \
+            recorded is None or \
+            recorded.get("base_fingerprint") != base_fingerprint or \
+            processed is None:
+        logger.info("Overlay can't be extended, overlaying all shots.")
+        return overlay_fn(df)
+
+    shot_numbers = overlay_cache.get_shot_numbers(df)
+    is_new = ~np.isin(shot_numbers, processed, assume_unique=True)
+    existing = storage.load_frame(output_path)
+    existing = existing[existing.index.isin(shot_numbers)]
+    logger.info(f"Overlaying {is_new.sum()} new shots, keeping "
+                f"{len(existing)} existing results.")
+    if not is_new.any():
+        return existing
+
+    delta = overlay_fn(df[is_new].copy())
+    if delta is None or len(delta) == 0:
+        return existing
+    return pd.concat([existing, delta])
+
+
+def run_multi_overlay(
+        overlay_fn,
+        output_paths: dict,
+        df=None,
+        override=False,
+        batch_size=None,
+        inputs=None):
+    '''
+    Runs an overlay that produces several outputs in a single pass, e.g. one
+    per year. overlay_fn is called with the shots and the keys of the outputs
+    that are out of date, and returns a dict of results with the same keys.
+    Keys are processed in batches of batch_size, to bound memory.
+    '''
+    name = overlay_cache.get_overlay_name(overlay_fn)
+    logger.info(f"Running overlay: {name}")
+    fingerprints = {key: get_multi_overlay_fingerprint(
+                        overlay_fn, key, inputs, df)
+                    for key in output_paths}
+    keys = list(output_paths.keys())
+    if not override:
+        keys = [key for key in keys if not overlay_cache.is_fresh(
+            output_paths[key], fingerprints[key])]
+        if len(keys) == 0:
+            logger.info("All overlays are up to date. \n")
+            return
+
+    if df is None:
+        df = storage.load_frame(SIERRAS_GEDI_ID_COLUMNS)
+
+    batch_size = batch_size or len(keys)
+    for i in range(0, len(keys), batch_size):
+        results = overlay_fn(df, keys[i:i + batch_size])
+        for key, result in results.items():
+            storage.save_frame(output_paths[key], result)
+            overlay_cache.record(output_paths[key], fingerprints[key])
+    logger.info("Done! \n")
+
+
+def get_multi_overlay_fingerprint(overlay_fn, key, inputs=None, df=None):
+    if df is None:
+        return overlay_cache.get_fingerprint(
+            overlay_fn, [SIERRAS_GEDI_ID_COLUMNS] + (inputs or []), key=key)
+    return overlay_cache.get_fingerprint(
+        overlay_fn, inputs or [], df, key=key)
+
+
 def overlay_recent_land_cover():
     # Combine LC with dynamic world data, to provide two different sources for
     # land cover.
 
     # Load shots already combined with dynamic world.
-    gedi_shots = load_pickle(overlay.DYNAMIC_WORLD)
+    gedi_shots = storage.load_frame(overlay.DYNAMIC_WORLD)
 
     gedi_df_combined_years = []
     for year in range(2019, 2024):
         logger.info(f"Consolidate land cover for year {year}.")
         gedi_for_year = gedi_shots[gedi_shots.absolute_time.dt.year == year]
 
-        lc_df = load_pickle(overlay.LANDCOVER(min(2021, year - 1)))
+        lc_df = storage.load_frame(
+            overlay.LANDCOVER(min(2021, year - 1)),
+            columns=["land_cover_std", "land_cover_median"])
 
         joined_lc = gedi_for_year.join(
             lc_df[["land_cover_std", "land_cover_median"]], how="left")
@@ -60,90 +186,265 @@ def overlay_recent_land_cover():
         gedi_df_combined_years.append(joined_lc)
 
     result = pd.concat(gedi_df_combined_years)
-    save_pickle(overlay.RECENT_LAND_COVER, result)
+    storage.save_frame(overlay.RECENT_LAND_COVER, result)
 
 
 def overlay_land_cover():
-
-    START = 1985
-    END = 2022
-
-    for year in range(START, END):
-        run_overlay(
-            lambda x: raster_overlays.overlay_land_cover(x, year),
-            overlay.LANDCOVER(year))
+    run_multi_overlay(
+        raster_overlays.overlay_land_cover_for_years,
+        LAND_COVER_OUTPUTS,
+        batch_size=10,
+        inputs=[grm.LCSM_RASTER(year) for year in LAND_COVER_OUTPUTS])
 
 
 def overlay_all_landsat_years():
-    for year in range(1984, 2023):
-        run_overlay(
-            lambda x: raster_overlays.overlay_landsat_for_year(x, year),
-            overlay.LANDSAT(year))
-
-
-def run_all_overlays():
-    # Burn Datasets Overlays
-    run_overlay(bb.overlay_with_boundary_buffers, overlay.MTBS_BURN_BOUNDARIES)
-    run_overlay(fa.overlay_with_all_fires, overlay.ALL_CALFIRE_FIRES)
-
-    run_overlay(lambda x:
-                se.overlay_with_mtbs_fires(x,
-                                           distance=100,
-                                           post_fire_only=False),
-                overlay.ALL_MTBS_FIRES)
-
-    run_overlay(lambda x: se.overlay_with_mtbs_fires(x, distance=100),
-                overlay.MTBS_FIRES)
-
-    run_overlay(lambda x: se.overlay_with_mtbs_dnbr(
-        x, distance=100, post_fire=False), overlay.ALL_MTBS_FIRES_SEVERITY)
-
-    mtbs_overlay = run_overlay(lambda x: se.overlay_with_mtbs_dnbr(
-        x, distance=100, post_fire=True), overlay.MTBS_FIRES_SEVERITY)
-
-    run_overlay(pfno.overlay_pre_fire_NDVI,
-                overlay.MTBS_SEVERITY_WITH_PREFIRE_NDVI, df=mtbs_overlay)
-
-    run_overlay(se.overlay_with_mtbs_severity_categories,
-                overlay.MTBS_SEVERITY_CATEGORIES)
+    run_multi_overlay(
+        raster_overlays.overlay_landsat_for_years,
+        LANDSAT_OUTPUTS,
+        batch_size=4,
+        inputs=[grm.LANDSAT_RASTER(year) for year in LANDSAT_OUTPUTS])
 
-    # Other Datasets Raster Overlays
 
-    # Terrain Overlay
-    run_overlay(raster_overlays.overlay_terrain, overlay.TERRAIN)
-
-    # Landsat Overlay
-    run_overlay(raster_overlays.overlay_landsat, overlay.RECENT_LANDSAT)
-
-    # NDVI Overlay
-    run_overlay(raster_overlays.overlay_ndvi, overlay.NDVI_TIMESERIES)
-
-    # Dynamic World Overlay
-    run_overlay(raster_overlays.overlay_dynamic_world, overlay.DYNAMIC_WORLD)
-
-    # Land Cover
-    overlay_land_cover()
-
-    # Disturbances Overlay
-    run_overlay(da.overlay_with_disturbances, overlay.DISTURBANCE_AGENTS)
+def overlay_task(
+        overlay_fn,
+        output_path: str,
+        inputs: list[str] = None,
+        df_path: str = SIERRAS_GEDI_ID_COLUMNS,
+        incremental: bool = False):
+    '''
+    Creates a task that runs overlay_fn over the shots stored in df_path, and
+    saves the result in output_path. Parameters of the overlay should be bound
+    with functools.partial, so that they are part of its fingerprint.
+    '''
+    inputs = inputs or []
+
+    def run():
+        run_overlay(overlay_fn, output_path, override=True, inputs=inputs,
+                    df_path=df_path, incremental=incremental)
+
+    def fingerprint(output):
+        return overlay_cache.get_fingerprint(overlay_fn, [df_path] + inputs)
+
+    return OverlayTask(Path(output_path).stem, run, [df_path] + inputs,
+                       [output_path], fingerprint)
+
+
+def multi_overlay_task(
+        name: str,
+        overlay_fn,
+        output_paths: dict,
+        inputs: list[str] = None,
+        batch_size: int = None):
+    def run():
+        run_multi_overlay(overlay_fn, output_paths, override=True,
+                          batch_size=batch_size, inputs=inputs)
+
+    keys = {str(path): key for key, path in output_paths.items()}
+
+    def fingerprint(output):
+        return get_multi_overlay_fingerprint(overlay_fn, keys[output], inputs)
+
+    return OverlayTask(name, run, [SIERRAS_GEDI_ID_COLUMNS] + (inputs or []),
+                       list(output_paths.values()), fingerprint)
+
+
+def get_overlay_tasks(
+        year_workers: int = 1,
+        memory_budget: int = None,
+        incremental: bool = False):
+    '''
+    Declares all overlays as tasks, with the files they read and write.
+    year_workers and memory_budget configure the per-year, or per-fire,
+    process pool of the overlays that support it. With incremental, single
+    output overlays are only run on new shots, see run_incremental_overlay.
+    '''
+    task = partial(overlay_task, incremental=incremental)
+    tasks = [
+        # Burn Datasets Overlays
+        task(bb.overlay_with_boundary_buffers,
+             overlay.MTBS_BURN_BOUNDARIES,
+             [mtbs.MTBS_BOUNDARY_BUFFER(30)]),
+        task(fa.overlay_with_all_fires,
+             overlay.ALL_CALFIRE_FIRES,
+             [cp.CALFIRE_BURN_AREA_AUGMENTED(30)]),
+        task(partial(se.overlay_with_mtbs_fires, distance=100,
+                     post_fire_only=False),
+             overlay.ALL_MTBS_FIRES,
+             [mtbs.MTBS_PERIMETERS_TRIMMED(100)]),
+        task(partial(se.overlay_with_mtbs_fires, distance=100),
+             overlay.MTBS_FIRES,
+             [mtbs.MTBS_PERIMETERS_TRIMMED(100)]),
+        task(partial(se.overlay_with_mtbs_dnbr, distance=100,
+                     post_fire=False,
+                     workers=year_workers,
+                     memory_budget=memory_budget),
+             overlay.ALL_MTBS_FIRES_SEVERITY,
+             [mtbs.MTBS_PERIMETERS_TRIMMED(100), mtbs.MTBS_DNBR_CATALOG]),
+        task(partial(se.overlay_with_mtbs_dnbr, distance=100,
+                     post_fire=True,
+                     workers=year_workers,
+                     memory_budget=memory_budget),
+             overlay.MTBS_FIRES_SEVERITY,
+             [mtbs.MTBS_PERIMETERS_TRIMMED(100), mtbs.MTBS_DNBR_CATALOG]),
+        # Pre-fire NDVI is only matched for the shots that burned.
+        task(pfno.overlay_pre_fire_NDVI,
+             overlay.MTBS_SEVERITY_WITH_PREFIRE_NDVI,
+             df_path=overlay.MTBS_FIRES_SEVERITY),
+        task(se.overlay_with_mtbs_severity_categories,
+             overlay.MTBS_SEVERITY_CATEGORIES,
+             [grm.BURN_DATA_RASTER]),
+
+        # Other Datasets Raster Overlays
+        task(raster_overlays.overlay_terrain, overlay.TERRAIN,
+             [grm.TERRAIN_RASTER]),
+        task(partial(raster_overlays.overlay_landsat,
+                     workers=year_workers,
+                     memory_budget=memory_budget),
+             overlay.RECENT_LANDSAT,
+             [grm.LANDSAT_RASTER(year) for year in range(2019, 2023)]),
+        task(partial(raster_overlays.overlay_ndvi,
+                     workers=year_workers,
+                     memory_budget=memory_budget),
+             overlay.NDVI_TIMESERIES,
+             [grm.LANDSAT_RASTER(year) for year in range(1984, 2023)]),
+        task(partial(raster_overlays.overlay_dynamic_world,
+                     workers=year_workers,
+                     memory_budget=memory_budget),
+             overlay.DYNAMIC_WORLD,
+             [grm.DYNAMIC_WORLD_RASTER(year)
+              for year in range(2018, 2023)]),
+        multi_overlay_task("land_cover_overlay",
+                           raster_overlays.overlay_land_cover_for_years,
+                           LAND_COVER_OUTPUTS,
+                           [grm.LCSM_RASTER(year)
+                            for year in LAND_COVER_OUTPUTS],
+                           batch_size=10),
+        OverlayTask(Path(overlay.RECENT_LAND_COVER).stem,
+                    overlay_recent_land_cover,
+                    RECENT_LAND_COVER_INPUTS,
+                    [overlay.RECENT_LAND_COVER],
+                    lambda output: overlay_cache.get_fingerprint(
+                        overlay_recent_land_cover, RECENT_LAND_COVER_INPUTS)),
+        task(da.overlay_with_disturbances,
+             overlay.DISTURBANCE_AGENTS),
+        task(partial(raster_overlays.overlay_tree_cover,
+                     workers=year_workers,
+                     memory_budget=memory_budget),
+             overlay.TCC,
+             [grm.TREE_COVER_RASTER(year)
+              for year in [2000, 2005, 2010, 2015]]),
+        multi_overlay_task("landsat_overlay_years",
+                           raster_overlays.overlay_landsat_for_years,
+                           LANDSAT_OUTPUTS,
+                           [grm.LANDSAT_RASTER(year)
+                            for year in LANDSAT_OUTPUTS],
+                           batch_size=4),
+    ]
 
     # Adv Landsat
-    for kind in ["mean", "min", "max", "stddev", "qt_25", "qt_50", "qt_75"]:
-        run_overlay(lambda x: alo.overlay_advanced_landsat(x, 2019, kind),
-                    overlay.ADVANCED_LANDSAT(kind))
+    for kind in ADVANCED_LANDSAT_KINDS:
+        tasks.append(task(
+            partial(alo.overlay_advanced_landsat, year=2019, kind=kind),
+            overlay.ADVANCED_LANDSAT(kind)))
 
     # Monthly Landsat
-    year = 1985
     for month in range(1, 13):
-        run_overlay(lambda x: alo.overlay_monthly_landsat(x, year, month),
-                    overlay.MONTHLY_LANDSAT(year, month))
-
-    # GFCC Overlay - tree canopy cover.
-    run_overlay(raster_overlays.overlay_tree_cover, overlay.TCC)
-
-    overlay_all_landsat_years()
+        tasks.append(task(
+            partial(alo.overlay_monthly_landsat, year=MONTHLY_LANDSAT_YEAR,
+                    month=month),
+            overlay.MONTHLY_LANDSAT(MONTHLY_LANDSAT_YEAR, month)))
+
+    return tasks
+
+
+def run_all_overlays(
+        workers: int = 1,
+        year_workers: int = 1,
+        memory_budget: int = None,
+        dry_run: bool = False,
+        override: bool = False,
+        incremental: bool = False):
+    '''
+    Runs all overlays that are out of date, up to `workers` overlays at a
+    time. With dry_run, only logs the plan. With incremental, overlays whose
+    shots changed are only run on the new shots, unless override is set.
+
+    year_workers and memory_budget are shared by all the overlays that run
+    concurrently, so each of them gets a 1 / workers share of both.
+    '''
+    # The catalog of dNBR rasters is an input of the severity overlays, so
+    # it's brought up to date first, for fires added since the last run to
+    # make them stale.
+    if not dry_run and os.path.isdir(mtbs.MTBS_INDIVIDUAL_FIRES):
+        mtbs.build_dnbr_catalog()
+
+    year_workers = max(1, year_workers // workers)
+    if memory_budget is not None:
+        memory_budget //= workers
+
+    scheduler = OverlayScheduler(get_overlay_tasks(
+        year_workers, memory_budget, incremental and not override))
+    return scheduler.run(workers=workers, dry_run=dry_run, override=override)
 
 
 if __name__ == '__main__':
-    # TODO: add params to main
-    run_all_overlays()
+    parser = argparse.ArgumentParser(
+        description="Script to run all the overlays that are out of date.")
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Number of overlays to run concurrently.",
+        type=int,
+        default=1
+    )
+
+    parser.add_argument(
+        "-y",
+        "--year_workers",
+        help="Total number of processes for per-year and per-fire raster "
+        "overlays, split evenly between the overlays that run concurrently.",
+        type=int,
+        default=1
+    )
+
+    parser.add_argument(
+        "-m",
+        "--memory_budget",
+        help="Total memory budget in GB for per-year and per-fire raster "
+        "overlays, split evenly between the overlays that run concurrently.",
+        type=float,
+        default=None
+    )
+
+    parser.add_argument(
+        "-d",
+        "--dry_run",
+        help="Only print the plan of overlays to run.",
+        action="store_true"
+    )
+
+    parser.add_argument(
+        "-o",
+        "--override",
+        help="Rerun all overlays, even if they are up to date.",
+        action="store_true"
+    )
+
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        help="Only overlay new shots, for overlays whose shots changed.",
+        action="store_true"
+    )
+
+    args = parser.parse_args()
+    run_all_overlays(
+        workers=args.workers,
+        year_workers=args.year_workers,
+        memory_budget=None if args.memory_budget is None
+        else int(args.memory_budget * 1e9),
+        dry_run=args.dry_run,
+        override=args.override,
+        incremental=args.incremental
+    )
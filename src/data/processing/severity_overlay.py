@@ -1,17 +1,17 @@
-import os
-import re
-
+import numpy as np
 import pandas as pd
-from fastai.tabular.all import load_pickle
 from src.data.adapters import mtbs
-from src.data.processing import gedi_raster_matching, overlay
-from src.data.utils import gedi_utils, raster
+from src.data.processing import fire_history, gedi_raster_matching, overlay, \
+    perimeter_index
+from src.data.utils import gedi_utils, parallel, raster
 from src.utils.logging_util import get_logger
 
 logger = get_logger(__file__)
 
 
 GEDI_IDS_TO_REMOVE = [22791100300215022]
+DNBR_STATS = ["mean", "std", "median", "min", "max"]
+DNBR_COLUMNS = [f"dnbr_{stat}" for stat in DNBR_STATS]
 
 
 def cleanup_gedi_shots(gedi_shots):
@@ -25,96 +25,129 @@ def overlay_with_mtbs_fires(
         df: pd.DataFrame,
         distance: int,
         post_fire_only: bool = True):
-    df = overlay.validate_input(df)
-    gdf = cleanup_gedi_shots(gedi_utils.convert_to_geo_df(df))
-
-    mtbs_fires = load_pickle(mtbs.MTBS_PERIMETERS_TRIMMED(distance))
+    df = cleanup_gedi_shots(overlay.validate_input(df))
 
-    intersection = gdf.sjoin(mtbs_fires,
-                             how="left",
-                             predicate="within")
+    mtbs_fires = fire_history.get_fire_history(
+        mtbs.MTBS_PERIMETERS_TRIMMED(distance))
 
-    burned_shots = intersection[intersection.index_right.notna()]
-    unburned_shots = intersection[intersection.index_right.isna()]
+    point_idx, fire_idx = mtbs_fires.points_within(
+        df.longitude.to_numpy(), df.latitude.to_numpy())
+    is_burned = np.zeros(len(df), dtype=bool)
+    is_burned[point_idx] = True
+    unburned_shots = df[~is_burned]
 
+    fire_ig_dates = pd.to_datetime(
+        mtbs_fires.attributes.fire_ig_date,
+        utc=True,
+        format='mixed').values[fire_idx]
     if post_fire_only:
         # Look only at gedi shots post fire, not pre fire (relevant for the
         # most recent fires 2019-2022 that overlap with the dates GEDI was
         # sampled at).
-        delta_time = burned_shots.absolute_time - pd.to_datetime(
-            burned_shots.fire_ig_date,
-            utc=True,
-            format='mixed')
-        burned_shots["days_since_fire"] = delta_time.dt.days
-        burned_shots = burned_shots[burned_shots.days_since_fire >= 0]
+        days_since_fire = (df.absolute_time.values[point_idx]
+                           - fire_ig_dates) // np.timedelta64(1, "D")
+        post_fire = days_since_fire >= 0
+        point_idx, fire_idx = point_idx[post_fire], fire_idx[post_fire]
+        fire_ig_dates = fire_ig_dates[post_fire]
+        days_since_fire = days_since_fire[post_fire]
 
     # Assign total number of all fires for each GEDI shot.
-    fire_count_col = "fire_count"
-    unburned_shots[fire_count_col] = 0
-    burned_shots[fire_count_col] = burned_shots.groupby(
-        overlay.INDEX).index_right.count()
+    shots, fire_counts, _, most_recent_dates = \
+        perimeter_index.summarize_fires(point_idx, fire_ig_dates)
+    shot_fires = np.searchsorted(shots, point_idx)
 
     # For each burned shot, only keep the most recent fire details.
-    most_recent_fire_idx = burned_shots.groupby(
-        overlay.INDEX
-    ).fire_ig_date.transform(max) == burned_shots.fire_ig_date
-    most_recent_fires = burned_shots[most_recent_fire_idx]
+    most_recent = fire_ig_dates == most_recent_dates[shot_fires]
+    most_recent_fires = perimeter_index.join_pairs(
+        df, mtbs_fires.attributes, point_idx[most_recent],
+        fire_idx[most_recent], how="inner")
+    if post_fire_only:
+        most_recent_fires["days_since_fire"] = days_since_fire[most_recent]
 
-    result = pd.concat([unburned_shots, most_recent_fires])
-    result.drop(columns=["index_right"], inplace=True)
+    fire_count_col = "fire_count"
+    unburned_shots[fire_count_col] = 0
+    most_recent_fires[fire_count_col] = fire_counts[shot_fires[most_recent]]
 
-    return result
+    result = pd.concat([unburned_shots, most_recent_fires])
+    result.drop(columns=[perimeter_index.INDEX_RIGHT], inplace=True)
+
+    return gedi_utils.convert_to_geo_df(result)
+
+
+def _sample_dnbr_for_fire(shots: dict, fire: tuple):
+    start, stop, dnbr_path = fire
+    # Kernels with any nodata pixel are invalid, which
+    # filter.filter_burn_severity relies on.
+    dnbr_raster = raster.RasterSampler(
+        dnbr_path, ["dnbr"], drop_partial_nodata=True)
+    matched = gedi_raster_matching.sample_raster(
+        dnbr_raster, overlay.get_shots_frame(shots, slice(start, stop)), 2,
+        stats=DNBR_STATS)
+    # Only positions and statistics of the matched shots are sent back, as
+    # copies, since a slice of the shots is a view into shared memory.
+    return matched.index.to_numpy(copy=True), matched[DNBR_COLUMNS].to_numpy()
+
+
+def sample_dnbr(
+        shots: pd.DataFrame,
+        catalog: pd.DataFrame,
+        workers: int = 1,
+        memory_budget: int = None):
+    '''
+    Samples dNBR of the fire of each shot, with a 2x2 kernel, reading rasters
+    of the fires from the catalog, see mtbs.build_dnbr_catalog. Returns a
+    block of DNBR_COLUMNS, in the order of shots, with NaN for shots without
+    a dNBR raster or valid kernel.
+
+    Fires are sampled in parallel by up to `workers` processes, each loading
+    the raster of one fire, within memory_budget bytes.
+    '''
+    # Shots are sorted by fire, so that each fire samples a contiguous range
+    # of shots.
+    codes, fire_ids = pd.factorize(shots.fire_id)
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(len(fire_ids) + 1))
+    fires = []
+    for code, fire_id in enumerate(fire_ids):
+        if fire_id not in catalog.index:
+            logger.warning(f"Cannot find dnbr raster for fire {fire_id}.")
+            continue
+        fires.append((bounds[code], bounds[code + 1],
+                      catalog.loc[fire_id, "dnbr_path"]))
+
+    matched = parallel.run_parallel(
+        _sample_dnbr_for_fire,
+        {
+            "longitude": shots.longitude.values[order],
+            "latitude": shots.latitude.values[order],
+            "position": order,
+        },
+        fires,
+        workers=workers,
+        memory_budget=memory_budget,
+        task_memory=lambda fire: raster.get_raster_memory(fire[2]))
+
+    block = np.full((len(shots), len(DNBR_COLUMNS)), np.nan)
+    if matched:
+        positions, values = zip(*matched)
+        block[np.concatenate(positions)] = np.concatenate(values)
+    return block
 
 
 def overlay_with_mtbs_dnbr(
         df: pd.DataFrame,
         distance: int,
-        post_fire: bool = True):
+        post_fire: bool = True,
+        workers: int = 1,
+        memory_budget: int = None):
     fire_occurrence_df = overlay_with_mtbs_fires(df, distance, post_fire)
-    burned = fire_occurrence_df[fire_occurrence_df.fire_count > 0]
-
-    for fire_id in burned.fire_id.unique():
-        print(fire_id)
-        gedi_within = burned[burned.fire_id == fire_id]
-        fire_year = gedi_within.sample().fire_ig_date.dt.year.iloc[0]
-        # return gedi_within
-        dir_path = \
-            f"{mtbs.MTBS_INDIVIDUAL_FIRES}/{int(fire_year)}/{fire_id.lower()}"
-
-        if (os.path.exists(dir_path)):
-            # MTBS for this fire exists.
-            mtbs_files = os.listdir(dir_path)
-            r = re.compile(f"^{fire_id.lower()}.*_dnbr\.tif")  # noqa: W605
-            matches = list(filter(r.match, mtbs_files))
-
-            if len(matches) == 1:
-                print('file found')
-                dnbr_file = matches[0]
-                file_path = f"{dir_path}/{dnbr_file}"
-
-                raster.reproject_raster(file_path, file_path)
-                dnbr_raster = raster.RasterSampler(file_path, ["dnbr"])
-                matched = gedi_raster_matching.sample_raster(
-                    dnbr_raster, gedi_within, 2, expanded=True)
-                print('rasters matched!')
-                print(matched.columns)
-
-                fire_occurrence_df.loc[matched.index,
-                                       "dnbr_mean"] = matched.dnbr_mean
-                fire_occurrence_df.loc[matched.index,
-                                       "dnbr_std"] = matched.dnbr_std
-                fire_occurrence_df.loc[matched.index,
-                                       "dnbr_median"] = matched.dnbr_median
-                fire_occurrence_df.loc[matched.index,
-                                       "dnbr_min"] = matched.dnbr_min
-                fire_occurrence_df.loc[matched.index,
-                                       "dnbr_max"] = matched.dnbr_max
-            else:
-                logger.warn(
-                    f"Found zero or more than one dnbr \
-                        file matching the query in the directory {dir_path}.")
-        else:
-            logger.warn(f"Cannot find directory for path {dir_path}.")
+    burned = (fire_occurrence_df.fire_count > 0).to_numpy()
+
+    dnbr = np.full((len(fire_occurrence_df), len(DNBR_COLUMNS)), np.nan)
+    dnbr[burned] = sample_dnbr(
+        fire_occurrence_df[burned], mtbs.get_dnbr_catalog(),
+        workers=workers, memory_budget=memory_budget)
+    fire_occurrence_df[DNBR_COLUMNS] = dnbr
 
     return fire_occurrence_df
 
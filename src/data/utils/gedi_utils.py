@@ -1,13 +1,48 @@
 import geopandas as gpd
 import numpy as np
 import pandas as pd
-from fastai.tabular.all import load_pickle
 from src import constants
+from src.data.gedi import gedi_archive, gedi_loader
+from src.data.utils import storage
 
 
-def get_gedi_shots(input_path: str, index: str) -> gpd.GeoDataFrame:
-    gedi = load_pickle(input_path)
-    gdf = convert_to_geo_df(gedi)
+def get_gedi_shots(
+        input_path: str,
+        index: str,
+        columns: list[str] = None,
+        geometry: gpd.GeoSeries = None,
+        start_time: str = None,
+        end_time: str = None) -> gpd.GeoDataFrame:
+    # Only the requested columns are read, along with the index and the
+    # coordinates.
+    if columns is not None:
+        columns = [index, "longitude", "latitude"] + \
+            [column for column in columns
+             if column not in [index, "longitude", "latitude"]]
+
+    # GEDI archives only read the partitions within geometry and the time
+    # range, other inputs are filtered on time while loading, and on geometry
+    # once loaded.
+    if geometry is not None:
+        geometry = geometry.to_crs(constants.WGS84)
+    if gedi_archive.is_archive(input_path):
+        gedi = gedi_archive.load_shots(
+            input_path, columns=columns, geometry=geometry,
+            start_time=start_time, end_time=end_time)
+    else:
+        filters = []
+        if start_time is not None:
+            filters += [("absolute_time", ">=",
+                         pd.Timestamp(start_time, tz="UTC"))]
+        if end_time is not None:
+            filters += [("absolute_time", "<",
+                         pd.Timestamp(end_time, tz="UTC"))]
+        gedi = storage.load_frame(
+            input_path, columns=columns, filters=filters or None)
+    # Categoricals of other types than strings are read as their values.
+    gdf = convert_to_geo_df(gedi_loader.apply_gedi_schema(gedi))
+    if geometry is not None and not gedi_archive.is_archive(input_path):
+        gdf = gdf[gdf.intersects(geometry.unary_union)]
     gdf.set_index(index, inplace=True)
     return gdf
 
@@ -1,87 +1,129 @@
 import pandas as pd
 import numpy as np
 
-
-def transform_pai_z(df: pd.DataFrame):
-    '''
-    Transforms the original pai_z array into a more useful set of columns:
-    pai_z_np - numpy array representing cumulative vertical pai starting from
-    the lowest heights, pai_z_padded - same as pai_z_np but padded with zeros
-    so that all the arrays are of the same length of 30, pai_z_delta_np -
-    delta PAI for each height bucket.
-
-    NOTE: This function can run for a long time (~12 mins) for ~10 million
-    footprints.
-    '''
-    df = transform_pai_z_array_to_np(df)
-    df = pad_all_pai_z_to_constant_length(df)
-    df = calculate_pai_z_delta(df)
-    return df
+# GEDI vertical profiles have up to 30 bins of 5m.
+PAI_Z_BINS = 30
+PAI_Z_BIN_HEIGHT = 5
 
 
-def transform_pai_z_array_to_np(df: pd.DataFrame):
+def profile_columns(name: str):
     '''
-    For some reason, pai_z is a string, so convert to a numpy array,
-    flip it around (so that the lowest heights come first in the array),
-    and trim zeros.
+    Columns that hold the bins of a vertical profile in a data frame. They're
+    added as a single float32 block, see _set_profile_columns, so that
+    df[profile_columns(name)].to_numpy() reads the (n_shots, PAI_Z_BINS)
+    matrix of the profiles from one block.
     '''
-    df['pai_z_np'] = df.apply(lambda row: np.flip(np.trim_zeros(
-        np.array(row.pai_z))), axis=1)
-    return df
-
+    return [f'{name}_{i}' for i in range(PAI_Z_BINS)]
 
-def pad_all_pai_z_to_constant_length(df: pd.DataFrame):
-    def pad_numpy_array(df):
-        pai_array = df.pai_z_np
-        return np.pad(pai_array, (0, 30-pai_array.size), 'constant')
 
-    df['pai_z_padded'] = df.apply(pad_numpy_array, axis=1)
-    return df
+PAI_Z_PADDED = profile_columns('pai_z_padded')
+PAI_Z_DELTA = profile_columns('pai_z_delta')
+PAI_Z_PERCENT_PADDED = profile_columns('pai_z_percent_padded')
 
 
-def pad_array(df: pd.DataFrame, column: str, constant_values=(0, 0)):
-    def pad_numpy_array(df):
-        pai_array = df[column]
-        return np.pad(pai_array, (0, 30-pai_array.size), 'constant',
-                      constant_values=constant_values)
+def pack_profiles(profiles: pd.Series):
+    '''
+    Packs a column of ragged profile arrays, e.g. pai_z, into a float32
+    matrix of (n_shots, PAI_Z_BINS), padded with zeros. Returns the matrix
+    and the length of every profile. Missing profiles are empty.
+    '''
+    values = profiles.to_numpy()
+    lengths = np.fromiter(
+        (0 if profile is None else len(profile) for profile in values),
+        dtype=np.int64, count=len(values))
+    if (lengths > PAI_Z_BINS).any():
+        raise ValueError(f'Profiles have more than {PAI_Z_BINS} bins.')
+
+    matrix = np.zeros((len(values), PAI_Z_BINS), dtype=np.float32)
+    if lengths.sum() == 0:
+        return matrix, lengths
+    flat = np.concatenate([profile for profile in values
+                           if profile is not None and len(profile) > 0])
+    rows = np.repeat(np.arange(len(values)), lengths)
+    starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    matrix[rows, np.arange(flat.size) - starts] = flat
+    return matrix, lengths
+
+
+def trim_and_flip(matrix: np.ndarray):
+    '''
+    Trims leading and trailing zeros of every profile, and flips it around,
+    so that the lowest heights come first, padding it with zeros at the end.
+    Returns the transformed matrix and the trimmed length of every profile.
+    '''
+    nonzero = matrix != 0
+    has_values = nonzero.any(axis=1)
+    first = np.argmax(nonzero, axis=1)
+    last = PAI_Z_BINS - 1 - np.argmax(nonzero[:, ::-1], axis=1)
+    lengths = np.where(has_values, last - first + 1, 0)
 
-    df[f'{column}_padded'] = df.apply(pad_numpy_array, axis=1)
-    return df
+    bins = np.arange(PAI_Z_BINS)
+    source = np.clip(last[:, None] - bins, 0, PAI_Z_BINS - 1)
+    flipped = np.take_along_axis(matrix, source, axis=1)
+    return np.where(bins < lengths[:, None], flipped, 0).astype(
+        matrix.dtype), lengths
 
 
-def calculate_pai_z_delta(df: pd.DataFrame):
-    def calc_delta(df):
-        pai_array = df.pai_z_padded
-        pai_rolled = np.roll(pai_array, 1)
-        pai_delta = pai_array - pai_rolled
-        pai_delta[pai_delta < 0] = 0
-        return pai_delta
+def get_profile_delta(padded: np.ndarray):
+    '''
+    Delta PAI for each height bin, i.e. the difference with the previous bin,
+    where the previous bin of the first one is the last one.
+    '''
+    delta = padded - np.roll(padded, 1, axis=1)
+    delta[delta < 0] = 0
+    return delta
 
-    df['pai_z_delta_np'] = df.apply(calc_delta, axis=1)
-    return df
 
+def get_profile_percentage(
+        padded: np.ndarray,
+        lengths: np.ndarray,
+        pai: np.ndarray):
+    ''' Profiles as percentages of total pai, padded with zeros. '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent = np.around(padded / pai[:, None] * 100, 1)
+    bins = np.arange(PAI_Z_BINS)
+    return np.where(bins < lengths[:, None], percent, 0).astype(np.float32)
 
-def calculate_pai_z_percentage(df: pd.DataFrame):
-    def calc_percentage(df):
-        pai_array = df.pai_z_np
-        pai = df.pai
-        return np.around((pai_array / pai) * 100, 1)
 
-    df['pai_z_percent'] = df.apply(calc_percentage, axis=1)
-    return df
+def _set_profile_columns(
+        df: pd.DataFrame,
+        columns: list[str],
+        matrix: np.ndarray):
+    # Assigning the columns one by one, or into an existing frame, would
+    # store them in as many blocks.
+    profiles = pd.DataFrame(matrix, index=df.index, columns=columns)
+    return pd.concat(
+        [df.drop(columns=columns, errors='ignore'), profiles], axis=1)
 
 
-def maximum_pai_height(df: pd.DataFrame):
-    df['pai_max_height'] = df.apply(lambda row: len(row.pai_z) * 5, axis=1)
+def transform_pai_z(df: pd.DataFrame):
+    '''
+    Transforms the original pai_z array into a more useful set of columns:
+    pai_z_length - number of bins of pai_z, once zeros are trimmed,
+    PAI_Z_PADDED - cumulative vertical pai starting from the lowest heights,
+    padded with zeros so that all the profiles are of the same length of 30,
+    PAI_Z_DELTA - delta PAI for each height bin.
+    '''
+    matrix, _ = pack_profiles(df.pai_z)
+    padded, lengths = trim_and_flip(matrix)
+    df['pai_z_length'] = lengths.astype(np.int8)
+    df = _set_profile_columns(df, PAI_Z_PADDED, padded)
+    df = _set_profile_columns(df, PAI_Z_DELTA, get_profile_delta(padded))
     return df
 
 
 def transform_pai_z_2(df: pd.DataFrame):
-    df = transform_pai_z_array_to_np(df)
-    df = calculate_pai_z_percentage(df)
-    df["pai_z"] = df.pai_z_np
-    df = df.drop(columns=["pai_z_np"])
-    df = maximum_pai_height(df)
-    df = pad_array(df, "pai_z")
-    df = pad_array(df, "pai_z_percent")
+    '''
+    Adds pai_z_length, PAI_Z_PADDED, PAI_Z_PERCENT_PADDED - the padded
+    profile as percentages of pai, and pai_max_height - the height of the
+    highest bin of the trimmed profile.
+    '''
+    matrix, _ = pack_profiles(df.pai_z)
+    padded, lengths = trim_and_flip(matrix)
+    df['pai_z_length'] = lengths.astype(np.int8)
+    df['pai_max_height'] = lengths * PAI_Z_BIN_HEIGHT
+    df = _set_profile_columns(df, PAI_Z_PADDED, padded)
+    df = _set_profile_columns(
+        df, PAI_Z_PERCENT_PADDED,
+        get_profile_percentage(padded, lengths, df.pai.to_numpy()))
     return df
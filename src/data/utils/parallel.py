@@ -0,0 +1,102 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Hashable
+
+import numpy as np
+from src.utils.logging_util import get_logger
+
+logger = get_logger(__file__)
+
+
+class SharedArrays:
+    '''
+    Copies numpy arrays into shared memory, so that worker processes can
+    attach to them by name, instead of receiving a pickled copy of the data.
+    '''
+
+    def __init__(self, arrays: dict[str, np.ndarray]):
+        self.specs = {}
+        self._shared_memory = []
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, array.dtype, buffer=shm.buf)[:] = array
+
+            self.specs[name] = (shm.name, array.shape, array.dtype.str)
+            self._shared_memory.append(shm)
+
+    def close(self):
+        for shm in self._shared_memory:
+            shm.close()
+            shm.unlink()
+        self._shared_memory = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _run_task(fn: Callable, specs: dict, key: Hashable):
+    shared_memory = {name: SharedMemory(name=spec[0])
+                     for name, spec in specs.items()}
+    arrays = {name: np.ndarray(shape, dtype, buffer=shared_memory[name].buf)
+              for name, (_, shape, dtype) in specs.items()}
+    try:
+        return fn(arrays, key)
+    finally:
+        # Views into shared memory have to be released before closing it.
+        del arrays
+        for shm in shared_memory.values():
+            shm.close()
+
+
+def run_parallel(
+        fn: Callable,
+        arrays: dict[str, np.ndarray],
+        keys: list,
+        workers: int = 1,
+        memory_budget: int = None,
+        task_memory: Callable = None):
+    '''
+    Runs fn(arrays, key) for every key, and returns the results in the order
+    of keys, regardless of the order in which tasks complete.
+
+    With more than one worker, tasks run in a process pool, and arrays are
+    shared with the workers through shared memory. fn must not return views
+    into the arrays. If memory_budget (in bytes) is provided, tasks are only
+    started while the sum of task_memory(key) estimates of the running tasks
+    fits in the budget. A single task is always allowed to run.
+    '''
+    if workers == 1:
+        return [fn(arrays, key) for key in keys]
+
+    results = {}
+    running = {}
+
+    def collect(futures):
+        for future in futures:
+            key, _ = running.pop(future)
+            results[key] = future.result()
+            logger.debug(f"Task {key} done.")
+
+    with SharedArrays(arrays) as shared, \
+            ProcessPoolExecutor(max_workers=workers) as executor:
+        for key in keys:
+            memory = task_memory(key) if task_memory is not None else 0
+            while running and (
+                    len(running) >= workers or (
+                        memory_budget is not None and
+                        sum(m for _, m in running.values()) + memory
+                        > memory_budget)):
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                collect(done)
+
+            logger.debug(f"Starting task {key}.")
+            future = executor.submit(_run_task, fn, shared.specs, key)
+            running[future] = (key, memory)
+
+        collect(list(wait(running).done))
+
+    return [results[key] for key in keys]
@@ -1,11 +1,14 @@
 import os
+import warnings
 
 import numpy as np
 import pandas as pd
 import rasterio as rio
 import rioxarray as riox
+from rasterio.coords import BoundingBox
 from rasterio.merge import merge
 from rasterio.warp import Resampling, calculate_default_transform, reproject
+from rasterio.windows import Window
 from src.utils.logging_util import get_logger
 
 logger = get_logger(__file__)
@@ -13,17 +16,75 @@ logger = get_logger(__file__)
 pd.options.mode.chained_assignment = None  # default='warn'
 
 
+# Statistics that can be computed over the pixels in a sampling kernel.
+KERNEL_STATS = {
+    "mean": np.mean,
+    "std": np.std,
+    "median": np.median,
+    "min": np.min,
+    "max": np.max,
+}
+# Same statistics, ignoring NaN (masked nodata) pixels.
+NAN_KERNEL_STATS = {
+    "mean": np.nanmean,
+    "std": np.nanstd,
+    "median": np.nanmedian,
+    "min": np.nanmin,
+    "max": np.nanmax,
+}
+DEFAULT_KERNEL_STATS = ["mean", "std", "median"]
+
+
 class RasterSampler:
     def __init__(
             self,
             raster_file_path: str,
             bands: list[str] = None,
-            bands_map: dict = None):
-        self.raster = riox.open_rasterio(raster_file_path)
+            bands_map: dict = None,
+            lazy: bool = False,
+            nodata: float = None,
+            drop_partial_nodata: bool = False):
+        '''
+        Pixels equal to nodata are excluded from kernel statistics. If nodata
+        is not provided, it's read from the raster metadata. With
+        drop_partial_nodata, a kernel with any nodata pixel is invalid,
+        rather than only kernels with nodata pixels only.
+        '''
         # Need to provide at least one - bands or bands_map.
         if bands is None and bands_map is None:
             raise Exception("bands or bands_map argument must be provided.")
 
+        self.raster_file_path = raster_file_path
+        self.lazy = lazy
+        if lazy:
+            # Only read the raster metadata. Pixel values are read on demand,
+            # one raster block at a time.
+            with rio.open(raster_file_path) as src:
+                self.height = src.height
+                self.width = src.width
+                self.dtype = src.dtypes[0]
+                self.block_shape = src.block_shapes[0]
+                raster_nodata = src.nodata
+                transform = src.transform
+                self.bounds = src.bounds
+                self.x, self.y = get_axis_coords(
+                    src.transform, src.width, src.height)
+        else:
+            self.raster = riox.open_rasterio(raster_file_path)
+            self.height = self.raster.shape[1]
+            self.width = self.raster.shape[2]
+            raster_nodata = self.raster.rio.nodata
+            transform = self.raster.rio.transform()
+            self.bounds = BoundingBox(*self.raster.rio.bounds())
+            self.x = self.raster.x.data
+            self.y = self.raster.y.data
+
+        self.nodata = raster_nodata if nodata is None else nodata
+        self.drop_partial_nodata = drop_partial_nodata
+
+        # Rasters with the same grid share pixel indices for the same coords.
+        self.grid = (self.width, self.height, tuple(transform))
+
         if bands_map is not None:
             self.bands_map = bands_map
             return
@@ -31,86 +92,383 @@ class RasterSampler:
         self.bands_map = dict(zip(range(len(bands)), bands))
 
     def sample_2x2(self, df: pd.DataFrame, x_coord: str, y_coord: str,
-                   expanded: bool = False):
-        xs = get_idxs_two_nearest(self.raster.x.data, df[x_coord].values)
-        ys = get_idxs_two_nearest(self.raster.y.data, df[y_coord].values)
-        valid = np.logical_and.reduce(
-            (
-                (np.min(xs, axis=1) >= 0),
-                (np.max(xs, axis=1) < self.raster.shape[2]),
-                (np.min(ys, axis=1) >= 0),
-                (np.max(ys, axis=1) < self.raster.shape[1]),
-            )
-        )
-        xs = xs[valid]
-        ys = ys[valid]
+                   expanded: bool = False, stats: list[str] = None):
+        if stats is None:
+            stats = DEFAULT_KERNEL_STATS + (["min", "max"] if expanded else [])
+        return self.sample_kernel(df, x_coord, y_coord, 2, stats,
+                                  with_values=expanded)
+
+    def sample_3x3(self, df: pd.DataFrame, x_coord: str, y_coord: str,
+                   debug: bool = False, stats: list[str] = None):
+        # With debug, it could be helpful to get the values from all 9 cells.
+        return self.sample_kernel(df, x_coord, y_coord, 3, stats,
+                                  with_values=debug)
+
+    def sample_kernel(self, df: pd.DataFrame, x_coord: str, y_coord: str,
+                      kernel: int, stats: list[str] = None,
+                      with_values: bool = False):
+        '''
+        Samples all bands on a kernel x kernel pixel box around each shot, and
+        attaches the requested kernel statistics as {band}_{stat} columns.
+        Shots whose kernel falls outside the raster, or has no valid pixels
+        in any of the bands, are dropped.
+
+        Pixel values for all bands are gathered into one array, and each
+        statistic is computed for all the bands at once, so statistics that
+        are not requested are never computed.
+        '''
+        if stats is None:
+            stats = DEFAULT_KERNEL_STATS
+
+        xs = get_kernel_idxs(self.x, df[x_coord].values, kernel)
+        ys = get_kernel_idxs(self.y, df[y_coord].values, kernel)
+        valid = self._valid_kernels(xs, ys)
         df = df.loc[valid]
 
+        rows, cols = get_kernel_cells(xs[valid], ys[valid])
+        values = self._read_pixels(rows, cols)
+
+        block = self._kernel_stats(values, stats)
+        if self.nodata is not None:
+            has_data = ~np.isnan(block).all(axis=1)
+            df = df.loc[has_data]
+            block = block[has_data]
+            values = values[:, has_data]
+
+        band_names = list(self.bands_map.values())
+        data = pd.DataFrame(
+            block,
+            index=df.index,
+            columns=[f'{band_name}_{stat}'
+                     for band_name in band_names for stat in stats])
+
+        if with_values:
+            for i, band_name in enumerate(band_names):
+                data[f'{band_name}_{kernel}x{kernel}'] = list(values[i])
+
+        return pd.concat([df, data], axis=1)
+
+    def sample(self, df: pd.DataFrame, x_coord: str, y_coord: str):
+        values = self.sample_values(df[x_coord].values, df[y_coord].values)
+
         # Calculate stats for each band. Attach to df.
-        all_bands = []
-        for band_idx, band_name in self.bands_map.items():
-            band_values = np.vstack(
-                [self.raster.data[band_idx, ys[:, j], xs[:, i]]
-                 for i in [0, 1] for j in [0, 1]]
-            ).T
-
-            data = {
-                f'{band_name}_mean': np.mean(band_values, axis=1),
-                f'{band_name}_std': np.std(band_values, axis=1),
-                f'{band_name}_median': np.median(band_values, axis=1)
-            }
-
-            if expanded:
-                # Add additional columns
-                data[f'{band_name}_2x2'] = list(band_values)
-                data[f'{band_name}_min'] = np.min(band_values, axis=1)
-                data[f'{band_name}_max'] = np.max(band_values, axis=1)
-
-            new_df = pd.DataFrame(index=df.index, data=data)
-            all_bands.append(new_df)
-
-        return pd.concat([df] + all_bands, axis=1)
+        for i, band_name in enumerate(self.bands_map.values()):
+            df[f'{band_name}'] = list(values[i])
+        return df
 
-    def sample_3x3(self, df: pd.DataFrame, x_coord: str, y_coord: str,
-                   debug: bool = False):
-        xs = get_idxs_three_nearest(self.raster.x.data, df[x_coord].values)
-        ys = get_idxs_three_nearest(self.raster.y.data, df[y_coord].values)
-        valid = np.logical_and.reduce(
+    def sample_values(self, x_values, y_values):
+        '''
+        Returns values of the pixels nearest to the given coords, for all the
+        bands, as an array of shape (bands, len(x_values)). Coords outside
+        the raster get values of the border pixels.
+        '''
+        xs = get_kernel_idxs(self.x, x_values, 1)
+        ys = get_kernel_idxs(self.y, y_values, 1)
+        return self._read_pixels(ys, xs)
+
+    def _kernel_stats(self, values, stats: list[str]):
+        '''
+        Computes kernel statistics, excluding nodata pixels. Statistics for
+        kernels without valid pixels are NaN.
+        '''
+        if self.nodata is None:
+            return get_kernel_stats(values, stats)
+
+        if np.isnan(self.nodata):
+            nodata = np.isnan(values)
+        else:
+            nodata = values == self.nodata
+        if not nodata.any():
+            return get_kernel_stats(values, stats)
+
+        if self.drop_partial_nodata:
+            nodata |= nodata.any(axis=2, keepdims=True)
+        masked = np.where(nodata, np.nan, values.astype(np.float64))
+        return get_kernel_stats(masked, stats, ignore_nan=True)
+
+    def _valid_kernels(self, xs, ys):
+        return np.logical_and.reduce(
             (
                 (np.min(xs, axis=1) >= 0),
-                (np.max(xs, axis=1) < self.raster.shape[2]),
+                (np.max(xs, axis=1) < self.width),
                 (np.min(ys, axis=1) >= 0),
-                (np.max(ys, axis=1) < self.raster.shape[1]),
+                (np.max(ys, axis=1) < self.height),
             )
         )
-        xs = xs[valid]
-        ys = ys[valid]
-        df = df.loc[valid]
 
-        # Calculate stats for each band. Attach to df.
-        for band_idx, band_name in self.bands_map.items():
-            band_values = np.vstack(
-                [self.raster.data[band_idx, ys[:, j], xs[:, i]]
-                 for i in [0, 1, 2] for j in [0, 1, 2]]
-            ).T
-
-            if debug:
-                # Could be helpful to get the values from all 4 cells.
-                df[f'{band_name}_3x3'] = list(band_values)
-            df[f'{band_name}_mean'] = np.mean(band_values, axis=1)
-            df[f'{band_name}_std'] = np.std(band_values, axis=1)
-            df[f'{band_name}_median'] = np.median(band_values, axis=1)
-        return df
+    def _within_bounds(self, x_values, y_values):
+        return (x_values >= self.bounds.left) & \
+            (x_values < self.bounds.right) & \
+            (y_values > self.bounds.bottom) & \
+            (y_values <= self.bounds.top)
+
+    def _read_pixels(self, rows, cols, blocks: tuple = None):
+        '''
+        Returns pixel values at (rows, cols) for all the bands in bands_map,
+        as an array of shape (bands, *rows.shape). Lazy samplers read the
+        pixels block by block, see get_block_groups, which can be passed in
+        as blocks when they were already computed for the same pixels.
+        '''
+        band_idxs = np.array(list(self.bands_map.keys()))
+        if not self.lazy:
+            values = self.raster.data[band_idxs[:, np.newaxis],
+                                      rows.ravel(), cols.ravel()]
+            return values.reshape(band_idxs.size, *rows.shape)
+
+        if blocks is None:
+            blocks = get_block_groups(
+                rows, cols, self.block_shape, self.width)
+        return self._read_pixels_windowed(band_idxs, rows, cols, blocks)
+
+    def _read_pixels_windowed(self, band_idxs, rows, cols, blocks: tuple):
+        # Read each touched block once, with all the bands at the same time.
+        # Peak memory is a single block, regardless of the raster size.
+        shape = rows.shape
+        rows = rows.ravel()
+        cols = cols.ravel()
+        values = np.empty((band_idxs.size, rows.size), dtype=self.dtype)
+
+        block_height, block_width = self.block_shape
+        blocks_per_row = -(-self.width // block_width)
+        order, sorted_ids, group_starts, group_ends = blocks
+
+        logger.debug(f"Reading {group_starts.size} raster blocks from "
+                     f"{self.raster_file_path}.")
+        with rio.open(self.raster_file_path) as src:
+            for start, end in zip(group_starts, group_ends):
+                block_row, block_col = divmod(
+                    sorted_ids[start], blocks_per_row)
+                row_off = block_row * block_height
+                col_off = block_col * block_width
+                window = Window(
+                    col_off, row_off,
+                    min(block_width, self.width - col_off),
+                    min(block_height, self.height - row_off))
+                block = src.read((band_idxs + 1).tolist(), window=window)
+
+                pixel_idxs = order[start:end]
+                values[:, pixel_idxs] = block[:,
+                                              rows[pixel_idxs] - row_off,
+                                              cols[pixel_idxs] - col_off]
+        return values.reshape(band_idxs.size, *shape)
+
+
+class StackedRasterSampler:
+    '''
+    Samples a stack of rasters, e.g. the same product over many years, in a
+    single pass over the shots.
+
+    Pixel indices are computed once per distinct raster grid, so co-registered
+    rasters share them, and statistics for all rasters and bands are written
+    into one preallocated block. Band names must be unique across the stack.
+    Unlike RasterSampler, shots falling outside a raster, or whose kernel
+    does, are not dropped, but get NaN values for that raster's columns, for
+    every kernel size.
+    '''
+
+    def __init__(self, samplers: list[RasterSampler]):
+        band_names = [band_name for sampler in samplers
+                      for band_name in sampler.bands_map.values()]
+        if len(band_names) != len(set(band_names)):
+            raise Exception(
+                f"Band names must be unique across rasters: {band_names}")
+
+        self.samplers = samplers
+
+        # Group rasters by grid, falling back to separate index computation
+        # for rasters that are not co-registered.
+        self.grids = {}
+        for sampler in samplers:
+            self.grids.setdefault(sampler.grid, []).append(sampler)
+
+    def sample(self, df: pd.DataFrame, x_coord: str, y_coord: str,
+               kernel: int, stats: list[str] = None):
+        if stats is None:
+            stats = DEFAULT_KERNEL_STATS
+        # Kernel of size 1 returns raw pixel values, in a column per band.
+        if kernel == 1:
+            stats = [None]
+
+        columns = []
+        offsets = {}
+        for sampler in self.samplers:
+            offsets[id(sampler)] = len(columns)
+            columns += [band_name if stat is None else f"{band_name}_{stat}"
+                        for band_name in sampler.bands_map.values()
+                        for stat in stats]
+
+        block = np.full((len(df), len(columns)), np.nan)
+        for grid, grid_samplers in self.grids.items():
+            logger.debug(f"Sampling {len(grid_samplers)} rasters with grid "
+                         f"{grid}.")
+            xs = get_kernel_idxs(grid_samplers[0].x, df[x_coord].values,
+                                 kernel)
+            ys = get_kernel_idxs(grid_samplers[0].y, df[y_coord].values,
+                                 kernel)
+            # Pixel indices of shots outside the raster are clamped to its
+            # border, so those shots are masked explicitly.
+            valid = grid_samplers[0]._within_bounds(
+                df[x_coord].values, df[y_coord].values)
+            if kernel == 1:
+                rows, cols = ys[valid, np.newaxis], xs[valid, np.newaxis]
+            else:
+                valid &= grid_samplers[0]._valid_kernels(xs, ys)
+                rows, cols = get_kernel_cells(xs[valid], ys[valid])
+
+            # Lazy rasters with the same grid and block shape read the same
+            # blocks, so pixels are grouped by block once for all of them.
+            blocks = {}
+            for sampler in grid_samplers:
+                if sampler.lazy and sampler.block_shape not in blocks:
+                    blocks[sampler.block_shape] = get_block_groups(
+                        rows, cols, sampler.block_shape, sampler.width)
+                values = sampler._read_pixels(
+                    rows, cols,
+                    blocks.get(sampler.block_shape) if sampler.lazy else None)
+                start = offsets[id(sampler)]
+                end = start + len(sampler.bands_map) * len(stats)
+                block[valid, start:end] = values[:, :, 0].T \
+                    if kernel == 1 else sampler._kernel_stats(values, stats)
+
+        return pd.DataFrame(block, index=df.index, columns=columns)
+
+
+def get_block_groups(rows, cols, block_shape: tuple, width: int):
+    '''
+    Groups pixels at (rows, cols) by the raster block of block_shape they
+    fall in. Returns the order of the pixels sorted by block id, the sorted
+    block ids, and the start and end of every block's group of pixels in
+    that order.
+    '''
+    block_height, block_width = block_shape
+    blocks_per_row = -(-width // block_width)
+    block_ids = (rows.ravel() // block_height) * blocks_per_row + \
+        cols.ravel() // block_width
+
+    order = np.argsort(block_ids, kind="stable")
+    sorted_ids = block_ids[order]
+    group_starts = np.flatnonzero(np.diff(sorted_ids, prepend=-1) != 0)
+    group_ends = np.append(group_starts[1:], sorted_ids.size)
+    return order, sorted_ids, group_starts, group_ends
+
+
+def get_kernel_stats(values, stats: list[str], ignore_nan: bool = False):
+    '''
+    Computes kernel statistics for pixel values of shape (bands, shots, cells),
+    one reducer call per statistic over all the bands. Returns a block of
+    shape (shots, bands * len(stats)), with a column per band and statistic.
+    With ignore_nan, NaN pixels are excluded, and kernels with only NaN
+    pixels get NaN statistics.
+    '''
+    reducers = NAN_KERNEL_STATS if ignore_nan else KERNEL_STATS
+    block = np.empty((values.shape[1], values.shape[0], len(stats)))
+    with warnings.catch_warnings():
+        # All-NaN kernels are expected, and result in NaN statistics.
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        for i, stat in enumerate(stats):
+            block[:, :, i] = reducers[stat](values, axis=2).T
+    return block.reshape(values.shape[1], -1)
+
+
+def get_axis_coords(transform, width: int, height: int):
+    '''
+    Returns the pixel center coordinates along the x and y axes of a raster,
+    computed the same way as rioxarray does for raster.x and raster.y.
+    '''
+    xs, _ = transform * (np.arange(width) + 0.5, np.zeros(width) + 0.5)
+    _, ys = transform * (np.zeros(height) + 0.5, np.arange(height) + 0.5)
+    return xs, ys
+
+
+def get_kernel_cells(xs, ys):
+    '''
+    Expands per-axis kernel indices of shape (shots, k) into row and column
+    indices of every cell in the k x k kernel, both of shape (shots, k * k).
+    Cells are ordered column by column.
+    '''
+    kernel = xs.shape[1]
+    rows = ys[:, np.tile(np.arange(kernel), kernel)]
+    cols = xs[:, np.repeat(np.arange(kernel), kernel)]
+    return rows, cols
+
+
+def get_kernel_idxs(array, values, kernel: int):
+    """Vectorized lookup of the pixel indices covering the given coords.
+
+    Equivalent to get_idx (kernel=1), get_idxs_two_nearest (kernel=2) and
+    get_idxs_three_nearest (kernel=3), including their out-of-bounds
+    semantics, but without looping over the coords in Python.
 
-    def sample(self, df: pd.DataFrame, x_coord: str, y_coord: str):
-        xs = get_idx(self.raster.x.data, df[x_coord].values)
-        ys = get_idx(self.raster.y.data, df[y_coord].values)
+    Args:
+        array (n,): array of of raster coordinate values
+                    e.g. from raster.x.data
+        values (k,): coordinate values to find in the raster
+        kernel: size of the pixel box to find, one of 1, 2 or 3
+    Returns:
+        np.array(k,) for kernel 1, np.array(k, kernel) otherwise
+    """
+    values = np.asarray(values)
+    if kernel == 1:
+        return get_nearest_idxs(array, values)
+    elif kernel == 2:
+        half_pixel = (array[1] - array[0]) / 2
+        array_center = array + half_pixel
+        nearest = get_nearest_idxs(array_center, values)
+        second = np.where(values < array_center[nearest],
+                          nearest - 1, nearest + 1)
+        return np.stack([nearest, second], axis=1)
+    elif kernel == 3:
+        nearest = get_nearest_idxs(array, values)
+        return nearest[:, np.newaxis] + np.arange(-1, 2)
+
+    raise ValueError(f"Unsupported kernel size {kernel}.")
+
+
+def get_nearest_idxs(array, values):
+    """Find the index of the nearest raster coordinate for each value.
+
+    Regularly spaced axes (any axis derived from an affine transform) are
+    indexed arithmetically, irregular ones with a binary search. Values
+    outside the raster are clamped to the border pixel, and ties go to the
+    lower index, same as np.argmin in get_idx.
 
-        # Calculate stats for each band. Attach to df.
-        for band_idx, band_name in self.bands_map.items():
-            band_values = self.raster.data[band_idx, ys, xs]
-            df[f'{band_name}'] = list(band_values)
-        return df
+    Args:
+        array (n,): monotonic array of raster coordinate values
+        values (k,): coordinate values to find in the raster
+    Returns:
+        np.array(k,): indices of the nearest coordinate values
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if array.size == 1:
+        return np.zeros(values.shape, dtype=np.int64)
+
+    step = array[1] - array[0]
+    if np.allclose(np.diff(array), step):
+        # Pixel k is centered at array[0] + k * step, so the nearest pixel is
+        # the rounded fractional pixel position.
+        idxs = np.ceil((values - array[0]) / step - 0.5)
+        return np.clip(idxs, 0, array.size - 1).astype(np.int64)
+
+    return _get_nearest_idxs_searchsorted(array, values)
+
+
+def _get_nearest_idxs_searchsorted(array, values):
+    descending = array[-1] < array[0]
+    ascending_array = array[::-1] if descending else array
+
+    right = np.clip(np.searchsorted(ascending_array, values),
+                    1, array.size - 1)
+    left = right - 1
+    distance_left = values - ascending_array[left]
+    distance_right = ascending_array[right] - values
+
+    if descending:
+        # Ties go to the lower index in the original (descending) array.
+        idxs = np.where(distance_left < distance_right, left, right)
+        return (array.size - 1 - idxs).astype(np.int64)
+
+    idxs = np.where(distance_left <= distance_right, left, right)
+    return idxs.astype(np.int64)
 
 
 def get_idxs_two_nearest(array, values):
@@ -188,6 +546,13 @@ def get_idx(array, values):
     return nearest_idxs
 
 
+def get_raster_memory(file_path: str) -> int:
+    ''' Returns the size in bytes of a fully loaded raster. '''
+    with rio.open(file_path) as src:
+        itemsize = np.dtype(src.dtypes[0]).itemsize
+        return src.width * src.height * src.count * itemsize
+
+
 def reproject_raster(file_path: str, out_file_path: str,
                      dst_crs: str = 'EPSG:4326'):
 
@@ -0,0 +1,78 @@
+# Benchmarks the vectorized pixel index lookup against the original per-shot
+# loops in src.data.utils.raster, on synthetic raster axes and GEDI shots.
+#
+# Run with: python -m src.data.utils.raster_benchmark
+
+import time
+
+import numpy as np
+from src.data.utils import raster
+from src.utils.logging_util import get_logger
+
+logger = get_logger(__file__)
+
+# Roughly the extent of the Sierras at 30m resolution.
+WIDTH = 20000
+HEIGHT = 30000
+PIXEL_SIZE = 0.00026949
+LON_ORIGIN = -122.0
+LAT_ORIGIN = 41.0
+
+LOOP_FUNCTIONS = {
+    1: raster.get_idx,
+    2: raster.get_idxs_two_nearest,
+    3: raster.get_idxs_three_nearest,
+}
+
+
+def get_synthetic_axes(irregular: bool = False):
+    xs = LON_ORIGIN + PIXEL_SIZE * (np.arange(WIDTH) + 0.5)
+    ys = LAT_ORIGIN - PIXEL_SIZE * (np.arange(HEIGHT) + 0.5)
+    if irregular:
+        # Jitter the pixel centers so that the arithmetic path can't be used.
+        rng = np.random.default_rng(0)
+        xs += rng.uniform(-0.1, 0.1, WIDTH) * PIXEL_SIZE
+        ys += rng.uniform(-0.1, 0.1, HEIGHT) * PIXEL_SIZE
+    return xs, ys
+
+
+def get_synthetic_shots(num_shots: int):
+    # Include a margin around the raster, to exercise out-of-bounds shots.
+    rng = np.random.default_rng(1)
+    margin = 10 * PIXEL_SIZE
+    lons = rng.uniform(LON_ORIGIN - margin,
+                       LON_ORIGIN + WIDTH * PIXEL_SIZE + margin, num_shots)
+    lats = rng.uniform(LAT_ORIGIN - HEIGHT * PIXEL_SIZE - margin,
+                       LAT_ORIGIN + margin, num_shots)
+    return lons, lats
+
+
+def time_fn(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def run_benchmark(num_shots: int = 20000, irregular: bool = False):
+    xs, ys = get_synthetic_axes(irregular)
+    lons, lats = get_synthetic_shots(num_shots)
+
+    for kernel, loop_fn in LOOP_FUNCTIONS.items():
+        for axis, values in [(xs, lons), (ys, lats)]:
+            expected, loop_time = time_fn(loop_fn, axis, values)
+            actual, vectorized_time = time_fn(
+                raster.get_kernel_idxs, axis, values, kernel)
+
+            if not np.array_equal(expected, actual):
+                raise Exception(
+                    f"Vectorized indices differ for kernel {kernel}.")
+
+            logger.info(
+                f"kernel={kernel} irregular={irregular} shots={num_shots} "
+                f"axis={axis.size}: loop {loop_time:.3f}s, vectorized "
+                f"{vectorized_time:.4f}s ({loop_time / vectorized_time:.0f}x)")
+
+
+if __name__ == '__main__':
+    run_benchmark(irregular=False)
+    run_benchmark(irregular=True)
@@ -1,3 +1,5 @@
+import math
+
 import geopandas as gpd
 
 from shapely.geometry import box
@@ -40,3 +42,31 @@ def get_box(region_gpd: gpd.GeoDataFrame, crs: int = None) -> gpd.GeoDataFrame:
 
     return gpd.GeoDataFrame({'geometry':
                              gpd.GeoSeries([box_envelope]).set_crs(crs)})
+
+
+def get_grid(region_gpd: gpd.GeoDataFrame, tile_size: float, crs: int = None) \
+        -> gpd.GeoDataFrame:
+    '''
+    Split a shape into a grid of square tiles of tile_size, in units of crs.
+    Tiles are clipped to the shape, and tiles outside of it are dropped.
+    Returns a Geo DataFrame with a tile name, built from the tile's grid
+    position, and its geometry.
+    '''
+    if crs is None:
+        crs = region_gpd.crs
+
+    shape = get_union(region_gpd, crs).geometry.iloc[0]
+    minx, miny, maxx, maxy = shape.bounds
+    names = []
+    tiles = []
+    for i in range(max(1, math.ceil((maxx - minx) / tile_size))):
+        for j in range(max(1, math.ceil((maxy - miny) / tile_size))):
+            tile = box(minx + i * tile_size, miny + j * tile_size,
+                       minx + (i + 1) * tile_size, miny + (j + 1) * tile_size)
+            tile = tile.intersection(shape)
+            if not tile.is_empty:
+                names.append(f"tile_{i}_{j}")
+                tiles.append(tile)
+
+    return gpd.GeoDataFrame(
+        {'tile': names, 'geometry': gpd.GeoSeries(tiles).set_crs(crs)})
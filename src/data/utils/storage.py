@@ -0,0 +1,218 @@
+# Storage of intermediate data frames as Parquet files, or GeoParquet for
+# frames with geometry. Frames indexed by shot number are sorted by it, and
+# written in row groups, so that reads can skip row groups that don't match
+# a filter on shot number, and only read the requested columns.
+#
+# Intermediate results used to be pickles. Loading a Parquet path that
+# doesn't exist yet falls back to the pickle with the same name, and migrates
+# it to Parquet.
+
+import json
+import operator
+import os
+import uuid
+from contextlib import contextmanager
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow
+import pyarrow.parquet as pq
+from fastai.tabular.all import load_pickle, save_pickle
+from src.utils.logging_util import get_logger
+
+logger = get_logger(__file__)
+
+SHOT_NUMBER = "shot_number"
+ROW_GROUP_SIZE = 1_000_000
+
+FILTER_OPERATORS = {
+    "=": operator.eq,
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda values, other: np.isin(values, list(other)),
+    "not in": lambda values, other: ~np.isin(values, list(other)),
+}
+
+
+def PICKLE_PATH(path: str):
+    return f"{os.path.splitext(path)[0]}.pkl"
+
+
+@contextmanager
+def atomic_path(path: str):
+    '''
+    Yields a temporary path to write to, which is moved to path once the
+    block completes, so that concurrent readers, e.g. of a frame being
+    migrated, never see the file half written. Every writer has its own
+    temporary file, which is removed if the block fails.
+    '''
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _write_parquet(path: str, df: pd.DataFrame):
+    if df.index.name == SHOT_NUMBER and not df.index.is_monotonic_increasing:
+        df = df.sort_index(kind="stable")
+    with atomic_path(path) as tmp_path:
+        # GeoDataFrames are written as GeoParquet.
+        df.to_parquet(tmp_path, row_group_size=ROW_GROUP_SIZE)
+
+
+def save_frame(path: str, df: pd.DataFrame):
+    '''
+    Saves df as Parquet in path. Frames with columns that can't be stored in
+    Parquet, e.g. mixed type objects, are pickled instead.
+    '''
+    try:
+        _write_parquet(path, df)
+    except (pyarrow.ArrowException, ValueError, TypeError) as e:
+        logger.warning(f"Can't save {path} as Parquet, pickling instead: {e}")
+        save_pickle(PICKLE_PATH(path), df)
+
+
+def _is_pickle_newer(path: str):
+    pickle_path = PICKLE_PATH(path)
+    if not os.path.exists(pickle_path) or pickle_path == path:
+        return False
+    return not os.path.exists(path) or \
+        os.path.getmtime(pickle_path) > os.path.getmtime(path)
+
+
+def stored_path(path: str):
+    '''
+    Returns the file that holds the frame saved in path, which is the pickle
+    with the same name, if it's newer than path or path doesn't exist.
+    '''
+    return PICKLE_PATH(path) if _is_pickle_newer(path) else path
+
+
+def frame_exists(path: str):
+    return os.path.exists(stored_path(path))
+
+
+def _filter_frame(df: pd.DataFrame, filters: list):
+    # Applies filters in the pyarrow format, i.e. a list of (column, op,
+    # value) conjunctions, or a list of such lists, combined with OR.
+    if not filters:
+        return df
+    if isinstance(filters[0], tuple):
+        filters = [filters]
+
+    def values_of(column):
+        return df.index.values if column == df.index.name \
+            else df[column].values
+
+    mask = np.zeros(len(df), dtype=bool)
+    for conjunction in filters:
+        conjunction_mask = np.ones(len(df), dtype=bool)
+        for column, op, value in conjunction:
+            conjunction_mask &= FILTER_OPERATORS[op](values_of(column), value)
+        mask |= conjunction_mask
+    return df[mask]
+
+
+def _load_pickle(path: str, columns: list[str], filters: list):
+    pickle_path = PICKLE_PATH(path)
+    df = load_pickle(pickle_path)
+    if isinstance(df, pd.DataFrame):
+        try:
+            logger.info(f"Migrating {pickle_path} to {path}.")
+            _write_parquet(path, df)
+        except (pyarrow.ArrowException, ValueError, TypeError) as e:
+            logger.warning(f"Can't migrate {pickle_path} to Parquet: {e}")
+
+    df = _filter_frame(df, filters)
+    return df if columns is None else df[columns]
+
+
+def load_frame(
+        path: str,
+        columns: list[str] = None,
+        filters: list = None):
+    '''
+    Loads a frame saved with save_frame. Only the requested columns are read,
+    along with the index, and filters are pushed down to the Parquet reader,
+    e.g. [("shot_number", ">=", start), ("shot_number", "<", end)].
+
+    GeoParquet files are loaded as GeoDataFrames, unless the geometry column
+    isn't requested.
+    '''
+    if _is_pickle_newer(path):
+        return _load_pickle(path, columns, filters)
+
+    geo = (pq.read_schema(path).metadata or {}).get(b"geo")
+    if geo is not None:
+        geometry_column = json.loads(geo)["primary_column"]
+        if columns is None or geometry_column in columns:
+            return gpd.read_parquet(path, columns=columns, filters=filters)
+    return pd.read_parquet(path, columns=columns, filters=filters)
+
+
+def get_columns(path: str):
+    '''
+    Returns the columns of the frame saved in path, without the index,
+    reading only the Parquet schema.
+    '''
+    if _is_pickle_newer(path):
+        return list(load_pickle(PICKLE_PATH(path)).columns)
+
+    schema = pq.read_schema(path)
+    pandas_metadata = schema.pandas_metadata or {}
+    index_columns = [column for column in
+                     pandas_metadata.get("index_columns", [])
+                     if isinstance(column, str)]
+    return [name for name in schema.names if name not in index_columns]
+
+
+class FrameWriter:
+    '''
+    Writes a frame to a Parquet file in chunks, so that the whole frame never
+    has to be in memory. All chunks are cast to schema, or if it's not given,
+    to the schema of the first chunk, which only works if no column of the
+    first chunk is all null. The file only appears in path once the writer is
+    closed without errors.
+    '''
+
+    def __init__(self, path: str, schema: pyarrow.Schema = None):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.schema = schema
+        self.num_rows = 0
+        self._writer = None
+
+    def write(self, df: pd.DataFrame):
+        table = pyarrow.Table.from_pandas(
+            df, schema=self.schema if self._writer is None
+            else self._writer.schema,
+            preserve_index=False)
+        if self._writer is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._writer = pq.ParquetWriter(self.tmp_path, table.schema)
+        self._writer.write_table(table, row_group_size=ROW_GROUP_SIZE)
+        self.num_rows += len(df)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        elif self._writer is not None:
+            self._writer.close()
+            os.remove(self.tmp_path)
@@ -8,7 +8,7 @@ import numpy as np
 import pandas as pd
 from src.data.fire_perimeters import Fire, FirePerimeters
 from src.data import k_nn
-from src.data import pai_vertical
+from src.data.utils import pai_vertical
 import datetime
 import importlib
 importlib.reload(pai_vertical)
@@ -24,6 +24,7 @@ def find_matches(
     '''
     For each row in the left GeoDataFrame, it finds the closest row in the 
     right GeoDataFrame, and extracts column values from the matching row.
+    Columns are compared as one matrix, e.g. pai_vertical.PAI_Z_DELTA.
     '''
     if severity is None:
         left_input = left
@@ -40,19 +41,20 @@ def find_matches(
         left_input, right_input, 1)
 
     result = left_input.copy()
+    matched = right_input.iloc[closest_indeces.flatten()]
     result['closest_distance'] = distances
     result[f'match_datetime'] = pd.to_datetime(
-        right_input.iloc[closest_indeces.flatten()
-                         ].absolute_time.values, utc=True, format='mixed')
+        matched.absolute_time.values, utc=True, format='mixed')
 
     if column is not None:
         columns = [column]
 
-    for col in columns:
-        result[f'{col}_after'] = right_input.iloc[closest_indeces.flatten()
-                                                  ][col].values
-        result[f'{col}_diff'] = result[f'{col}_after'] - result[col]
-        result[f'{col}_rel'] = result[f'{col}_after']/result[col]
+    before = result[columns].to_numpy()
+    after = matched[columns].to_numpy()
+    result[[f'{col}_after' for col in columns]] = after
+    result[[f'{col}_diff' for col in columns]] = after - before
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result[[f'{col}_rel' for col in columns]] = after / before
 
     return result
 
@@ -152,7 +154,8 @@ def match_pai_z_before_and_after_date(
 
     # For each shot in before fire, find the closest shot after fire.
     # Break it down per severity.
-    result = find_matches(before_date, after_date, column='pai_z_delta_np')
+    result = find_matches(
+        before_date, after_date, columns=pai_vertical.PAI_Z_DELTA)
     result['start_offset'] = start_offset
     result['end_offset'] = end_offset
     return result
@@ -222,9 +225,12 @@ def match_pai_z_before_and_after_fire(
 
     # For each shot in before fire, find the closest shot after fire.
     # Break it down per severity.
-    result_low = find_matches(before_fire, after_fire, 2, 'pai_z_delta_np')
-    result_medium = find_matches(before_fire, after_fire, 3, 'pai_z_delta_np')
-    result_high = find_matches(before_fire, after_fire, 4, 'pai_z_delta_np')
+    result_low = find_matches(
+        before_fire, after_fire, 2, columns=pai_vertical.PAI_Z_DELTA)
+    result_medium = find_matches(
+        before_fire, after_fire, 3, columns=pai_vertical.PAI_Z_DELTA)
+    result_high = find_matches(
+        before_fire, after_fire, 4, columns=pai_vertical.PAI_Z_DELTA)
 
     if result_low is None and result_medium is None and result_high is None:
         return None
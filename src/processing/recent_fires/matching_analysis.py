@@ -7,6 +7,7 @@ import scipy.stats as stats
 from sklearn.metrics import r2_score
 from sklearn.linear_model import LinearRegression
 
+from src.data.utils import pai_vertical
 from src.processing.recent_fires.gedi_matching import get_closest_matches
 
 
@@ -243,22 +244,15 @@ def transform_pai_z_data(df, rel=False):
 
 
 def _unpack_pai_z(df, severity, date_since, rel):
-    if rel:
-        pai_z = df[(df.severity == severity) & (
-            df.date_since == date_since)].pai_z_delta_np_rel.to_numpy()
-    else:
-        pai_z = df[(df.severity == severity) & (
-            df.date_since == date_since)].pai_z_delta_np_diff.to_numpy()
+    suffix = 'rel' if rel else 'diff'
+    columns = [f'{col}_{suffix}' for col in pai_vertical.PAI_Z_DELTA]
+    pai_z = df.loc[(df.severity == severity) & (
+        df.date_since == date_since), columns].to_numpy()
 
     if pai_z.shape[0] == 0:
         return
 
-    unpacked = np.empty((pai_z.shape[0], pai_z[0].shape[0]))
-
-    for i in range(pai_z.shape[0]):
-        unpacked[i] = pai_z[i]
-
-    new_df = pd.melt(pd.DataFrame(unpacked))
+    new_df = pd.melt(pd.DataFrame(pai_z))
     new_df['severity'] = severity
     new_df['date_since'] = date_since
     return new_df